@@ -0,0 +1,126 @@
+"""
+Compiled vs eager inference benchmark of `rsverac.VeraModel`.
+
+Builds a small, randomly initialized RoBERTa model locally (no downloads), wraps it with `get_peft_model` and measures
+the inference throughput of the eager model, of the eager model with a frozen adapter topology
+(`VeraModel.freeze_topology`) and of the frozen model compiled with `torch.compile` (inductor), as well as the time of
+the first, compiling, call and the number of graph breaks. Run from the root of the repository:
+
+    python -m benchmarks.bench_compile --hidden 768 --layers 4 --r 256 --output compile.json
+"""
+import argparse
+import dataclasses
+import time
+import warnings
+
+import torch
+import torch._dynamo
+from peft import get_peft_model
+from peft.peft_model import PEFT_TYPE_TO_MODEL_MAPPING
+
+from rsverac.model import VeraModel
+
+from .bench_model import make_base_model, make_peft_config
+from .common import DTYPES, time_fn, write_results
+
+
+PEFT_TYPE_TO_MODEL_MAPPING["VERA"] = VeraModel
+
+
+def graph_breaks(model, inputs) -> int:
+    torch._dynamo.reset()
+    with torch.no_grad():
+        return torch._dynamo.explain(model)(**inputs).graph_break_count
+
+
+def bench_mode(mode, model, inputs, args, device):
+    """Times the inference of `model`, compiled first for the `compiled` modes. Returns the results and the model."""
+    result = {"mode": mode}
+    if mode.startswith("compiled"):
+        result["graph_breaks"] = graph_breaks(model, inputs)
+        torch._dynamo.reset()
+        model = torch.compile(model, backend="inductor", mode=args.compile_mode)
+        start = time.perf_counter()
+        with torch.no_grad():
+            model(**inputs)
+        result["first_call_ms"] = (time.perf_counter() - start) * 1e3
+
+    def forward():
+        with torch.no_grad():
+            model(**inputs)
+
+    timings = time_fn(forward, repeats=args.repeats, warmup=args.warmup, device=device)
+    tokens = args.batch_size * args.seq
+    result.update(timings, tokens_per_s=tokens / (timings["median_ms"] / 1e3))
+    return result, model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", type=int, default=768, help="Hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Number of hidden layers")
+    parser.add_argument("--heads", type=int, default=12, help="Number of attention heads")
+    parser.add_argument("--vocab_size", type=int, default=1000, help="Vocabulary size")
+    parser.add_argument("--r", type=int, default=256, help="R value for VeraConfig")
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--seq", type=int, default=128, help="Sequence length")
+    parser.add_argument("--dtype", type=str, default="float32", help="Dtype of the model")
+    parser.add_argument("--device", type=str, default="cpu", help="Device")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument(
+        "--modes",
+        type=str,
+        default="eager,eager_frozen,compiled_frozen",
+        help="Comma separated modes among eager, eager_frozen, compiled and compiled_frozen",
+    )
+    parser.add_argument(
+        "--merge_weights",
+        action="store_true",
+        help="Use the `auto` strategy and freeze with `num_tokens`, so that the layers faster with merged weights"
+        " freeze them",
+    )
+    parser.add_argument("--compile_mode", type=str, default=None, help="`mode` of torch.compile")
+    parser.add_argument("--repeats", type=int, default=10, help="Timed repetitions per measurement")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed repetitions per measurement")
+    parser.add_argument("--output", type=str, default=None, help="JSON output file, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    dtype = DTYPES[args.dtype]
+    generator = torch.Generator().manual_seed(0)
+    inputs = {
+        "input_ids": torch.randint(3, args.vocab_size, (args.batch_size, args.seq), generator=generator).to(device),
+        "attention_mask": torch.ones(args.batch_size, args.seq, dtype=torch.long).to(device),
+    }
+    num_tokens = args.batch_size * args.seq if args.merge_weights else None
+
+    results = []
+    reference = None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for mode in args.modes.split(","):
+            config = make_peft_config(args)
+            if args.merge_weights:
+                config = dataclasses.replace(config, execution_strategy="auto")
+            model = get_peft_model(make_base_model(args), config)
+            model = model.to(device=device, dtype=dtype).eval()
+            if mode.endswith("_frozen"):
+                model.base_model.freeze_topology(num_tokens=num_tokens)
+            result, model = bench_mode(mode, model, inputs, args, device)
+
+            # the compiled and frozen models must compute the same logits as the eager one
+            with torch.no_grad():
+                logits = model(**inputs).logits.float()
+            if reference is None:
+                reference = logits
+            result["max_abs_diff"] = (logits - reference).abs().max().item()
+            results.append(result)
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    write_results(results, args.output, **config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Int8 backbone benchmark and accuracy parity check of `rsverac.VeraModel`.
+
+Builds the same small, randomly initialized RoBERTa model (no downloads) twice, with a float32 backbone and with the
+targeted `nn.Linear` base layers quantized to int8 (`quantize_backbone="int8"`), and compares:
+
+- the bytes of the targeted base layers,
+- the latency of an inference forward and of a training step (forward, backward, optimizer step),
+- the logits and the gradients of the lambdas on the same batch,
+- the losses and accuracies of a short training run on a synthetic classification task, from the same initial lambdas.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_int8 --hidden 768 --layers 4 --r 256 --steps 50 --output int8.json
+
+With `--check`, the script fails once the results are written if the int8 logits are off by more than
+`--max_logits_rel_error` or the int8 lambda gradients less aligned than `--min_grad_cosine` with the float32 ones, e.g.
+as a quick regression test:
+
+    python -m benchmarks.bench_int8 --hidden 256 --layers 2 --r 64 --steps 5 --repeats 1 --check
+"""
+import argparse
+import dataclasses
+import warnings
+
+import torch
+from peft import get_peft_model
+from peft.peft_model import PEFT_TYPE_TO_MODEL_MAPPING
+
+from rsverac.layer import Linear
+from rsverac.model import VeraModel
+
+from .bench_model import make_base_model, make_peft_config
+from .common import time_fn, write_results
+
+
+PEFT_TYPE_TO_MODEL_MAPPING["VERA"] = VeraModel
+
+
+def build(args, quantize_backbone):
+    config = dataclasses.replace(
+        make_peft_config(args), target_modules=args.target_modules.split(","), quantize_backbone=quantize_backbone
+    )
+    model = get_peft_model(make_base_model(args), config)
+    # the same non-trivial lambdas and head for both backbones
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if param.requires_grad:
+                param.copy_(param + 0.1 * torch.randn(param.shape, generator=generator))
+    return model
+
+
+def base_layer_bytes(model) -> int:
+    layers = [module.get_base_layer() for module in model.modules() if isinstance(module, Linear)]
+    return sum(t.numel() * t.element_size() for layer in layers for t in [*layer.parameters(), *layer.buffers()])
+
+
+def make_task(args):
+    """Random token sequences labelled by whether their first token is in the upper half of the vocabulary."""
+    generator = torch.Generator().manual_seed(2)
+    input_ids = torch.randint(3, args.vocab_size, (args.batch_size * 8, args.seq), generator=generator)
+    labels = (input_ids[:, 0] >= args.vocab_size // 2).long()
+    return input_ids.split(args.batch_size), labels.split(args.batch_size)
+
+
+def train(model, batches, args):
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args.lr)
+    input_ids, labels = batches
+    model.train()
+    losses = []
+    for step in range(args.steps):
+        i = step % len(input_ids)
+        loss = model(input_ids=input_ids[i], labels=labels[i]).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        losses.append(loss.item())
+
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for ids, y in zip(input_ids, labels):
+            correct += (model(input_ids=ids).logits.argmax(-1) == y).sum().item()
+    return losses, correct / sum(len(y) for y in labels)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", type=int, default=768, help="Hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Number of hidden layers")
+    parser.add_argument("--heads", type=int, default=12, help="Number of attention heads")
+    parser.add_argument("--vocab_size", type=int, default=1000, help="Vocabulary size")
+    parser.add_argument("--r", type=int, default=256, help="R value for VeraConfig")
+    parser.add_argument("--target_modules", type=str, default="query,key,value", help="Comma separated targets")
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--seq", type=int, default=128, help="Sequence length")
+    parser.add_argument("--steps", type=int, default=50, help="Training steps of the parity run")
+    parser.add_argument("--lr", type=float, default=1e-2, help="Learning rate of the parity run")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repetitions per measurement")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed repetitions per measurement")
+    parser.add_argument("--output", type=str, default=None, help="JSON output file, defaults to stdout")
+    parser.add_argument("--check", action="store_true", help="Fail if the parity is outside the tolerances")
+    parser.add_argument("--max_logits_rel_error", type=float, default=1e-2, help="Tolerance of --check")
+    parser.add_argument("--min_grad_cosine", type=float, default=0.999, help="Tolerance of --check")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(3, args.vocab_size, (args.batch_size, args.seq), generator=generator)
+    labels = torch.randint(0, 2, (args.batch_size,), generator=generator)
+    batches = make_task(args)
+
+    results = []
+    outputs = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for backbone, quantize_backbone in (("float32", None), ("int8", "int8")):
+            model = build(args, quantize_backbone)
+
+            def inference():
+                with torch.no_grad():
+                    model(input_ids=input_ids)
+
+            def training_step():
+                model(input_ids=input_ids, labels=labels).loss.backward()
+                model.zero_grad()
+
+            model.eval()
+            inference_timings = time_fn(inference, repeats=args.repeats, warmup=args.warmup, device=device)
+            model.train()
+            training_timings = time_fn(training_step, repeats=args.repeats, warmup=args.warmup, device=device)
+
+            # dropout off, so that the two backbones see the same network
+            model.eval()
+            loss = model(input_ids=input_ids, labels=labels).loss
+            loss.backward()
+            grads = torch.cat([p.grad.flatten() for n, p in model.named_parameters() if "vera_lambda_" in n])
+            with torch.no_grad():
+                logits = model(input_ids=input_ids).logits
+            model.zero_grad()
+            outputs[backbone] = logits, grads
+
+            losses, accuracy = train(model, batches, args)
+            results.append(
+                {
+                    "backbone": backbone,
+                    "base_layer_bytes": base_layer_bytes(model),
+                    "inference_median_ms": inference_timings["median_ms"],
+                    "training_step_median_ms": training_timings["median_ms"],
+                    "first_loss": losses[0],
+                    "final_loss": losses[-1],
+                    "train_accuracy": accuracy,
+                }
+            )
+
+    (ref_logits, ref_grads), (logits, grads) = outputs["float32"], outputs["int8"]
+    parity = {
+        "parity": "int8 vs float32",
+        "logits_max_abs_diff": (logits - ref_logits).abs().max().item(),
+        "logits_rel_error": ((logits - ref_logits).norm() / ref_logits.norm()).item(),
+        "lambda_grad_rel_error": ((grads - ref_grads).norm() / ref_grads.norm()).item(),
+        "lambda_grad_cosine": torch.nn.functional.cosine_similarity(grads, ref_grads, dim=0).item(),
+    }
+    results.append(parity)
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    write_results(results, args.output, **config)
+
+    if args.check:
+        failures = []
+        if not parity["logits_rel_error"] <= args.max_logits_rel_error:
+            failures.append(f"logits_rel_error {parity['logits_rel_error']:.3g} > {args.max_logits_rel_error}")
+        if not parity["lambda_grad_cosine"] >= args.min_grad_cosine:
+            failures.append(f"lambda_grad_cosine {parity['lambda_grad_cosine']:.6f} < {args.min_grad_cosine}")
+        if failures:
+            raise SystemExit("int8 parity check failed: " + ", ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Microbenchmarks of the adapter layers.
+
+Measures the latency and the peak memory of forward, backward, merge, unmerge and `get_delta_weight` of
+`lora.layer.Linear`, `rsvera.layer.Linear` and `rsverac.layer.Linear` over a grid of ranks, hidden sizes, input
+shapes and dtypes, and writes the results as JSON. Run from the root of the repository:
+
+    python -m benchmarks.bench_layers --r 8,1024 --hidden 768 --shapes 8x128 --output layers.json
+"""
+import argparse
+import warnings
+from typing import Callable, Dict
+
+import torch
+import torch.nn as nn
+
+import lora.layer
+import rsvera.buffer_dict
+import rsvera.layer
+import rsverac.buffer_dict
+import rsverac.layer
+from rsverac.model import _kaiming_init
+
+from .common import DTYPES, parse_int_list, parse_shapes, peak_memory, time_fn, write_results
+
+
+ADAPTER_NAME = "default"
+OPS = ("forward", "backward", "merge", "unmerge", "get_delta_weight")
+
+
+def _vera_projections(buffer_dict_cls, hidden: int, r: int):
+    generator = torch.Generator(device="cpu").manual_seed(0)
+    vera_A = buffer_dict_cls({}, persistent=True)
+    vera_B = buffer_dict_cls({}, persistent=True)
+    vera_A[ADAPTER_NAME] = _kaiming_init((r, hidden), generator=generator)
+    vera_B[ADAPTER_NAME] = _kaiming_init((hidden, r), generator=generator)
+    return vera_A, vera_B
+
+
+def make_lora(hidden: int, r: int) -> nn.Module:
+    layer = lora.layer.Linear(nn.Linear(hidden, hidden), ADAPTER_NAME, r=r, lora_alpha=8)
+    # a freshly initialized LoRA layer has lora_B == 0, which is not representative of a trained adapter
+    nn.init.normal_(layer.lora_B[ADAPTER_NAME].weight, std=0.02)
+    return layer
+
+
+def make_rsvera(hidden: int, r: int) -> nn.Module:
+    vera_A, vera_B = _vera_projections(rsvera.buffer_dict.BufferDict, hidden, r)
+    layer = rsvera.layer.Linear(
+        nn.Linear(hidden, hidden), vera_A, vera_B, ADAPTER_NAME, r=r, vera_alpha=8, use_rsvera=True, d_initial=0.1
+    )
+    nn.init.normal_(layer.vera_lambda_b[ADAPTER_NAME], std=0.02)
+    return layer
+
+
+def make_rsverac(hidden: int, r: int) -> nn.Module:
+    vera_A, vera_B = _vera_projections(rsverac.buffer_dict.BufferDict, hidden, r)
+    layer = rsverac.layer.Linear(
+        nn.Linear(hidden, hidden),
+        vera_A,
+        vera_B,
+        ADAPTER_NAME,
+        r=r,
+        vera_alpha=8,
+        use_rsvera=True,
+        d_initial=0.1,
+        c_initial=0.1,
+        # the adapter branch is measured, not the cached weights of the `dense`/`merged` strategies
+        execution_strategy="low_rank",
+    )
+    nn.init.normal_(layer.vera_lambda_b[ADAPTER_NAME], std=0.02)
+    return layer
+
+
+LAYERS: Dict[str, Callable[[int, int], nn.Module]] = {
+    "lora": make_lora,
+    "rsvera": make_rsvera,
+    "rsverac": make_rsverac,
+}
+
+
+def _prepare(factory, hidden, r, dtype, device) -> nn.Module:
+    layer = factory(hidden, r).to(device=device, dtype=dtype)
+    layer.get_base_layer().requires_grad_(False)
+    return layer
+
+
+def bench_case(name, factory, hidden, r, batch, seq, dtype, device, repeats, warmup) -> list:
+    results = []
+    x = torch.randn(batch, seq, hidden, device=device, dtype=dtype, requires_grad=True)
+
+    for op in OPS:
+        # every op gets a fresh layer so that the ops cannot affect each other
+        layer = _prepare(factory, hidden, r, dtype, device)
+        setup = None
+
+        if op == "forward":
+            layer.eval()
+
+            def fn():
+                with torch.no_grad():
+                    layer(x)
+
+        elif op == "backward":
+            layer.train()
+            state = {}
+
+            def setup():
+                x.grad = None
+                layer.zero_grad(set_to_none=True)
+                state["loss"] = layer(x).float().sum()
+
+            def fn():
+                state["loss"].backward()
+
+        elif op == "merge":
+
+            def setup():
+                if layer.merged:
+                    layer.unmerge()
+
+            def fn():
+                layer.merge(adapter_names=[ADAPTER_NAME])
+
+        elif op == "unmerge":
+
+            def setup():
+                if not layer.merged:
+                    layer.merge(adapter_names=[ADAPTER_NAME])
+
+            def fn():
+                layer.unmerge()
+
+        else:
+
+            def fn():
+                with torch.no_grad():
+                    layer.get_delta_weight(ADAPTER_NAME)
+
+        timings = time_fn(fn, repeats=repeats, warmup=warmup, device=device, setup=setup)
+        results.append(
+            {
+                "layer": name,
+                "op": op,
+                "r": r,
+                "hidden": hidden,
+                "batch": batch,
+                "seq": seq,
+                "dtype": str(dtype).replace("torch.", ""),
+                # `None` for the layers without execution strategies and the ops without forward
+                "execution_strategy": getattr(layer, "last_execution_strategy", None),
+                **timings,
+                "peak_bytes": peak_memory(fn, device=device, setup=setup),
+            }
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layers", type=str, default="lora,rsvera,rsverac", help="Layers to benchmark")
+    parser.add_argument("--r", type=parse_int_list, default=[8, 64, 256, 1024, 4096], help="Ranks")
+    parser.add_argument("--hidden", type=parse_int_list, default=[768, 1024], help="Hidden sizes")
+    parser.add_argument("--shapes", type=parse_shapes, default=[(1, 128), (8, 128), (8, 512)], help="batch x seq")
+    parser.add_argument("--dtypes", type=str, default="float32,bfloat16", help="Dtypes of the layers and inputs")
+    parser.add_argument("--device", type=str, default="cpu", help="Device")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed repetitions per measurement")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed repetitions per measurement")
+    parser.add_argument("--output", type=str, default=None, help="JSON output file, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    layer_names = args.layers.split(",")
+    dtypes = [DTYPES[name] for name in args.dtypes.split(",")]
+
+    results = []
+    with warnings.catch_warnings():
+        # merge/unmerge warn about the (expected) merge state changes
+        warnings.simplefilter("ignore")
+        for name in layer_names:
+            for hidden in args.hidden:
+                for r in args.r:
+                    for batch, seq in args.shapes:
+                        for dtype in dtypes:
+                            results.extend(
+                                bench_case(
+                                    name,
+                                    LAYERS[name],
+                                    hidden,
+                                    r,
+                                    batch,
+                                    seq,
+                                    dtype,
+                                    device,
+                                    args.repeats,
+                                    args.warmup,
+                                )
+                            )
+
+    write_results(
+        results,
+        args.output,
+        layers=layer_names,
+        r=args.r,
+        hidden=args.hidden,
+        shapes=args.shapes,
+        dtypes=args.dtypes.split(","),
+        device=args.device,
+        repeats=args.repeats,
+        warmup=args.warmup,
+    )
+
+
+if __name__ == "__main__":
+    main()
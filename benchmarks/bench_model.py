@@ -0,0 +1,247 @@
+"""
+End-to-end benchmark of `rsverac.VeraModel`.
+
+Builds a small, randomly initialized RoBERTa model locally (no downloads), wraps it with `get_peft_model` and measures
+the time and peak memory of `_find_first_dim`, the projection init, `inject_adapter`, the first forward, the
+steady-state inference throughput, `merge_and_unload` and the safetensors checkpoint save/load. Run from the root of
+the repository:
+
+    python -m benchmarks.bench_model --hidden 768 --layers 4 --r 1024 --output model.json
+"""
+import argparse
+import contextlib
+import functools
+import os
+import tempfile
+import time
+import warnings
+from collections import defaultdict
+
+import torch
+from peft import get_peft_model
+from peft.peft_model import PEFT_TYPE_TO_MODEL_MAPPING
+from safetensors.torch import load_model, save_model
+from torch.profiler import ProfilerActivity, profile, record_function
+from transformers import RobertaConfig, RobertaForSequenceClassification
+
+import rsverac.model
+from rsverac.config import VeraConfig
+from rsverac.model import VeraModel
+
+from .common import DTYPES, memory_timeline, peak_from_timeline, peak_memory, time_fn, write_results
+
+
+PEFT_TYPE_TO_MODEL_MAPPING["VERA"] = VeraModel
+
+# the construction phases timed by wrapping the methods that implement them
+CONSTRUCTION_PHASES = {
+    "find_first_dim": (VeraModel, "_find_first_dim"),
+    "projection_init": (rsverac.model, "_kaiming_init"),
+    "inject_adapter": (VeraModel, "inject_adapter"),
+}
+
+
+@contextlib.contextmanager
+def instrument_construction(timings):
+    """Temporarily wraps the construction phases so that every call is timed and labelled for the profiler."""
+    originals = {}
+
+    def wrap(phase, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            with record_function(phase):
+                out = fn(*args, **kwargs)
+            timings[phase] += (time.perf_counter() - start) * 1e3
+            return out
+
+        return wrapper
+
+    for phase, (owner, attr) in CONSTRUCTION_PHASES.items():
+        # inherited methods (e.g. `BaseTuner.inject_adapter`) are not in `owner.__dict__`
+        originals[phase] = vars(owner).get(attr)
+        setattr(owner, attr, wrap(phase, getattr(owner, attr)))
+    try:
+        yield
+    finally:
+        for phase, (owner, attr) in CONSTRUCTION_PHASES.items():
+            if originals[phase] is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, originals[phase])
+
+
+def make_base_model(args) -> torch.nn.Module:
+    config = RobertaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+        intermediate_size=4 * args.hidden,
+        max_position_embeddings=args.seq + 2,
+        num_labels=2,
+    )
+    torch.manual_seed(0)
+    return RobertaForSequenceClassification(config)
+
+
+def make_peft_config(args) -> VeraConfig:
+    return VeraConfig(
+        task_type="SEQ_CLS",
+        r=args.r,
+        vera_alpha=8,
+        use_rsvera=True,
+        projection_prng_key=0xABC,
+        d_initial=0.1,
+        c_initial=0.1,
+        target_modules=["key", "query", "value"],
+        save_projection=True,
+    )
+
+
+def bench_construction(args):
+    """Builds the peft model `args.repeats` times, returns the per-phase timings and the peak memory of each phase."""
+    per_phase = defaultdict(list)
+    for _ in range(args.repeats):
+        base_model = make_base_model(args)
+        timings = defaultdict(float)
+        with instrument_construction(timings):
+            start = time.perf_counter()
+            get_peft_model(base_model, make_peft_config(args))
+            timings["get_peft_model"] = (time.perf_counter() - start) * 1e3
+        for phase, elapsed in timings.items():
+            per_phase[phase].append(elapsed)
+
+    # one additional, profiled construction for the memory of each phase
+    base_model = make_base_model(args)
+    with instrument_construction(defaultdict(float)):
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            get_peft_model(base_model, make_peft_config(args))
+    timeline = memory_timeline(prof)
+    peaks = defaultdict(int)
+    for event in prof.events():
+        if event.name in CONSTRUCTION_PHASES:
+            peak = peak_from_timeline(timeline, event.time_range.start, event.time_range.end)
+            peaks[event.name] = max(peaks[event.name], peak)
+    peaks["get_peft_model"] = peak_from_timeline(timeline)
+
+    results = []
+    for phase, values in per_phase.items():
+        values = sorted(values)
+        results.append(
+            {
+                "phase": phase,
+                "median_ms": values[len(values) // 2],
+                "mean_ms": sum(values) / len(values),
+                "min_ms": values[0],
+                "max_ms": values[-1],
+                "peak_bytes": peaks[phase],
+            }
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", type=int, default=768, help="Hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Number of hidden layers")
+    parser.add_argument("--heads", type=int, default=12, help="Number of attention heads")
+    parser.add_argument("--vocab_size", type=int, default=1000, help="Vocabulary size")
+    parser.add_argument("--r", type=int, default=1024, help="R value for VeraConfig")
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--seq", type=int, default=128, help="Sequence length")
+    parser.add_argument("--dtype", type=str, default="float32", help="Dtype of the model")
+    parser.add_argument("--device", type=str, default="cpu", help="Device")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repetitions per measurement")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed repetitions per measurement")
+    parser.add_argument("--output", type=str, default=None, help="JSON output file, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    dtype = DTYPES[args.dtype]
+    generator = torch.Generator().manual_seed(0)
+    inputs = {
+        "input_ids": torch.randint(3, args.vocab_size, (args.batch_size, args.seq), generator=generator).to(device),
+        "attention_mask": torch.ones(args.batch_size, args.seq, dtype=torch.long).to(device),
+    }
+
+    def build():
+        model = get_peft_model(make_base_model(args), make_peft_config(args))
+        return model.to(device=device, dtype=dtype).eval()
+
+    results = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        results.extend(bench_construction(args))
+
+        # first forward of a freshly built model, includes lazy initializations
+        first = []
+        for _ in range(args.repeats):
+            model = build()
+            start = time.perf_counter()
+            with torch.no_grad():
+                model(**inputs)
+            first.append((time.perf_counter() - start) * 1e3)
+        first.sort()
+        results.append({"phase": "first_forward", "median_ms": first[len(first) // 2], "min_ms": first[0]})
+
+        model = build()
+
+        def forward():
+            with torch.no_grad():
+                model(**inputs)
+
+        timings = time_fn(forward, repeats=args.repeats, warmup=args.warmup, device=device)
+        tokens = args.batch_size * args.seq
+        results.append(
+            {
+                "phase": "inference",
+                **timings,
+                "tokens_per_s": tokens / (timings["median_ms"] / 1e3),
+                "peak_bytes": peak_memory(forward, device=device),
+            }
+        )
+
+        state = {}
+
+        def setup_merge():
+            state["model"] = build()
+
+        def merge():
+            state["model"].merge_and_unload()
+
+        timings = time_fn(merge, repeats=args.repeats, warmup=args.warmup, device=device, setup=setup_merge)
+        results.append(
+            {"phase": "merge_and_unload", **timings, "peak_bytes": peak_memory(merge, device, setup=setup_merge)}
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "model.safetensors")
+
+            def save():
+                save_model(model, path)
+
+            def load():
+                load_model(model, path)
+
+            timings = time_fn(save, repeats=args.repeats, warmup=args.warmup, device=device)
+            results.append(
+                {
+                    "phase": "save",
+                    **timings,
+                    "peak_bytes": peak_memory(save, device),
+                    "checkpoint_bytes": os.path.getsize(path),
+                }
+            )
+            timings = time_fn(load, repeats=args.repeats, warmup=args.warmup, device=device)
+            results.append({"phase": "load", **timings, "peak_bytes": peak_memory(load, device)})
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    write_results(results, args.output, **config)
+
+
+if __name__ == "__main__":
+    main()
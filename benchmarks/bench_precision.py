@@ -0,0 +1,164 @@
+"""
+Mixed precision policy benchmark of `rsverac.VeraModel` and `lora.LoraModel` on a bfloat16 backbone.
+
+Builds the same small, randomly initialized RoBERTa model (no downloads) in bfloat16 for every tuner and
+`precision_policy` (see `utils.precision.PrecisionPolicy`), with the same float32 initial adapter weights, and reports:
+
+- the latency of an inference forward and of a training step (forward, backward, optimizer step),
+- the number of activation sized dtype casts (`aten::_to_copy`) of one inference forward,
+- the logits against the float32 adapters (`float32` policy) on the same batch,
+- the adapter layers and `ModulesToSaveWrapper`s (e.g. around the SEQ_CLS `classifier`) left by `merge_and_unload`,
+  which should be none.
+
+The policies are `float32` (float32 adapters, the activations are cast for float32 adapter GEMMs), `bfloat16` (the
+default, the adapters take the dtype of the backbone), `float32_bfloat16` (float32 adapter weights, bfloat16 GEMMs)
+and `float32_bfloat16_float32` (the same, accumulated in float32). Run from the root of the repository:
+
+    python -m benchmarks.bench_precision --hidden 768 --layers 4 --r 256 --output precision.json
+"""
+import argparse
+import dataclasses
+import warnings
+
+import torch
+from peft import get_peft_model
+from peft.peft_model import PEFT_TYPE_TO_MODEL_MAPPING
+from peft.tuners.tuners_utils import BaseTunerLayer
+from peft.utils import ModulesToSaveWrapper
+from torch.profiler import profile
+
+from lora.config import LoraConfig
+from lora.model import LoraModel
+from rsverac.model import VeraModel
+
+from .bench_model import make_base_model, make_peft_config
+from .common import time_fn, write_results
+
+
+PEFT_TYPE_TO_MODEL_MAPPING["VERA"] = VeraModel
+PEFT_TYPE_TO_MODEL_MAPPING["LORA"] = LoraModel
+
+POLICIES = {
+    "float32": {"storage_dtype": "float32"},
+    "bfloat16": None,
+    "float32_bfloat16": {"storage_dtype": "float32", "compute_dtype": "bfloat16"},
+    "float32_bfloat16_float32": {
+        "storage_dtype": "float32",
+        "compute_dtype": "bfloat16",
+        "accumulate_dtype": "float32",
+    },
+}
+
+
+def build(args, tuner, policy):
+    target_modules = args.target_modules.split(",")
+    if tuner == "vera":
+        config = dataclasses.replace(
+            make_peft_config(args), target_modules=target_modules, precision_policy=policy
+        )
+    else:
+        config = LoraConfig(
+            task_type="SEQ_CLS", r=args.lora_r, target_modules=target_modules, precision_policy=policy
+        )
+    model = get_peft_model(make_base_model(args).to(torch.bfloat16), config)
+    # the same non-trivial float32 adapter weights for all the policies, rounded to their storage dtype
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if param.requires_grad:
+                param.copy_(param.float() + 0.1 * torch.randn(param.shape, generator=generator))
+    return model
+
+
+def activation_casts(model, input_ids) -> int:
+    """The dtype casts of tensors with the batch and sequence dimensions in one inference forward."""
+    with torch.no_grad(), profile(record_shapes=True) as prof:
+        model(input_ids=input_ids)
+    return sum(
+        1
+        for event in prof.events()
+        if event.name == "aten::_to_copy" and event.input_shapes and len(event.input_shapes[0]) >= 3
+    )
+
+
+def leftover_modules(model) -> int:
+    """The adapter layers and `ModulesToSaveWrapper`s of a model returned by `merge_and_unload`."""
+    return sum(isinstance(module, (BaseTunerLayer, ModulesToSaveWrapper)) for module in model.modules())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", type=int, default=768, help="Hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Number of hidden layers")
+    parser.add_argument("--heads", type=int, default=12, help="Number of attention heads")
+    parser.add_argument("--vocab_size", type=int, default=1000, help="Vocabulary size")
+    parser.add_argument("--r", type=int, default=256, help="R value for VeraConfig")
+    parser.add_argument("--lora_r", type=int, default=16, help="R value for LoraConfig")
+    parser.add_argument("--target_modules", type=str, default="query,key,value", help="Comma separated targets")
+    parser.add_argument("--tuners", type=str, default="vera,lora", help="Comma separated tuners among vera, lora")
+    parser.add_argument(
+        "--policies", type=str, default=",".join(POLICIES), help=f"Comma separated policies among {list(POLICIES)}"
+    )
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--seq", type=int, default=128, help="Sequence length")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repetitions per measurement")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed repetitions per measurement")
+    parser.add_argument("--output", type=str, default=None, help="JSON output file, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(3, args.vocab_size, (args.batch_size, args.seq), generator=generator)
+    labels = torch.randint(0, 2, (args.batch_size,), generator=generator)
+
+    results = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for tuner in args.tuners.split(","):
+            reference = None
+            for name in args.policies.split(","):
+                model = build(args, tuner, POLICIES[name])
+                optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+
+                def inference():
+                    with torch.no_grad():
+                        model(input_ids=input_ids)
+
+                def training_step():
+                    model(input_ids=input_ids, labels=labels).loss.backward()
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+                # dropout off, so that the policies see the same network
+                model.eval()
+                with torch.no_grad():
+                    logits = model(input_ids=input_ids).logits.float()
+                # the first policy, float32 by default, is the reference
+                if reference is None:
+                    reference = logits
+                casts = activation_casts(model, input_ids)
+                inference_timings = time_fn(inference, repeats=args.repeats, warmup=args.warmup, device=device)
+                training_timings = time_fn(training_step, repeats=args.repeats, warmup=args.warmup, device=device)
+                unloaded = leftover_modules(model.merge_and_unload())
+                results.append(
+                    {
+                        "tuner": tuner,
+                        "policy": name,
+                        "activation_casts": casts,
+                        "inference_median_ms": inference_timings["median_ms"],
+                        "training_step_median_ms": training_timings["median_ms"],
+                        "logits_max_abs_diff": (logits - reference).abs().max().item(),
+                        "logits_rel_error": ((logits - reference).norm() / reference.norm()).item(),
+                        "unload_leftover_modules": unloaded,
+                    }
+                )
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    write_results(results, args.output, **config)
+
+
+if __name__ == "__main__":
+    main()
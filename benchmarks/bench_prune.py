@@ -0,0 +1,131 @@
+"""
+Rank pruning benchmark of `rsverac.VeraModel`, the accuracy/speed trade-off of `VeraModel.prune_ranks`.
+
+Builds a small, randomly initialized RoBERTa model (no downloads) with lambdas standing in for trained ones: the
+`vera_lambda_d` magnitudes are spread log-uniformly over `--decades` orders of magnitude, so that many of them are
+near zero. For every threshold, a copy of the model is pruned and compared with the unpruned one on the same batch:
+
+- the total kept rank, and the largest relative Frobenius error of the delta weight of a layer,
+- the latency of an inference forward and the part of it spent in the adapters (against the adapters disabled),
+- the logits error and the agreement of the predicted classes,
+- the bytes of the gathered sub-projections owned by the pruned layers.
+
+The layers run the `low_rank` strategy, the cost of which is proportional to the rank. Run from the root of the
+repository:
+
+    python -m benchmarks.bench_prune --hidden 768 --layers 4 --r 1024 --output prune.json
+"""
+import argparse
+import copy
+import dataclasses
+import warnings
+
+import torch
+from peft import get_peft_model
+from peft.peft_model import PEFT_TYPE_TO_MODEL_MAPPING
+
+from rsverac.layer import Linear
+from rsverac.model import VeraModel
+
+from .bench_model import make_base_model, make_peft_config
+from .common import time_fn, write_results
+
+
+PEFT_TYPE_TO_MODEL_MAPPING["VERA"] = VeraModel
+
+
+def build(args):
+    config = dataclasses.replace(
+        make_peft_config(args), target_modules=args.target_modules.split(","), execution_strategy="low_rank"
+    )
+    model = get_peft_model(make_base_model(args), config)
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if "vera_lambda_d" in name:
+                signs = torch.randint(0, 2, param.shape, generator=generator) * 2 - 1
+                exponents = -args.decades * torch.rand(param.shape, generator=generator)
+                param.copy_(signs * 10**exponents)
+            elif param.requires_grad:
+                param.copy_(param + 0.1 * torch.randn(param.shape, generator=generator))
+    return model.eval()
+
+
+def pruned_projection_bytes(model) -> int:
+    buffers = [
+        buffer
+        for module in model.modules()
+        if isinstance(module, Linear)
+        for buffer in [*module.pruned_vera_A.buffers(), *module.pruned_vera_B.buffers()]
+    ]
+    return sum(buffer.numel() * buffer.element_size() for buffer in buffers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", type=int, default=768, help="Hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Number of hidden layers")
+    parser.add_argument("--heads", type=int, default=12, help="Number of attention heads")
+    parser.add_argument("--vocab_size", type=int, default=1000, help="Vocabulary size")
+    parser.add_argument("--r", type=int, default=1024, help="R value for VeraConfig")
+    parser.add_argument("--target_modules", type=str, default="query,key,value", help="Comma separated targets")
+    parser.add_argument("--decades", type=float, default=4.0, help="Orders of magnitude spanned by lambda_d")
+    parser.add_argument(
+        "--thresholds", type=str, default="0,0.001,0.01,0.05,0.1,0.2,0.5", help="Comma separated pruning thresholds"
+    )
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--seq", type=int, default=128, help="Sequence length")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repetitions per measurement")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed repetitions per measurement")
+    parser.add_argument("--output", type=str, default=None, help="JSON output file, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(3, args.vocab_size, (args.batch_size, args.seq), generator=generator)
+    num_tokens = args.batch_size * args.seq
+
+    results = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        reference = build(args)
+
+        def inference(model):
+            with torch.no_grad():
+                return model(input_ids=input_ids).logits
+
+        with reference.disable_adapter():
+            base_timings = time_fn(lambda: inference(reference), args.repeats, args.warmup, device)
+        reference_logits = inference(reference)
+
+        for threshold in (float(t) for t in args.thresholds.split(",")):
+            model = copy.deepcopy(reference)
+            report = model.base_model.prune_ranks(threshold)
+            logits = inference(model)
+            timings = time_fn(lambda: inference(model), args.repeats, args.warmup, device)
+            adapter_ms = timings["median_ms"] - base_timings["median_ms"]
+            results.append(
+                {
+                    "threshold": threshold,
+                    "rank": report["rank"],
+                    "kept_rank": report["kept_rank"],
+                    "max_delta_rel_error": max(layer["delta_rel_error"] for layer in report["layers"].values()),
+                    "inference_median_ms": timings["median_ms"],
+                    "adapter_median_ms": adapter_ms,
+                    "tokens_per_s": num_tokens / timings["median_ms"] * 1e3,
+                    "logits_max_abs_diff": (logits - reference_logits).abs().max().item(),
+                    "logits_rel_error": ((logits - reference_logits).norm() / reference_logits.norm()).item(),
+                    "prediction_agreement": (logits.argmax(-1) == reference_logits.argmax(-1)).float().mean().item(),
+                    "pruned_projection_bytes": pruned_projection_bytes(model),
+                }
+            )
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    write_results(results, args.output, base_inference_median_ms=base_timings["median_ms"], **config)
+
+
+if __name__ == "__main__":
+    main()
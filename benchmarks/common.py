@@ -0,0 +1,132 @@
+import json
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+
+DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_shapes(value: str) -> List[tuple]:
+    """Parses `"8x128,32x512"` into `[(8, 128), (32, 512)]`."""
+    return [tuple(int(d) for d in shape.split("x")) for shape in value.split(",") if shape]
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(
+    fn: Callable[[], None],
+    repeats: int,
+    warmup: int,
+    device: torch.device,
+    setup: Optional[Callable[[], None]] = None,
+) -> Dict[str, float]:
+    """
+    Times `fn` and returns the median, mean, min and max latency in milliseconds.
+
+    `setup` is called before every call of `fn` and is not timed.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        _synchronize(device)
+        start = time.perf_counter()
+        fn()
+        _synchronize(device)
+        timings.append((time.perf_counter() - start) * 1e3)
+
+    return {
+        "median_ms": statistics.median(timings),
+        "mean_ms": statistics.fmean(timings),
+        "min_ms": min(timings),
+        "max_ms": max(timings),
+    }
+
+
+def peak_memory(fn: Callable[[], None], device: torch.device, setup: Optional[Callable[[], None]] = None) -> int:
+    """
+    Returns the peak number of bytes allocated by torch while running `fn` once, relative to the start of the call.
+
+    On CUDA this uses the allocator statistics. On CPU, where torch keeps no such statistics, the allocations and
+    frees recorded by the profiler are replayed in order.
+    """
+    if setup is not None:
+        setup()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return peak_from_timeline(memory_timeline(prof))
+
+
+def memory_timeline(prof) -> List[tuple]:
+    """Returns the `(start time, bytes)` allocations (positive) and frees (negative) recorded by a CPU profiler."""
+    # op events carry the memory they allocated themselves, allocations outside of any op are `[memory]` events
+    timeline = []
+    for event in prof.events():
+        usage = event.cpu_memory_usage if event.name == "[memory]" else event.self_cpu_memory_usage
+        if usage:
+            timeline.append((event.time_range.start, usage))
+    timeline.sort(key=lambda item: item[0])
+    return timeline
+
+
+def peak_from_timeline(timeline: List[tuple], start: float = float("-inf"), end: float = float("inf")) -> int:
+    """Peak of the running sum of the allocations of `timeline` between `start` and `end`."""
+    current = peak = 0
+    for time_us, usage in timeline:
+        if start <= time_us <= end:
+            current += usage
+            peak = max(peak, current)
+    return peak
+
+
+def environment() -> Dict[str, object]:
+    return {
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def write_results(results: List[Dict[str, object]], output: Optional[str], **metadata) -> None:
+    """Writes the results as JSON to `output`, or to stdout if `output` is `None`."""
+    payload = {"environment": environment(), "config": metadata, "results": results}
+    if output is None:
+        json.dump(payload, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as f:
+            json.dump(payload, f, indent=2)
@@ -21,6 +21,8 @@ from typing import List, Literal, Optional, Union
 from peft.config import PeftConfig
 from peft.utils import PeftType
 
+from utils.precision import PrecisionPolicy
+
 
 @dataclass
 class LoftQConfig:
@@ -102,6 +104,12 @@ class LoraConfig(PeftConfig):
             The configuration of LoftQ. If this is not None, then LoftQ will be used to quantize the backbone weights
             and initialize Lora layers. Also pass `init_lora_weights='loftq'`. Note that you should not pass a
             quantized model in this case, as LoftQ will quantize the model itself.
+        precision_policy (`Optional[dict]`):
+            Dtypes of the adapter, by name (`float32`, `float16`, `bfloat16`): `storage_dtype` for the `lora_A` and
+            `lora_B` weights, `compute_dtype` for the adapter GEMMs and `accumulate_dtype` for the sum of the adapter
+            and base outputs, see [`~utils.precision.PrecisionPolicy`]. The missing ones keep the default, the dtype
+            of the base layers. E.g. float32 weights with a bfloat16 compute dtype on a bfloat16 backbone: the small
+            adapter weights are cast for the GEMMs instead of the activations.
     """
 
     r: int = field(default=8, metadata={"help": "Lora attention dimension"})
@@ -225,9 +233,19 @@ class LoraConfig(PeftConfig):
             )
         },
     )
+    precision_policy: Optional[dict] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Dtypes of the adapter, e.g. {'storage_dtype': 'float32', 'compute_dtype': 'bfloat16',"
+                " 'accumulate_dtype': 'float32'}, the missing ones being the dtype of the base layers."
+            )
+        },
+    )
 
     def __post_init__(self):
         self.peft_type = PeftType.LORA
+        PrecisionPolicy.from_dict(self.precision_policy)
         self.target_modules = (
             set(self.target_modules) if isinstance(self.target_modules, list) else self.target_modules
         )
@@ -24,6 +24,7 @@ from transformers.pytorch_utils import Conv1D
 
 from peft.tuners.tuners_utils import BaseTunerLayer
 from peft.utils.other import transpose
+from utils.precision import PrecisionPolicy
 
 from .config import LoraConfig
 
@@ -48,6 +49,8 @@ class LoraLayer(BaseTunerLayer):
         # Mark the weight as unmerged
         self._disable_adapters = False
         self.merged_adapters = []
+        # the `PrecisionPolicy` of every adapter, see `set_precision_policy`
+        self.precision_policy = {}
         self.kwargs = kwargs
 
         base_layer = self.get_base_layer()
@@ -178,6 +181,32 @@ class LoraLayer(BaseTunerLayer):
             else:
                 self.scaling[active_adapter] /= scale
 
+    def set_precision_policy(self, adapter: str, policy: PrecisionPolicy) -> None:
+        """
+        Sets the precision policy of `adapter` and casts its weights to the storage dtype, see
+        `LoraConfig.precision_policy`.
+        """
+        self.precision_policy[adapter] = policy
+        if policy.storage_dtype is None:
+            return
+        for name in self.adapter_layer_names:
+            weights = getattr(self, name)
+            if adapter not in weights:
+                continue
+            if isinstance(weights[adapter], nn.Module):
+                weights[adapter].to(policy.storage_dtype)
+            else:
+                weights[adapter].data = weights[adapter].data.to(policy.storage_dtype)
+
+    def _compute_dtype(self, adapter: str, storage_dtype: torch.dtype) -> torch.dtype:
+        # the dtype of the adapter GEMMs, the one of the adapter weights by default
+        policy = self.precision_policy.get(adapter)
+        return storage_dtype if policy is None else policy.compute(storage_dtype)
+
+    def _accumulate_dtype(self, adapter: str) -> Optional[torch.dtype]:
+        policy = self.precision_policy.get(adapter)
+        return None if policy is None else policy.accumulate_dtype
+
 
 # Below code is based on https://github.com/microsoft/LoRA/blob/main/loralib/layers.py
 # and modified to work with PyTorch FSDP
@@ -317,8 +346,14 @@ class Linear(nn.Module, LoraLayer):
                 lora_B = self.lora_B[active_adapter]
                 dropout = self.lora_dropout[active_adapter]
                 scaling = self.scaling[active_adapter]
-                x = x.to(lora_A.weight.dtype)
-                result += lora_B(lora_A(dropout(x))) * scaling
+                accumulate_dtype = self._accumulate_dtype(active_adapter)
+                if accumulate_dtype is not None:
+                    result = result.to(accumulate_dtype)
+                # the input is only cast when it is not in the compute dtype, the weights are cast to it instead
+                dtype = self._compute_dtype(active_adapter, lora_A.weight.dtype)
+                x = x.to(dtype)
+                after_A = F.linear(dropout(x), lora_A.weight.to(dtype))
+                result += F.linear(after_A, lora_B.weight.to(dtype)) * scaling
 
         result = result.to(previous_dtype)
         return result
@@ -490,14 +525,21 @@ class Embedding(nn.Module, LoraLayer):
             result = self.base_layer(x, *args, **kwargs)
         else:
             result = self.base_layer(x, *args, **kwargs)
+            # the embeddings keep the dtype of the base layer, whatever the accumulate dtype
+            previous_dtype = result.dtype
             for active_adapter in self.active_adapters:
                 if active_adapter not in self.lora_embedding_A:
                     continue
-                embedding_A = self.lora_embedding_A[active_adapter].T
-                embedding_B = self.lora_embedding_B[active_adapter].T
+                accumulate_dtype = self._accumulate_dtype(active_adapter)
+                if accumulate_dtype is not None:
+                    result = result.to(accumulate_dtype)
+                dtype = self._compute_dtype(active_adapter, self.lora_embedding_A[active_adapter].dtype)
+                embedding_A = self.lora_embedding_A[active_adapter].T.to(dtype)
+                embedding_B = self.lora_embedding_B[active_adapter].T.to(dtype)
                 scaling = self.scaling[active_adapter]
                 after_A = self._embed(x, embedding_A)
                 result += (after_A @ embedding_B) * scaling
+            result = result.to(previous_dtype)
 
         return result
 
@@ -678,8 +720,14 @@ class Conv2d(nn.Module, LoraLayer):
                 lora_B = self.lora_B[active_adapter]
                 dropout = self.lora_dropout[active_adapter]
                 scaling = self.scaling[active_adapter]
-                x = x.to(lora_A.weight.dtype)
-                result += lora_B(lora_A(dropout(x))) * scaling
+                accumulate_dtype = self._accumulate_dtype(active_adapter)
+                if accumulate_dtype is not None:
+                    result = result.to(accumulate_dtype)
+                # as in `Linear`, the weights rather than the input are cast to the compute dtype
+                dtype = self._compute_dtype(active_adapter, lora_A.weight.dtype)
+                x = x.to(dtype)
+                after_A = lora_A._conv_forward(dropout(x), lora_A.weight.to(dtype), None)
+                result += lora_B._conv_forward(after_A, lora_B.weight.to(dtype), None) * scaling
 
         result = result.to(previous_dtype)
         return result
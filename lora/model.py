@@ -22,7 +22,7 @@ from dataclasses import asdict, replace
 from enum import Enum
 from functools import reduce
 from itertools import chain
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 import torch
 from torch import nn
@@ -38,13 +38,20 @@ from peft.utils import (
     get_quantization_config,
 )
 
+from utils.parallel import parallel_map
+from utils.precision import PrecisionPolicy
+from utils.profiler import ProfilingMixin
+from utils.registry import TunerLayerRegistry
+from utils.target_index import TargetModuleIndex, config_signature, module_keys
+
 from .config import LoraConfig
 from .gptq import dispatch_gptq
 from .layer import Conv2d, LoraLayer, dispatch_default
+from .svd_utils import randomized_svd_from_factors, streaming_quantile, truncated_svd_from_factors
 from .tp_layer import dispatch_megatron
 
 
-class LoraModel(BaseTuner):
+class LoraModel(ProfilingMixin, BaseTuner):
     """
     Creates Low Rank Adapter (LoRA) model from a pretrained transformers model.
 
@@ -127,6 +134,58 @@ class LoraModel(BaseTuner):
     def _check_target_module_exists(lora_config, key):
         return check_target_module_exists(lora_config, key)
 
+    def _get_layer_registry(self) -> TunerLayerRegistry:
+        """The LoRA layers and `ModulesToSaveWrapper`s of the model, recorded when they are injected."""
+        if getattr(self, "_layer_registry", None) is None:
+            self._layer_registry = TunerLayerRegistry()
+        return self._layer_registry
+
+    def _get_target_index(self, lora_config) -> TargetModuleIndex:
+        """
+        Returns the targets and `modules_to_save` of `lora_config`. The index is cached per config signature, and the
+        module keys of the model are listed once per injection, as injecting adapters does not change them.
+        """
+        if getattr(self, "_target_indexes", None) is None:
+            self._target_indexes = {}
+            self._module_keys = module_keys(self.model)
+        signature = config_signature(lora_config, "r", "lora_alpha")
+        if signature not in self._target_indexes:
+            self._target_indexes[signature] = TargetModuleIndex(
+                self._module_keys, lora_config, lora_config.r, lora_config.lora_alpha
+            )
+        return self._target_indexes[signature]
+
+    def _register_modules_to_save(self) -> None:
+        # `PeftModel` wraps the `modules_to_save` of the task (e.g. the SEQ_CLS `classifier`) after the injection and
+        # adds them to the config, their keys are resolved by the cached target indexes whenever the configs change
+        signature = tuple(config_signature(config, "r", "lora_alpha") for config in self.peft_config.values())
+
+        def keys():
+            indexes = [self._get_target_index(config) for config in self.peft_config.values()]
+            return [key for index in indexes for key in index.modules_to_save]
+
+        self._get_layer_registry().register_modules_to_save(self.model, keys, signature)
+
+    def inject_adapter(self, model: nn.Module, adapter_name: str) -> None:
+        super().inject_adapter(model, adapter_name)
+        # modules may have been added to the model since the last injection, the module keys are listed again
+        self._target_indexes = None
+        # the wrappers are created by `BaseTuner.inject_adapter`, which does not report them
+        self._register_modules_to_save()
+        # the layers of the new adapter cast all the adapters to the dtype of the base layers
+        self._apply_precision_policies()
+
+    def _apply_precision_policies(self) -> None:
+        """
+        Applies the `precision_policy` of every adapter to its layers, see [`~utils.precision.PrecisionPolicy`].
+        """
+        layers = self._get_layer_registry().modules(LoraLayer)
+        for adapter, config in self.peft_config.items():
+            policy = PrecisionPolicy.from_dict(getattr(config, "precision_policy", None))
+            for layer in layers:
+                if adapter in layer.r:
+                    layer.set_precision_policy(adapter, policy)
+
     def _create_and_replace(
         self,
         lora_config,
@@ -178,6 +237,7 @@ class LoraModel(BaseTuner):
                 # adding an additional adapter: it is not automatically trainable
                 new_module.requires_grad_(False)
             self._replace_module(parent, target_name, new_module, target)
+        self._get_layer_registry().register(current_key, getattr(parent, target_name))
 
     def _replace_module(self, parent, child_name, new_module, child):
         setattr(parent, child_name, new_module)
@@ -278,9 +338,9 @@ class LoraModel(BaseTuner):
         return config
 
     def _set_adapter_layers(self, enabled: bool = True) -> None:
-        for module in self.model.modules():
-            if isinstance(module, (BaseTunerLayer, ModulesToSaveWrapper)):
-                module.enable_adapters(enabled)
+        self._register_modules_to_save()
+        for module in self._get_layer_registry().modules((BaseTunerLayer, ModulesToSaveWrapper)):
+            module.enable_adapters(enabled)
 
     def enable_adapter_layers(self) -> None:
         """Enable all adapters.
@@ -310,12 +370,11 @@ class LoraModel(BaseTuner):
         Args:
             adapter_name (`str` or `list[str]`): Name of the adapter(s) to be activated.
         """
-        for module in self.model.modules():
-            if isinstance(module, LoraLayer):
-                if module.merged:
-                    warnings.warn("Adapter cannot be set when the model is merged. Unmerging the model first.")
-                    module.unmerge()
-                module.set_adapter(adapter_name)
+        for module in self._get_layer_registry().modules(LoraLayer):
+            if module.merged:
+                warnings.warn("Adapter cannot be set when the model is merged. Unmerging the model first.")
+                module.unmerge()
+            module.set_adapter(adapter_name)
         self.active_adapter = adapter_name
 
     @staticmethod
@@ -334,26 +393,35 @@ class LoraModel(BaseTuner):
         progressbar: bool = False,
         safe_merge: bool = False,
         adapter_names: Optional[List[str]] = None,
+        num_workers: int = 1,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
     ):
+        # the base layers are handed back to the user, they must not keep the profiling hooks
+        self.disable_profiling()
+        self._register_modules_to_save()
         if merge:
             if getattr(self.model, "quantization_method", None) == "gptq":
                 raise ValueError("Cannot merge LORA layers when the model is gptq quantized")
 
-        key_list = [key for key, _ in self.model.named_modules() if self.prefix not in key]
+            # every layer only updates its own base weight, so the layers can be merged concurrently
+            def merge_layer(target):
+                with onload_layer(target):
+                    target.merge(safe_merge=safe_merge, adapter_names=adapter_names)
+
+            targets = self._get_layer_registry().modules(LoraLayer)
+            parallel_map(merge_layer, targets, num_workers=num_workers, progress_callback=progress_callback)
+
+        registry = self._get_layer_registry()
         desc = "Unloading " + ("and merging " if merge else "") + "model"
-        for key in tqdm(key_list, disable=not progressbar, desc=desc):
-            try:
-                parent, target, target_name = _get_submodules(self.model, key)
-            except AttributeError:
-                continue
+        for key, target in tqdm(registry.items(), disable=not progressbar, desc=desc):
+            parent, _, target_name = _get_submodules(self.model, key)
             with onload_layer(target):
                 if hasattr(target, "base_layer"):
-                    if merge:
-                        target.merge(safe_merge=safe_merge, adapter_names=adapter_names)
                     self._replace_module(parent, target_name, target.get_base_layer(), target)
                 elif isinstance(target, ModulesToSaveWrapper):
                     # save any additional trainable modules part of `modules_to_save`
                     setattr(parent, target_name, target.modules_to_save[target.active_adapter])
+        registry.clear()
 
         return self.model
 
@@ -367,6 +435,10 @@ class LoraModel(BaseTuner):
         svd_clamp=None,
         svd_full_matrices=True,
         svd_driver=None,
+        svd_method="full",
+        svd_oversample=10,
+        svd_niter=2,
+        svd_quantile_bins=4096,
     ) -> None:
         """
         This method adds a new adapter by merging the given adapters with the given weights.
@@ -398,6 +470,22 @@ class LoraModel(BaseTuner):
                 Name of the cuSOLVER method to be used. This keyword argument only works when merging on CUDA. Can be
                 one of [None, `gesvd`, `gesvdj`, `gesvda`]. For more info please refer to `torch.linalg.svd`
                 documentation. Defaults to None.
+            svd_method (`str`, *optional*):
+                How the `svd` combination is computed. Can be one of [`full`, `truncated`, `randomized`]. `full`
+                builds the combined delta weight and decomposes it with `torch.linalg.svd`. `truncated` and
+                `randomized` work directly on the stacked LoRA factors and never form the `(out, in)` delta weight:
+                `truncated` is exact and costs `O((out + in) * R^2)` for a stacked rank `R`, `randomized` sketches the
+                range of the delta weight and is cheaper when `R` is much larger than `svd_rank`. With these two
+                methods, `svd_clamp` uses an approximate, streaming quantile. Defaults to `full`.
+            svd_oversample (`int`, *optional*):
+                Number of additional random vectors used by the `randomized` method. Higher is more accurate. Defaults
+                to 10.
+            svd_niter (`int`, *optional*):
+                Number of power iterations of the `randomized` method. Higher is more accurate. Defaults to 2.
+            svd_quantile_bins (`int`, *optional*):
+                Number of histogram bins of the approximate quantile used for `svd_clamp` by the `truncated` and
+                `randomized` methods. The quantile is accurate up to `(max - min) / svd_quantile_bins`. Defaults to
+                4096.
         """
 
         if adapter_name in list(self.peft_config.keys()):
@@ -406,6 +494,9 @@ class LoraModel(BaseTuner):
             if adapter not in list(self.peft_config.keys()):
                 raise ValueError(f"Adapter {adapter} does not exist")
 
+        if svd_method not in ("full", "truncated", "randomized"):
+            raise ValueError(f"Invalid svd_method: {svd_method}")
+
         # if there is only one adapter, we can only use linear merging
         combination_type = "linear" if len(adapters) == 1 else combination_type
 
@@ -454,65 +545,66 @@ class LoraModel(BaseTuner):
         # Do we really need that?
         _freeze_adapter(self.model, adapter_name)
 
-        key_list = [key for key, _ in self.model.named_modules() if self.prefix not in key]
-        for key in key_list:
-            _, target, _ = _get_submodules(self.model, key)
-            if isinstance(target, LoraLayer):
-                if adapter_name in target.lora_A:
-                    target_lora_A = target.lora_A[adapter_name].weight
-                    target_lora_B = target.lora_B[adapter_name].weight
-                elif adapter_name in target.lora_embedding_A:
-                    target_lora_A = target.lora_embedding_A[adapter_name]
-                    target_lora_B = target.lora_embedding_B[adapter_name]
-                else:
-                    continue
-
-                target_lora_A.data = target_lora_A.data * 0.0
-                target_lora_B.data = target_lora_B.data * 0.0
-                if combination_type == "linear":
-                    for adapter, weight in zip(adapters, weights):
-                        if adapter in target.lora_A:
-                            current_adapter_lora_A = target.lora_A[adapter].weight
-                            current_adapter_lora_B = target.lora_B[adapter].weight
-                        elif adapter in target.lora_embedding_A:
-                            current_adapter_lora_A = target.lora_embedding_A[adapter]
-                            current_adapter_lora_B = target.lora_embedding_B[adapter]
-                        else:
-                            continue
-                        target_lora_A.data += current_adapter_lora_A.data * math.sqrt(weight) * target.scaling[adapter]
-                        target_lora_B.data += current_adapter_lora_B.data * math.sqrt(weight)
-                elif combination_type == "cat":
-                    loras_A, loras_B = [], []
-                    for adapter, weight in zip(adapters, weights):
-                        if adapter in target.lora_A:
-                            current_adapter_lora_A = target.lora_A[adapter].weight
-                            current_adapter_lora_B = target.lora_B[adapter].weight
-                        elif adapter in target.lora_embedding_A:
-                            current_adapter_lora_A = target.lora_embedding_A[adapter]
-                            current_adapter_lora_B = target.lora_embedding_B[adapter]
-                        else:
-                            continue
-                        loras_A.append(current_adapter_lora_A.data * weight * target.scaling[adapter])
-                        loras_B.append(current_adapter_lora_B.data)
-
-                    if len(loras_A) == 0:
-                        raise ValueError("No matching LoRAs found. Please raise an issue on Github.")
-                    loras_A = torch.cat(loras_A, dim=0)
-                    loras_B = torch.cat(loras_B, dim=1)
-                    target_lora_A.data[: loras_A.shape[0], :] = loras_A
-                    target_lora_B.data[:, : loras_B.shape[1]] = loras_B
-                elif combination_type == "svd":
-                    target_lora_A.data, target_lora_B.data = self._svd_weighted_adapter(
-                        adapters,
-                        weights,
-                        new_rank,
-                        target,
-                        target_lora_A,
-                        target_lora_B,
-                        svd_clamp,
-                        full_matrices=svd_full_matrices,
-                        driver=svd_driver,
-                    )
+        for target in self._get_layer_registry().modules(LoraLayer):
+            if adapter_name in target.lora_A:
+                target_lora_A = target.lora_A[adapter_name].weight
+                target_lora_B = target.lora_B[adapter_name].weight
+            elif adapter_name in target.lora_embedding_A:
+                target_lora_A = target.lora_embedding_A[adapter_name]
+                target_lora_B = target.lora_embedding_B[adapter_name]
+            else:
+                continue
+
+            target_lora_A.data = target_lora_A.data * 0.0
+            target_lora_B.data = target_lora_B.data * 0.0
+            if combination_type == "linear":
+                for adapter, weight in zip(adapters, weights):
+                    if adapter in target.lora_A:
+                        current_adapter_lora_A = target.lora_A[adapter].weight
+                        current_adapter_lora_B = target.lora_B[adapter].weight
+                    elif adapter in target.lora_embedding_A:
+                        current_adapter_lora_A = target.lora_embedding_A[adapter]
+                        current_adapter_lora_B = target.lora_embedding_B[adapter]
+                    else:
+                        continue
+                    target_lora_A.data += current_adapter_lora_A.data * math.sqrt(weight) * target.scaling[adapter]
+                    target_lora_B.data += current_adapter_lora_B.data * math.sqrt(weight)
+            elif combination_type == "cat":
+                loras_A, loras_B = [], []
+                for adapter, weight in zip(adapters, weights):
+                    if adapter in target.lora_A:
+                        current_adapter_lora_A = target.lora_A[adapter].weight
+                        current_adapter_lora_B = target.lora_B[adapter].weight
+                    elif adapter in target.lora_embedding_A:
+                        current_adapter_lora_A = target.lora_embedding_A[adapter]
+                        current_adapter_lora_B = target.lora_embedding_B[adapter]
+                    else:
+                        continue
+                    loras_A.append(current_adapter_lora_A.data * weight * target.scaling[adapter])
+                    loras_B.append(current_adapter_lora_B.data)
+
+                if len(loras_A) == 0:
+                    raise ValueError("No matching LoRAs found. Please raise an issue on Github.")
+                loras_A = torch.cat(loras_A, dim=0)
+                loras_B = torch.cat(loras_B, dim=1)
+                target_lora_A.data[: loras_A.shape[0], :] = loras_A
+                target_lora_B.data[:, : loras_B.shape[1]] = loras_B
+            elif combination_type == "svd":
+                target_lora_A.data, target_lora_B.data = self._svd_weighted_adapter(
+                    adapters,
+                    weights,
+                    new_rank,
+                    target,
+                    target_lora_A,
+                    target_lora_B,
+                    svd_clamp,
+                    full_matrices=svd_full_matrices,
+                    driver=svd_driver,
+                    method=svd_method,
+                    oversample=svd_oversample,
+                    niter=svd_niter,
+                    quantile_bins=svd_quantile_bins,
+                )
 
     def _svd_weighted_adapter(
         self,
@@ -525,6 +617,10 @@ class LoraModel(BaseTuner):
         clamp=None,
         full_matrices=True,
         driver=None,
+        method="full",
+        oversample=10,
+        niter=2,
+        quantile_bins=4096,
     ):
         valid_adapters = []
         valid_weights = []
@@ -537,6 +633,21 @@ class LoraModel(BaseTuner):
         if len(valid_adapters) == 0:
             raise ValueError("No matching LoRAs found. Please raise an issue on Github.")
 
+        if method != "full":
+            return self._svd_weighted_adapter_from_factors(
+                valid_adapters,
+                valid_weights,
+                new_rank,
+                target,
+                target_lora_A,
+                target_lora_B,
+                clamp=clamp,
+                method=method,
+                oversample=oversample,
+                niter=niter,
+                quantile_bins=quantile_bins,
+            )
+
         delta_weight = valid_weights[0] * target.get_delta_weight(valid_adapters[0])
         for adapter, weight in zip(valid_adapters[1:], valid_weights[1:]):
             delta_weight += weight * target.get_delta_weight(adapter)
@@ -567,6 +678,65 @@ class LoraModel(BaseTuner):
             Vh = Vh.reshape(target_lora_A.data.shape)
         return Vh, U
 
+    def _svd_weighted_adapter_from_factors(
+        self,
+        adapters,
+        weights,
+        new_rank,
+        target,
+        target_lora_A,
+        target_lora_B,
+        clamp=None,
+        method="truncated",
+        oversample=10,
+        niter=2,
+        quantile_bins=4096,
+    ):
+        # The combined delta weight is sum_i weight_i * scaling_i * B_i @ A_i = B_cat @ A_cat, with the B_i stacked
+        # along the rank dimension. The decomposition works on these stacked factors only. Conv2d factors are
+        # flattened to (out, r) and (r, in * kh * kw), and `B @ A` is already in (out, in) layout for fan_in_fan_out
+        # and embedding layers, so no transposes are needed.
+        loras_A, loras_B = [], []
+        for adapter, weight in zip(adapters, weights):
+            if adapter in target.lora_A:
+                lora_A = target.lora_A[adapter].weight
+                lora_B = target.lora_B[adapter].weight
+            else:
+                lora_A = target.lora_embedding_A[adapter]
+                lora_B = target.lora_embedding_B[adapter]
+            loras_A.append(lora_A.detach().flatten(start_dim=1))
+            loras_B.append(lora_B.detach().flatten(start_dim=1) * (weight * target.scaling[adapter]))
+
+        dtype = target_lora_A.dtype
+        # half precision QR/SVD is not supported on all devices, always decompose in float32
+        compute_dtype = torch.float32 if dtype in (torch.float16, torch.bfloat16) else dtype
+        B = torch.cat(loras_B, dim=1).to(compute_dtype)
+        A = torch.cat(loras_A, dim=0).to(compute_dtype)
+
+        if method == "randomized":
+            generator = torch.Generator().manual_seed(0)
+            U, S, Vh = randomized_svd_from_factors(
+                B, A, new_rank, oversample=oversample, niter=niter, generator=generator
+            )
+        else:
+            U, S, Vh = truncated_svd_from_factors(B, A, new_rank)
+        U = U * S
+
+        if U.shape[1] < new_rank:
+            # the stacked rank is smaller than the requested rank, the remaining components are zero
+            U = torch.nn.functional.pad(U, (0, new_rank - U.shape[1]))
+            Vh = torch.nn.functional.pad(Vh, (0, 0, 0, new_rank - Vh.shape[0]))
+
+        if clamp is not None:
+            hi_val = streaming_quantile([U, Vh], clamp, bins=quantile_bins)
+            low_val = -hi_val
+            U = U.clamp(low_val, hi_val)
+            Vh = Vh.clamp(low_val, hi_val)
+
+        U = U.reshape(target_lora_B.data.shape).to(dtype)
+        Vh = Vh.reshape(target_lora_A.data.shape).to(dtype)
+        return Vh, U
+
     def delete_adapter(self, adapter_name: str) -> None:
         """
         Deletes an existing adapter.
@@ -578,19 +748,21 @@ class LoraModel(BaseTuner):
             raise ValueError(f"Adapter {adapter_name} does not exist")
         del self.peft_config[adapter_name]
 
-        key_list = [key for key, _ in self.model.named_modules() if self.prefix not in key]
         new_adapter = None
-        for key in key_list:
-            _, target, _ = _get_submodules(self.model, key)
-            if isinstance(target, LoraLayer):
-                target.delete_adapter(adapter_name)
-                if new_adapter is None:
-                    new_adapter = target.active_adapters[:]
+        for target in self._get_layer_registry().modules(LoraLayer):
+            target.delete_adapter(adapter_name)
+            if new_adapter is None:
+                new_adapter = target.active_adapters[:]
 
         self.active_adapter = new_adapter or []
 
     def merge_and_unload(
-        self, progressbar: bool = False, safe_merge: bool = False, adapter_names: Optional[List[str]] = None
+        self,
+        progressbar: bool = False,
+        safe_merge: bool = False,
+        adapter_names: Optional[List[str]] = None,
+        num_workers: int = 1,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
     ) -> torch.nn.Module:
         r"""
         This method merges the LoRa layers into the base model. This is needed if someone wants to use the base model
@@ -605,6 +777,12 @@ class LoraModel(BaseTuner):
             adapter_names (`List[str]`, *optional*):
                 The list of adapter names that should be merged. If None, all active adapters will be merged. Defaults
                 to `None`.
+            num_workers (`int`):
+                Number of threads merging the layers concurrently, every one of them using
+                `torch.get_num_threads() // num_workers` intra-op threads. The merged weights do not depend on the
+                scheduling of the layers. Defaults to 1, i.e. a serial merge.
+            progress_callback (`Callable[[int, int], None]`, *optional*):
+                Called as `progress_callback(done, total)` after every merged layer. Defaults to `None`.
         Example:
 
         ```py
@@ -618,7 +796,11 @@ class LoraModel(BaseTuner):
         ```
         """
         return self._unload_and_optionally_merge(
-            progressbar=progressbar, safe_merge=safe_merge, adapter_names=adapter_names
+            progressbar=progressbar,
+            safe_merge=safe_merge,
+            adapter_names=adapter_names,
+            num_workers=num_workers,
+            progress_callback=progress_callback,
         )
 
     def unload(self) -> torch.nn.Module:
@@ -0,0 +1,110 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Iterable, Optional, Tuple
+
+import torch
+
+
+def truncated_svd_from_factors(
+    B: torch.Tensor, A: torch.Tensor, rank: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Exact truncated SVD of `B @ A` computed from the factors, without forming the `(out, in)` product.
+
+    With `B` of shape `(out, R)` and `A` of shape `(R, in)`, the thin QR decompositions `B = Qb Rb` and `A^T = Qa Ra`
+    reduce the problem to the SVD of the `(R, R)` matrix `Rb @ Ra^T`. The cost is `O((out + in) * R^2)`.
+
+    Returns `U` of shape `(out, k)`, `S` of shape `(k,)` and `Vh` of shape `(k, in)` with `k = min(rank, R)`.
+    """
+    Qb, Rb = torch.linalg.qr(B)
+    Qa, Ra = torch.linalg.qr(A.T)
+    U, S, Vh = torch.linalg.svd(Rb @ Ra.T, full_matrices=False)
+    return (Qb @ U[:, :rank]), S[:rank], (Vh[:rank] @ Qa.T)
+
+
+def randomized_svd_from_factors(
+    B: torch.Tensor,
+    A: torch.Tensor,
+    rank: int,
+    oversample: int = 10,
+    niter: int = 2,
+    generator: Optional[torch.Generator] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Randomized truncated SVD of `B @ A` (Halko et al., 2011) computed from the factors.
+
+    The range of `B @ A` is sketched with `rank + oversample` random vectors and refined with `niter` power iterations,
+    every product with `B @ A` or its transpose being applied factor by factor. Increasing `oversample` and `niter`
+    improves the accuracy at the cost of more passes over the factors. Falls back to `truncated_svd_from_factors` when
+    the sketch would not be smaller than the stacked rank `R`.
+
+    Returns `U` of shape `(out, k)`, `S` of shape `(k,)` and `Vh` of shape `(k, in)` with `k = min(rank, R)`.
+    """
+    stacked_rank = B.shape[1]
+    sketch_size = rank + oversample
+    if sketch_size >= stacked_rank:
+        return truncated_svd_from_factors(B, A, rank)
+
+    omega = torch.randn(A.shape[1], sketch_size, generator=generator, dtype=A.dtype).to(A.device)
+    Y = B @ (A @ omega)
+    for _ in range(niter):
+        # orthonormalize between the products to keep the small singular directions from vanishing numerically
+        Y, _ = torch.linalg.qr(Y)
+        Z, _ = torch.linalg.qr(A.T @ (B.T @ Y))
+        Y = B @ (A @ Z)
+    Q, _ = torch.linalg.qr(Y)
+    U, S, Vh = torch.linalg.svd((Q.T @ B) @ A, full_matrices=False)
+    return (Q @ U[:, :rank]), S[:rank], Vh[:rank]
+
+
+def streaming_quantile(tensors: Iterable[torch.Tensor], q: float, bins: int = 4096, chunk_size: int = 2**20) -> float:
+    """
+    Approximate `q`-quantile of the values of all `tensors`, computed in chunks of `chunk_size` values.
+
+    A first pass finds the range of the values, a second one accumulates a histogram of `bins` bins over that range;
+    the quantile is interpolated linearly inside the bin where the cumulative count crosses it. The absolute error is
+    at most the bin width, `(max - min) / bins`. Unlike `torch.quantile`, this never sorts nor copies the values and
+    has no limit on their number.
+    """
+    tensors = [t.detach().reshape(-1) for t in tensors]
+
+    def chunks():
+        for t in tensors:
+            for start in range(0, t.numel(), chunk_size):
+                yield t[start : start + chunk_size].float()
+
+    low, high = float("inf"), float("-inf")
+    numel = 0
+    for chunk in chunks():
+        low = min(low, chunk.min().item())
+        high = max(high, chunk.max().item())
+        numel += chunk.numel()
+    if numel == 0:
+        raise ValueError("Cannot compute the quantile of empty tensors.")
+    if low == high:
+        return low
+
+    counts = torch.zeros(bins, dtype=torch.float64)
+    for chunk in chunks():
+        counts += torch.histc(chunk, bins=bins, min=low, max=high).to(torch.float64).cpu()
+
+    # rank of the quantile, with the linear interpolation convention of `torch.quantile`
+    position = q * (numel - 1)
+    cumulative = torch.cumsum(counts, dim=0)
+    index = int(torch.searchsorted(cumulative, torch.tensor(position + 1, dtype=torch.float64)).clamp(max=bins - 1))
+    before = cumulative[index - 1].item() if index > 0 else 0.0
+    fraction = (position + 1 - before) / max(counts[index].item(), 1.0)
+    width = (high - low) / bins
+    return low + (index + min(max(fraction, 0.0), 1.0)) * width
@@ -22,10 +22,10 @@ from peft import (
     PromptEncoderConfig,
 )
 from lora.config import LoraConfig
-import evaluate
 from datasets import load_dataset
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, get_linear_schedule_with_warmup, set_seed, AutoConfig
 from tqdm import tqdm
+from utils import AsyncEvaluator, GlueMetric
 from lora.model import LoraModel
 
 
@@ -46,6 +46,8 @@ parser.add_argument("--lora_alpha", type=int, default=8, help="Lora alpha value
 parser.add_argument("--lora_dropout", type=float, default=0.1, help="Lora dropout value for LoraConfig")
 parser.add_argument("--use_rslora", action="store_true", help="Whether to use RSLora in LoraConfig")
 parser.add_argument("--lr", type=float, default=4e-4, help="Learning rate")
+parser.add_argument("--async_eval", action="store_true", help="Evaluate in a background process while training")
+parser.add_argument("--eval_threads", type=int, default=None, help="Number of threads of the evaluation process")
 
 # Parse arguments
 args = parser.parse_args()
@@ -79,7 +81,7 @@ if getattr(tokenizer, "pad_token_id") is None:
     tokenizer.pad_token_id = tokenizer.eos_token_id
 
 datasets = load_dataset("glue", task)
-metric = evaluate.load("glue", task)
+metric = GlueMetric(task)
 
 
 def tokenize_function(examples):
@@ -150,6 +152,8 @@ lr_scheduler = get_linear_schedule_with_warmup(
     num_training_steps=(len(train_dataloader) * num_epochs),
 )
 
+# the evaluation process is forked here, before the model is moved to `device`
+evaluator = AsyncEvaluator(model, eval_dataloader, metric, num_threads=args.eval_threads) if args.async_eval else None
 model.to(device)
 for epoch in range(num_epochs):
     model.train()
@@ -162,6 +166,12 @@ for epoch in range(num_epochs):
         lr_scheduler.step()
         optimizer.zero_grad()
 
+    if evaluator is not None:
+        evaluator.submit(epoch, model)
+        for finished_epoch, eval_metric in evaluator.poll():
+            print(f"epoch {finished_epoch}:", eval_metric)
+        continue
+
     model.eval()
     for step, batch in enumerate(tqdm(train_dataloader)):
         batch.to(device)
@@ -178,6 +188,10 @@ for epoch in range(num_epochs):
     print(f"epoch {epoch}:", eval_metric)
     
     
+if evaluator is not None:
+    for finished_epoch, eval_metric in evaluator.close():
+        print(f"epoch {finished_epoch}:", eval_metric)
+
 save_model(model, "model.safetensors")
 
 load_model(model, "model.safetensors")
@@ -15,10 +15,10 @@ from peft import (
     PeftType,
 )
 from rsvera.config import VeraConfig
-import evaluate
 from datasets import load_dataset
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, get_linear_schedule_with_warmup, set_seed, AutoConfig
 from tqdm import tqdm
+from utils import AsyncEvaluator, GlueMetric
 from rsvera.model import VeraModel
 
 
@@ -41,6 +41,8 @@ parser.add_argument("--vera_alpha", type=int, default=8, help="Vera alpha value
 parser.add_argument("--use_rsvera", action="store_true", help="Whether to use RSVeRA")
 parser.add_argument("--head_lr", type=float, default=4e-4, help="Learning rate (head)")
 parser.add_argument("--vera_lr", type=float, default=4e-4, help="Learning rate (vera)")
+parser.add_argument("--async_eval", action="store_true", help="Evaluate in a background process while training")
+parser.add_argument("--eval_threads", type=int, default=None, help="Number of threads of the evaluation process")
 
 args = parser.parse_args()
 # Assign configuration values
@@ -76,7 +78,7 @@ if getattr(tokenizer, "pad_token_id") is None:
     tokenizer.pad_token_id = tokenizer.eos_token_id
 
 datasets = load_dataset("glue", task)
-metric = evaluate.load("glue", task)
+metric = GlueMetric(task)
 
 def tokenize_function(examples):
     if task == "sst2":
@@ -157,6 +159,8 @@ lr_scheduler = get_linear_schedule_with_warmup(
     num_training_steps=(len(train_dataloader) * num_epochs),
 )
 
+# the evaluation process is forked here, before the model is moved to `device`
+evaluator = AsyncEvaluator(model, eval_dataloader, metric, num_threads=args.eval_threads) if args.async_eval else None
 model.to(device)
 for epoch in range(num_epochs):
     model.train()
@@ -169,6 +173,12 @@ for epoch in range(num_epochs):
         lr_scheduler.step()
         optimizer.zero_grad()
     
+    if evaluator is not None:
+        evaluator.submit(epoch, model)
+        for finished_epoch, eval_metric in evaluator.poll():
+            print(f"epoch {finished_epoch}:", eval_metric)
+        continue
+
     model.eval()
     for step, batch in enumerate(tqdm(eval_dataloader)):
         batch.to(device)
@@ -185,6 +195,10 @@ for epoch in range(num_epochs):
     print(f"epoch {epoch}:", eval_metric)
     
     
+if evaluator is not None:
+    for finished_epoch, eval_metric in evaluator.close():
+        print(f"epoch {finished_epoch}:", eval_metric)
+
 save_model(model, f"{model_name_or_path}_{task}.safetensors")
 load_model(model, f"{model_name_or_path}_{task}.safetensors")
 #print(model.state_dict())
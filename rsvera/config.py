@@ -38,6 +38,9 @@ class VeraConfig(PeftConfig):
             all system configurations. Defaults to `True`.
         vera_dropout (`float`): The dropout probability for Vera layers.
         d_initial (`float`): Initial init value for `vera_lambda_d` vector used when `init_vera_weights`.
+        share_input_projection (`bool`): Whether the linear layers fed the same input tensor, e.g. the query, key and
+            value layers of an attention block, compute its projection by `vera_A` once and share it. Only applies
+            when dropout is disabled or in eval mode. Defaults to `True`.
         fan_in_fan_out (`bool`): Set this to True if the layer to replace stores weight like (fan_in, fan_out).
             For example, gpt-2 uses `Conv1D` which stores weights like (fan_in, fan_out) and hence this should be set
             to `True`.
@@ -98,6 +101,15 @@ class VeraConfig(PeftConfig):
     )
     vera_dropout: float = field(default=0.0, metadata={"help": "Vera dropout"})
     d_initial: float = field(default=1.0, metadata={"help": "Initial init value for d vector."})
+    share_input_projection: bool = field(
+        default=True,
+        metadata={
+            "help": (
+                "Whether the linear layers fed the same input tensor compute its projection by vera_A once and share"
+                " it."
+            )
+        },
+    )
     fan_in_fan_out: bool = field(
         default=False,
         metadata={"help": "Set this to True if the layer to replace stores weight like (fan_in, fan_out)"},
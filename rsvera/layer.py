@@ -25,6 +25,7 @@ from peft.tuners.tuners_utils import BaseTunerLayer
 from peft.utils.other import transpose
 
 from .buffer_dict import BufferDict
+from .projection_cache import InputProjectionCache
 
 
 class VeraLayer(BaseTunerLayer):
@@ -182,7 +183,9 @@ class VeraLayer(BaseTunerLayer):
 
 
 class Linear(nn.Linear, VeraLayer):
-    # Vera implemented in a dense layer
+    # Vera implemented in a dense layer.
+    # With a `projection_cache`, the layers of a model fed the same input tensor (e.g. query, key and value) compute
+    # `F.linear(x, vera_A)` once, as long as dropout does not make their inputs differ.
     def __init__(
         self,
         base_layer,
@@ -197,6 +200,7 @@ class Linear(nn.Linear, VeraLayer):
         init_vera_weights: Union[bool, str] = True,
         use_rsvera: bool = False,
         d_initial: float = 1.0,
+        projection_cache: Optional[InputProjectionCache] = None,
         **kwargs,
     ) -> None:
         # this gets the init from nn.Linear's super perspective, i.e.
@@ -204,6 +208,7 @@ class Linear(nn.Linear, VeraLayer):
         super(nn.Linear, self).__init__()
         VeraLayer.__init__(self, base_layer, **kwargs)
         self.fan_in_fan_out = fan_in_fan_out
+        self.projection_cache = projection_cache
 
         self._active_adapter = adapter_name
         self.update_layer(adapter_name, vera_A, vera_B, r, vera_alpha, vera_dropout, init_vera_weights, use_rsvera, d_initial=d_initial)
@@ -337,8 +342,13 @@ class Linear(nn.Linear, VeraLayer):
 
                 dropout = self.vera_dropout[active_adapter]
                 scaling = self.scaling[active_adapter]
-                x = x.to(lambda_d.dtype)
-                result += (lambda_b * F.linear(lambda_d * F.linear(dropout(x), vera_A), vera_B)) * scaling
+                if self.projection_cache is not None and (isinstance(dropout, nn.Identity) or not self.training):
+                    # the projection of the uncast input, shared with the sibling layers
+                    after_A = self.projection_cache.project(x, vera_A, lambda_d.dtype)
+                else:
+                    x = x.to(lambda_d.dtype)
+                    after_A = F.linear(dropout(x), vera_A)
+                result += (lambda_b * F.linear(lambda_d * after_A, vera_B)) * scaling
 
         result = result.to(previous_dtype)
         return result
@@ -33,6 +33,8 @@ from peft.utils import (
     _get_submodules,
 )
 
+from utils.profiler import ProfilingMixin
+
 TRANSFORMERS_MODELS_TO_VERA_TARGET_MODULES_MAPPING = TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING
 
 from .config import PeftConfig
@@ -40,6 +42,7 @@ from peft.tuners.tuners_utils import _maybe_include_all_linear_layers
 from .buffer_dict import BufferDict
 from .config import VeraConfig
 from .layer import Embedding, Linear, VeraLayer
+from .projection_cache import InputProjectionCache
 
 
 def _kaiming_init(
@@ -71,7 +74,7 @@ def _kaiming_init(
         return tensor.uniform_(-bound, bound, generator=generator)
 
 
-class VeraModel(BaseTuner):
+class VeraModel(ProfilingMixin, BaseTuner):
     """
     Creates Vector-based Random Matrix Adaptation (Vera) model from a pretrained transformers model.
 
@@ -240,6 +243,9 @@ class VeraModel(BaseTuner):
         self.vera_embedding_A = BufferDict({}, persistent=config.save_projection)
         self.vera_embedding_B = BufferDict({}, persistent=config.save_projection)
 
+        # shared by the linear layers, see `InputProjectionCache`
+        self._projection_cache = InputProjectionCache()
+
         # deterministic init of vera_A and vera_B if we know the key
         generator = torch.Generator(device="cpu").manual_seed(config.projection_prng_key)
         if first_linear is not None:
@@ -358,7 +364,10 @@ class VeraModel(BaseTuner):
                 vera_config.use_rsvera,
                 d_initial=vera_config.d_initial,
             )
+            target.projection_cache = self._projection_cache if vera_config.share_input_projection else None
         else:
+            if vera_config.share_input_projection:
+                kwargs["projection_cache"] = self._projection_cache
             new_module = self._create_new_module(vera_config, self.vera_A, self.vera_B, adapter_name, target, **kwargs)
             if adapter_name != self.active_adapter:
                 # adding an additional adapter: it is not automatically trainable
@@ -425,6 +434,7 @@ class VeraModel(BaseTuner):
         if isinstance(target_base_layer, torch.nn.Embedding):
             embedding_kwargs = kwargs.copy()
             embedding_kwargs.pop("fan_in_fan_out", None)
+            embedding_kwargs.pop("projection_cache", None)
             new_module = Embedding(
                 target,
                 vera_A,
@@ -466,6 +476,13 @@ class VeraModel(BaseTuner):
 
         return new_module
 
+    def forward(self, *args, **kwargs):
+        try:
+            return self.model.forward(*args, **kwargs)
+        finally:
+            # the entries would otherwise keep the last projections alive until the next forward
+            self._projection_cache.clear()
+
     def __getattr__(self, name: str):
         """Forward missing attributes to the wrapped module."""
         try:
@@ -526,6 +543,8 @@ class VeraModel(BaseTuner):
         safe_merge: bool = False,
         adapter_names: Optional[List[str]] = None,
     ):
+        # the base layers are handed back to the user, they must not keep the profiling hooks
+        self.disable_profiling()
         # we cannot use self.prefix as we want to include non-trainable vera parameters
         key_list = [key for key, _ in self.model.named_modules() if "vera" not in key]
         desc = "Unloading " + ("and merging " if merge else "") + "model"
@@ -0,0 +1,65 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reuse of the input projection between Vera layers fed the same tensor.
+
+Without `lambda_c`, the first step of the adapter branch, `F.linear(x, vera_A)`, only depends on the input and on the
+shared projection. The query, key and value layers of an attention block receive the same hidden states, so the
+projection is computed by the first of them and reused by the others.
+"""
+import weakref
+from typing import Dict, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+class InputProjectionCache:
+    """
+    The last `F.linear(x.to(dtype), vera_A)` of every projection, dtype and autograd mode, shared by the Vera `Linear`
+    layers of a model.
+
+    An entry only matches the very tensor it was computed from: the input is held by a weak reference, so that a new
+    tensor reusing the memory or the `id` of a freed one never matches (likewise for the projection), and an in-place
+    update of the input or of the projection (bumping its version) invalidates the entry. The reused output is a node
+    of the autograd graph like any other, its gradient accumulates over the layers that consume it.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple, Tuple[weakref.ref, int, weakref.ref, int, torch.Tensor]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def project(self, x: torch.Tensor, vera_A: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+        if x.is_inference() or vera_A.is_inference():
+            # inference tensors have no version counter to detect in-place updates
+            return F.linear(x.to(dtype), vera_A)
+
+        key = (id(vera_A), dtype, torch.is_grad_enabled())
+        entry = self._entries.get(key)
+        if entry is not None:
+            x_ref, x_version, vera_A_ref, vera_A_version, output = entry
+            same_x = x_ref() is x and x._version == x_version
+            if same_x and vera_A_ref() is vera_A and vera_A._version == vera_A_version:
+                self.hits += 1
+                return output
+
+        self.misses += 1
+        output = F.linear(x.to(dtype), vera_A)
+        self._entries[key] = (weakref.ref(x), x._version, weakref.ref(vera_A), vera_A._version, output)
+        return output
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -0,0 +1,128 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Combination of VeRA-plus adapters without materialising their delta weights.
+
+A VeRA-plus `Linear` adds `scaling * diag(lambda_b) @ vera_B @ diag(lambda_d) @ vera_A @ diag(lambda_c)` to the base
+weight. Such a term is represented here by a `VeraTerm`, its coefficient folding the combination weight and the
+scaling. The Frobenius inner product of two terms only involves `(r1, r2)` Gram matrices of the projections:
+
+    <diag(x) B1 D1 A1 diag(y), diag(x') B2 D2 A2 diag(y')> = d1^T [(B1^T diag(x x') B2) * (A1 diag(y y') A2^T)] d2
+
+so that both the exact combinations and the refit below cost `O((out + in) * r^2)` per layer.
+"""
+from typing import List, NamedTuple, Tuple
+
+import torch
+
+
+class VeraTerm(NamedTuple):
+    coef: float
+    lambda_b: torch.Tensor
+    vera_B: torch.Tensor
+    lambda_d: torch.Tensor
+    vera_A: torch.Tensor
+    lambda_c: torch.Tensor
+
+
+def _gram(left: torch.Tensor, weight: torch.Tensor, right: torch.Tensor) -> torch.Tensor:
+    # left^T @ diag(weight) @ right, for (n, r1) and (n, r2) matrices
+    return left.T @ (weight.unsqueeze(-1) * right)
+
+
+def term_inner(t1: VeraTerm, t2: VeraTerm) -> torch.Tensor:
+    """Frobenius inner product of the delta weights of two terms."""
+    gram_B = _gram(t1.vera_B, t1.lambda_b * t2.lambda_b, t2.vera_B)
+    gram_A = _gram(t1.vera_A.T, t1.lambda_c * t2.lambda_c, t2.vera_A.T)
+    return t1.coef * t2.coef * (t1.lambda_d @ (gram_B * gram_A) @ t2.lambda_d)
+
+
+def relative_error(targets: List[VeraTerm], approximation: VeraTerm) -> float:
+    """`||sum(targets) - approximation|| / ||sum(targets)||` in Frobenius norm."""
+    target_sq = sum(term_inner(t1, t2) for t1 in targets for t2 in targets)
+    cross = sum(term_inner(t, approximation) for t in targets)
+    error_sq = target_sq - 2 * cross + term_inner(approximation, approximation)
+    if target_sq <= 0:
+        return 0.0 if error_sq <= 0 else float("inf")
+    return (error_sq.clamp_min(0) / target_sq).sqrt().item()
+
+
+def _solve_lambda_d(targets: List[VeraTerm], fit: VeraTerm) -> torch.Tensor:
+    hessian = fit.coef**2 * _gram(fit.vera_B, fit.lambda_b**2, fit.vera_B) * _gram(
+        fit.vera_A.T, fit.lambda_c**2, fit.vera_A.T
+    )
+    rhs = torch.zeros_like(fit.lambda_d)
+    for t in targets:
+        gram_B = _gram(fit.vera_B, fit.lambda_b * t.lambda_b, t.vera_B)
+        gram_A = _gram(fit.vera_A.T, fit.lambda_c * t.lambda_c, t.vera_A.T)
+        rhs += fit.coef * t.coef * ((gram_B * gram_A) @ t.lambda_d)
+    # the normal equations are singular for repeated projection rows (e.g. after concatenation), lstsq returns the
+    # minimum norm solution in that case. Its `gelsd` driver only runs on CPU, where the (r, r) system is solved
+    solution = torch.linalg.lstsq(hessian.cpu(), rhs.unsqueeze(-1).cpu(), driver="gelsd").solution
+    return solution.squeeze(-1).to(rhs.device)
+
+
+def _solve_scales(targets: List[VeraTerm], fit: VeraTerm, target_scales, fit_gram, target_grams, rows, target_rows):
+    # per row least squares of `scale_i * P_i` against `T_i`: scale_i = <P_i, T_i> / ||P_i||^2
+    kernel = fit.coef**2 * torch.outer(fit.lambda_d, fit.lambda_d) * fit_gram
+    norms = ((rows @ kernel) * rows).sum(-1)
+    dots = torch.zeros_like(norms)
+    for t, gram, t_rows, t_scale in zip(targets, target_grams, target_rows, target_scales):
+        kernel = fit.coef * t.coef * torch.outer(fit.lambda_d, t.lambda_d) * gram
+        dots += ((rows @ kernel) * t_rows).sum(-1) * t_scale
+    return torch.where(norms > 0, dots / norms.clamp_min(torch.finfo(norms.dtype).tiny), torch.zeros_like(norms))
+
+
+def _solve_lambda_b(targets: List[VeraTerm], fit: VeraTerm) -> torch.Tensor:
+    fit_gram = _gram(fit.vera_A.T, fit.lambda_c**2, fit.vera_A.T)
+    target_grams = [_gram(fit.vera_A.T, fit.lambda_c * t.lambda_c, t.vera_A.T) for t in targets]
+    return _solve_scales(
+        targets,
+        fit,
+        [t.lambda_b for t in targets],
+        fit_gram,
+        target_grams,
+        fit.vera_B,
+        [t.vera_B for t in targets],
+    )
+
+
+def _solve_lambda_c(targets: List[VeraTerm], fit: VeraTerm) -> torch.Tensor:
+    fit_gram = _gram(fit.vera_B, fit.lambda_b**2, fit.vera_B)
+    target_grams = [_gram(fit.vera_B, fit.lambda_b * t.lambda_b, t.vera_B) for t in targets]
+    return _solve_scales(
+        targets,
+        fit,
+        [t.lambda_c for t in targets],
+        fit_gram,
+        target_grams,
+        fit.vera_A.T,
+        [t.vera_A.T for t in targets],
+    )
+
+
+def refit_lambdas(targets: List[VeraTerm], init: VeraTerm, steps: int = 10) -> Tuple[VeraTerm, float]:
+    """
+    Fits the lambdas of `init` (keeping its coefficient and projections) to the sum of `targets` by alternating least
+    squares over `lambda_d`, `lambda_b` and `lambda_c`. Every step solves its subproblem exactly, so the error never
+    increases. Returns the fitted term and its relative error.
+    """
+    fit = init
+    for _ in range(steps):
+        fit = fit._replace(lambda_d=_solve_lambda_d(targets, fit))
+        fit = fit._replace(lambda_b=_solve_lambda_b(targets, fit))
+        fit = fit._replace(lambda_c=_solve_lambda_c(targets, fit))
+    fit = fit._replace(lambda_d=_solve_lambda_d(targets, fit))
+    return fit, relative_error(targets, fit)
@@ -18,6 +18,9 @@ from typing import List, Optional, Union
 
 from peft.config import PeftConfig
 from peft.utils import PeftType
+
+from utils.precision import PrecisionPolicy
+
 PeftType.VERA = "VERA"
 
 @dataclass
@@ -38,6 +41,43 @@ class VeraConfig(PeftConfig):
             all system configurations. Defaults to `True`.
         vera_dropout (`float`): The dropout probability for Vera layers.
         d_initial (`float`): Initial init value for `vera_lambda_d` vector used when `init_vera_weights`.
+        embedding_projection (`str`): How the `vera_A` projection of the targeted embedding layers is obtained. With
+            `counter`, the columns of the looked up token ids are generated on the fly from `projection_prng_key`, so
+            the `(r, num_embeddings)` projection never exists in memory. With `dense`, the same projection is
+            materialised once (and saved if `save_projection`). Defaults to `counter`.
+        embedding_unique_tokens (`bool`): Whether the embedding layers compute their adapter output once per distinct
+            token id of the batch and gather it, instead of once per position. The forward and backward cost of the
+            adapter then scales with the number of distinct tokens. Defaults to `True`.
+        memory_efficient_backward (`bool`): Whether the linear layers recompute the rank `r` projections of the
+            adapter in the backward instead of keeping them, and their scaled input, from the forward. The gradients
+            are the same, the activation memory of the adapters shrinks to nothing beyond the layer input. Defaults to
+            `True`.
+        execution_strategy (`str`): How the linear layers apply the adapters in the forward, one of `auto`,
+            `low_rank`, `dense` or `merged`. `low_rank` applies the two projections, `dense` a cached delta weight and
+            `merged` a cached copy of the base weight with the delta weight merged in, see
+            [`Linear.select_execution_strategy`]. The cached weights are only used when no gradient is needed, and
+            `auto` picks the cheapest strategy per call from the rank, the feature dimensions, the number of tokens and
+            the training mode. Both cached weights have the size of the base weight, so `dense`, `merged` and
+            `auto` under `torch.no_grad()` keep one more copy of every targeted base weight in memory, e.g. `auto`
+            goes for `merged` at hidden size 768 from `r >= 384`. The cached strategies are therefore opt-in, defaults
+            to `low_rank`.
+        fuse_sibling_projections (`bool`): Whether the linear layers of the same parent module, e.g. the query, key
+            and value of an attention block, compute their low rank branches together: one GEMM against their stacked
+            `lambda_c`-scaled copies of `vera_A` and one against `vera_B`, instead of two per layer. This only pays off
+            when the layers are called on the same input tensor, as in self-attention, and for small token counts,
+            where the per-call overhead of the small GEMMs dominates: larger calls, or calls with dropout in training
+            mode, use the separate branches. Defaults to `False`.
+        quantize_backbone (`str`, *optional*): Quantization of the frozen base layers of the targeted `nn.Linear`
+            layers, `None` or `int8`. With `int8`, they are held as int8 with one scale per output feature and, on CPU,
+            the forward and the gradient of their input run as int8 matrix products, see [`~quantization.Int8Linear`].
+            The base layers are dequantized when the model is merged or unloaded. Defaults to `None`.
+        precision_policy (`dict`, *optional*): Dtypes of the adapter, by name (`float32`, `float16`, `bfloat16`):
+            `storage_dtype` for the lambdas, `compute_dtype` for the adapter GEMMs and the shared projections, and
+            `accumulate_dtype` for the sum of the adapter and base outputs, see [`~utils.precision.PrecisionPolicy`].
+            The missing ones keep the default, the dtype of the backbone. E.g. `{"storage_dtype": "float32",
+            "compute_dtype": "bfloat16"}` trains float32 lambdas with bfloat16 GEMMs on a bfloat16 backbone. Whatever
+            the policy, the activations are never cast to a wider compute dtype, the product by `lambda_c` promotes
+            them. Defaults to `None`.
         fan_in_fan_out (`bool`): Set this to True if the layer to replace stores weight like (fan_in, fan_out).
             For example, gpt-2 uses `Conv1D` which stores weights like (fan_in, fan_out) and hence this should be set
             to `True`.
@@ -99,6 +139,64 @@ class VeraConfig(PeftConfig):
     vera_dropout: float = field(default=0.0, metadata={"help": "Vera dropout"})
     d_initial: float = field(default=1.0, metadata={"help": "Initial init value for d vector."})
     c_initial: float = field(default=1.0, metadata={"help": "Initial init value for c vector."})
+    embedding_projection: str = field(
+        default="counter",
+        metadata={
+            "help": (
+                "How the projection of the embedding layers is obtained, 'counter' (generated on the fly from"
+                " `projection_prng_key` for the looked up token ids) or 'dense' (materialised once)."
+            )
+        },
+    )
+    embedding_unique_tokens: bool = field(
+        default=True,
+        metadata={
+            "help": (
+                "Whether the embedding layers compute their adapter output once per distinct token id of the batch"
+                " instead of once per position."
+            )
+        },
+    )
+    memory_efficient_backward: bool = field(
+        default=True,
+        metadata={
+            "help": (
+                "Whether the linear layers recompute the rank r projections of the adapter in the backward instead of"
+                " keeping them from the forward."
+            )
+        },
+    )
+    execution_strategy: str = field(
+        default="low_rank",
+        metadata={
+            "help": (
+                "How the linear layers apply the adapters in the forward, 'auto', 'low_rank', 'dense' (cached delta"
+                " weight) or 'merged' (cached merged weight)."
+            )
+        },
+    )
+    fuse_sibling_projections: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether the linear layers of the same parent module, e.g. query, key and value, compute their low"
+                " rank branches in one down-projection and one up-projection GEMM."
+            )
+        },
+    )
+    quantize_backbone: Optional[str] = field(
+        default=None,
+        metadata={"help": "Quantization of the frozen base layers of the targeted nn.Linear layers, None or 'int8'."},
+    )
+    precision_policy: Optional[dict] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Dtypes of the adapter, e.g. {'storage_dtype': 'float32', 'compute_dtype': 'bfloat16',"
+                " 'accumulate_dtype': 'float32'}, the missing ones being the dtype of the backbone."
+            )
+        },
+    )
     fan_in_fan_out: bool = field(
         default=False,
         metadata={"help": "Set this to True if the layer to replace stores weight like (fan_in, fan_out)"},
@@ -163,6 +261,13 @@ class VeraConfig(PeftConfig):
 
     def __post_init__(self):
         self.peft_type = PeftType.VERA
+        if self.embedding_projection not in ("counter", "dense"):
+            raise ValueError(f"Invalid embedding_projection: {self.embedding_projection}")
+        if self.execution_strategy not in ("auto", "low_rank", "dense", "merged"):
+            raise ValueError(f"Invalid execution_strategy: {self.execution_strategy}")
+        if self.quantize_backbone not in (None, "int8"):
+            raise ValueError(f"Invalid quantize_backbone: {self.quantize_backbone}")
+        PrecisionPolicy.from_dict(self.precision_policy)
         self.target_modules = (
             set(self.target_modules) if isinstance(self.target_modules, list) else self.target_modules
         )
\ No newline at end of file
@@ -0,0 +1,72 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Counter-based random projections.
+
+The entry `(k, t)` of a projection is a pure function of the PRNG key, the column `t` and the row `k`: the SplitMix64
+finalizer applied to a counter built from the three. Any subset of columns, e.g. the ones of the token ids of a batch,
+can then be generated independently of the others, on any device, without materialising the full projection.
+"""
+import math
+
+import torch
+
+
+def _signed(value: int) -> int:
+    # two's complement of a 64 bits constant, so that it fits in an int64 tensor
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+_GOLDEN_GAMMA = _signed(0x9E3779B97F4A7C15)
+_MIX_1 = _signed(0xBF58476D1CE4E5B9)
+_MIX_2 = _signed(0x94D049BB133111EB)
+
+
+def _shift_right(x: torch.Tensor, n: int) -> torch.Tensor:
+    # logical shift, `>>` is arithmetic on int64 tensors
+    return (x >> n) & ((1 << (64 - n)) - 1)
+
+
+def _mix64(x: torch.Tensor) -> torch.Tensor:
+    # SplitMix64 finalizer, the int64 products wrap around like the uint64 ones of the reference implementation
+    x = (x ^ _shift_right(x, 30)) * _MIX_1
+    x = (x ^ _shift_right(x, 27)) * _MIX_2
+    return x ^ _shift_right(x, 31)
+
+
+def counter_projection(
+    prng_key: int, columns: torch.Tensor, r: int, dtype: torch.dtype = torch.float32
+) -> torch.Tensor:
+    """
+    Columns `columns` of a `(r, num_columns)` random projection with i.i.d. entries, uniform with zero mean and unit
+    variance, returned transposed, i.e. with shape `(*columns.shape, r)` and on the device of `columns`.
+
+    Args:
+        prng_key (`int`):
+            Key of the projection, the same key always gives the same projection.
+        columns (`torch.Tensor`):
+            Integer tensor of the column indexes, e.g. token ids.
+        r (`int`):
+            Number of rows of the projection.
+        dtype (`torch.dtype`):
+            Dtype of the returned values.
+    """
+    seed = _mix64(torch.tensor(prng_key, dtype=torch.int64, device=columns.device))
+    rows = torch.arange(r, dtype=torch.int64, device=columns.device)
+    counters = columns.to(torch.int64).unsqueeze(-1) * r + rows
+    bits = _mix64(counters * _GOLDEN_GAMMA + seed)
+    # the 24 high bits give a float32-exact uniform in [0, 1), centered and scaled to unit variance
+    uniform = _shift_right(bits, 40).to(torch.float32).mul_(2.0**-24)
+    return uniform.sub_(0.5 - 2.0**-25).mul_(2 * math.sqrt(3.0)).to(dtype)
@@ -0,0 +1,107 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Delta weights of the VeRA-plus layers.
+
+The delta weight of a layer is a rank `r` product of the shared projections, scaled by the lambdas along its rows, its
+rank and its columns. For float16 and bfloat16 on CPU, it is computed tile by tile and written directly into the low
+precision output. The projections are scaled by the lambdas in float32, one tile at a time, and multiplied with a
+float32 accumulation:
+
+- where the CPU has a native low precision GEMM (e.g. AVX512-BF16 and AMX for bfloat16, several times faster than a
+  float32 GEMM), by blocks of rows against the scaled right projection, rounded once to the low precision dtype,
+- otherwise in float32, tile by tile.
+
+The float32 temporaries are bounded by a few tiles, instead of float32 copies of the full projections and of the full
+delta weight. Autograd would keep all the tiles alive, so the
+delta weights that need gradients are computed by a single product instead.
+"""
+import functools
+from typing import Optional
+
+import torch
+
+
+# rows and columns of the tiles of the blocked product, a float32 tile is 4 MiB
+DELTA_BLOCK_SIZE = 1024
+
+
+@functools.lru_cache()
+def has_native_gemm(dtype: torch.dtype) -> bool:
+    """Whether the CPU multiplies `dtype` matrices natively, the CPU BLAS accumulating in float32."""
+    if dtype == torch.bfloat16:
+        checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    elif dtype == torch.float16:
+        checks = ("_is_amx_fp16_supported",)
+    else:
+        return False
+    return any(getattr(torch.cpu, check, lambda: False)() for check in checks)
+
+
+def is_blocked(tensor: torch.Tensor) -> bool:
+    """Whether the delta weights of projections like `tensor` are computed tile by tile, see `delta_weight`."""
+    return tensor.device.type == "cpu" and tensor.dtype in (torch.float16, torch.bfloat16)
+
+
+def delta_weight(
+    left: torch.Tensor,
+    rank_scales: torch.Tensor,
+    right: torch.Tensor,
+    row_scales: torch.Tensor,
+    column_scales: torch.Tensor,
+    scaling: float = 1.0,
+    out: Optional[torch.Tensor] = None,
+    block_size: int = DELTA_BLOCK_SIZE,
+) -> torch.Tensor:
+    """
+    `scaling * row_scales[:, None] * ((left * rank_scales) @ right) * column_scales`, in the dtype of `left`.
+
+    Args:
+        left (`torch.Tensor`): `(rows, r)` projection.
+        rank_scales (`torch.Tensor`): `(r,)` scales of the rank, `lambda_d`.
+        right (`torch.Tensor`): `(r, columns)` projection.
+        row_scales (`torch.Tensor`): `(rows,)` scales of the rows.
+        column_scales (`torch.Tensor`): `(columns,)` scales of the columns.
+        scaling (`float`): Scaling of the adapter.
+        out (`torch.Tensor`, *optional*): `(rows, columns)` tensor the delta weight is written into.
+        block_size (`int`): Rows and columns of the tiles of the blocked product.
+    """
+    factors = (left, rank_scales, right, row_scales, column_scales)
+    needs_grad = torch.is_grad_enabled() and any(factor.requires_grad for factor in factors)
+    if needs_grad or not is_blocked(left):
+        delta = (row_scales.unsqueeze(-1) * scaling * left * rank_scales) @ (right * column_scales)
+        return delta if out is None else out.copy_(delta)
+
+    dtype = left.dtype
+    native = has_native_gemm(dtype)
+    if out is None:
+        out = torch.empty(left.shape[0], right.shape[1], dtype=dtype, device=left.device)
+    rank_scales = rank_scales.float()
+    if native:
+        scaled_right = torch.empty_like(right)
+        for column in range(0, right.shape[1], block_size):
+            columns = slice(column, column + block_size)
+            scaled_right[:, columns] = right[:, columns].float() * column_scales[columns].float()
+
+    for row in range(0, left.shape[0], block_size):
+        rows = slice(row, row + block_size)
+        left_tile = (row_scales[rows].float() * scaling).unsqueeze(-1) * left[rows].float() * rank_scales
+        if native:
+            out[rows] = left_tile.to(dtype) @ scaled_right
+            continue
+        for column in range(0, right.shape[1], block_size):
+            columns = slice(column, column + block_size)
+            out[rows, columns] = left_tile @ (right[:, columns].float() * column_scales[columns].float())
+    return out
@@ -0,0 +1,72 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Memory-efficient adapter branch of the VeRA-plus `Linear` layers.
+
+Autograd keeps the `(..., in_features)` scaled input and the `(..., r)` output of `vera_A` of the plain branch
+`lambda_b * (lambda_d * (x * lambda_c) @ vera_A.T) @ vera_B.T` alive until the backward. Only the lambdas need
+gradients, so `VeraLinearFunction` saves the input alone and recomputes the rank `r` projections in the backward.
+"""
+import torch
+
+
+def _sum_to_last_dim(tensor: torch.Tensor) -> torch.Tensor:
+    # sums over all the leading (batch, sequence, ...) dimensions
+    return tensor.reshape(-1, tensor.shape[-1]).sum(0)
+
+
+class VeraLinearFunction(torch.autograd.Function):
+    """
+    `scaling * lambda_b * ((lambda_d * ((x * lambda_c) @ vera_A.T)) @ vera_B.T)`, saving only `x` (and the lambdas
+    and projections, which are parameters and shared buffers) for the backward. The projections get no gradient.
+    """
+
+    @staticmethod
+    def forward(ctx, x, lambda_b, lambda_d, lambda_c, vera_A, vera_B, scaling):
+        ctx.save_for_backward(x, lambda_b, lambda_d, lambda_c, vera_A, vera_B)
+        ctx.scaling = scaling
+        after_A = (x * lambda_c) @ vera_A.T
+        return ((lambda_d * after_A) @ vera_B.T) * (lambda_b * scaling)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, lambda_b, lambda_d, lambda_c, vera_A, vera_B = ctx.saved_tensors
+        grad_x = grad_lambda_b = grad_lambda_d = grad_lambda_c = None
+
+        # recomputed, (..., r)
+        after_A = (x * lambda_c) @ vera_A.T
+        grad_output = grad_output * ctx.scaling
+        if ctx.needs_input_grad[1]:
+            grad_lambda_b = _sum_to_last_dim(grad_output * ((lambda_d * after_A) @ vera_B.T))
+
+        grad_after_d = (grad_output * lambda_b) @ vera_B
+        if ctx.needs_input_grad[2]:
+            grad_lambda_d = _sum_to_last_dim(grad_after_d * after_A)
+
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[3]:
+            grad_scaled_x = (grad_after_d * lambda_d) @ vera_A
+            if ctx.needs_input_grad[3]:
+                grad_lambda_c = _sum_to_last_dim(grad_scaled_x * x)
+            if ctx.needs_input_grad[0]:
+                grad_x = grad_scaled_x * lambda_c
+
+        return grad_x, grad_lambda_b, grad_lambda_d, grad_lambda_c, None, None, None
+
+
+def vera_linear(x, lambda_b, lambda_d, lambda_c, vera_A, vera_B, scaling: float) -> torch.Tensor:
+    """Adapter branch of a VeRA-plus `Linear`, see [`VeraLinearFunction`]."""
+    if vera_A.requires_grad or vera_B.requires_grad:
+        raise ValueError("`vera_linear` does not compute gradients for the projections `vera_A` and `vera_B`.")
+    return VeraLinearFunction.apply(x, lambda_b, lambda_d, lambda_c, vera_A, vera_B, scaling)
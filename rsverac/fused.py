@@ -0,0 +1,124 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Fused adapter branch of sibling VeRA-plus `Linear` layers.
+
+The query, key and value layers of an attention block are called one after the other on the same hidden states, each
+with two small GEMMs against the shared projections. The `k` siblings are computed together instead: one
+down-projection GEMM of their `(k * N, in)` stacked `lambda_c`-scaled inputs against the shared `vera_A`, and one
+up-projection GEMM of the `(k * N, r)` stacked intermediates against the shared `vera_B`.
+
+This saves the per-call overhead of the small GEMMs, but the stacked operands are `k` times larger than the ones of a
+single layer: past a few hundred tokens they fall out of the CPU caches and the fused branch gets slower than the
+separate ones. The siblings are therefore only fused while the stacked outputs stay below `MAX_FUSED_ELEMENTS`.
+"""
+import weakref
+from typing import Dict, List
+
+import torch
+
+from utils.precision import promotes_to
+
+
+# 2 MiB of float32, the stacked inputs or outputs of 3 siblings of width 768 for ~230 tokens
+MAX_FUSED_ELEMENTS = 1 << 19
+
+
+class SiblingGroup:
+    """
+    Vera `Linear` layers of the same parent module and input size, e.g. the query, key and value of an attention block.
+
+    The first member called on an input computes the adapter outputs of all the members that can be fused for the
+    adapter (see `fusable`), returns its own and keeps the others for their call on the same input tensor. The input is
+    held by a weak reference and checked against its version, so an output is only ever handed for the very tensor it
+    was computed from; any other call computes the group again. Fusion thus only pays off when the members share their
+    input, as in self-attention, and for few enough tokens (see `applies`). The outputs not handed out by the end of
+    the forward of the model are dropped by `VeraModel.forward`, see `clear`.
+    """
+
+    def __init__(self, layers: List):
+        self.layers = layers
+        # per (adapter, autograd mode): weak reference and version of the input, and the outputs not yet handed out
+        self._pending: Dict[tuple, tuple] = {}
+
+    @staticmethod
+    def fusable(layer, adapter: str) -> bool:
+        # the fused branch has no dropout, every member gets the very same input
+        return (
+            adapter in layer.vera_lambda_d
+            and adapter in layer.active_adapters
+            and not layer.merged
+            and not layer.disable_adapters
+            and (not layer.training or isinstance(layer.vera_dropout[adapter], torch.nn.Identity))
+        )
+
+    def applies(self, layer, x: torch.Tensor, adapter: str) -> bool:
+        """Whether `layer` gets its adapter output for `x` from the group."""
+        num_tokens = x.numel() // x.shape[-1]
+        width = max(layer.in_features, layer.out_features)
+        return self.fusable(layer, adapter) and len(self.layers) * num_tokens * width <= MAX_FUSED_ELEMENTS
+
+    def adapter_output(self, layer, x: torch.Tensor, adapter: str) -> torch.Tensor:
+        """The adapter output of `layer` for the input `x` (not yet cast to the compute dtype of the adapter)."""
+        key = (adapter, torch.is_grad_enabled())
+        pending = self._pending.get(key)
+        if pending is not None:
+            x_ref, x_version, outputs = pending
+            if x_ref() is x and x._version == x_version and layer in outputs:
+                output = outputs.pop(layer)
+                if not outputs:
+                    del self._pending[key]
+                return output
+
+        vera_A, vera_B = layer._projections(adapter)
+        members = [
+            member
+            for member in self.layers
+            if self.fusable(member, adapter)
+            and member.r[adapter] == layer.r[adapter]
+            and member._projections(adapter)[0] is vera_A
+            and member._projections(adapter)[1] is vera_B
+            and member._compute_dtype(adapter) == layer._compute_dtype(adapter)
+        ]
+        if layer not in members:
+            members.append(layer)
+
+        dtype = layer._compute_dtype(adapter)
+        vera_A, vera_B = vera_A.to(dtype), vera_B.to(dtype)
+        lambda_c = torch.stack([member.vera_lambda_c[adapter].to(dtype) for member in members])
+        lambda_d = torch.stack([member.vera_lambda_d[adapter].to(dtype) for member in members])
+        lambda_b = torch.stack(
+            [member.vera_lambda_b[adapter].to(dtype) * member.scaling[adapter] for member in members]
+        )
+
+        flat_x = promotes_to(x, dtype).reshape(-1, x.shape[-1])
+        num_tokens, num_members = flat_x.shape[0], len(members)
+        # (k * N, in) @ (in, r), with the lambda_c of every member applied to its copy of the input
+        after_A = ((flat_x * lambda_c.unsqueeze(1)).flatten(0, 1) @ vera_A.T).view(num_members, num_tokens, -1)
+        # (k * N, r) @ (r, out), then the lambda_b and scaling of every member
+        after_A = after_A * lambda_d.unsqueeze(1)
+        after_B = (after_A.flatten(0, 1) @ vera_B.T).view(num_members, num_tokens, -1)
+        after_B = after_B * lambda_b.unsqueeze(1)
+
+        outputs = {member: after_B[i].view(*x.shape[:-1], -1) for i, member in enumerate(members)}
+        output = outputs.pop(layer)
+        if outputs and not x.is_inference():
+            self._pending[key] = (weakref.ref(x), x._version, outputs)
+        else:
+            self._pending.pop(key, None)
+        return output
+
+    def clear(self) -> None:
+        self._pending.clear()
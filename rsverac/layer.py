@@ -14,6 +14,7 @@
 # limitations under the License.
 import math
 import warnings
+from abc import abstractmethod
 from typing import List, Optional, Union
 
 import torch
@@ -23,9 +24,13 @@ import torch.nn.functional as F
 from transformers.pytorch_utils import Conv1D
 
 from peft.tuners.tuners_utils import BaseTunerLayer
-from peft.utils.other import transpose
+from utils.precision import PrecisionPolicy, promotes_to
 
 from .buffer_dict import BufferDict
+from .counter_rng import counter_projection
+from .delta import delta_weight, is_blocked
+from .functional import vera_linear
+from .fused import SiblingGroup
 
 
 class VeraLayer(BaseTunerLayer):
@@ -51,16 +56,25 @@ class VeraLayer(BaseTunerLayer):
         # Set to `None` otherwise to avoid computation with random weights
         self.vera_A = None
         self.vera_B = None
+        # PRNG keys of the embedding projections generated on the fly, see `Embedding`
+        self.projection_prng_key = {}
+        # the `PrecisionPolicy` of every adapter, see `set_precision_policy`
+        self.precision_policy = {}
 
         # Mark the weight as unmerged
         self._disable_adapters = False
         self.merged_adapters = []
+        # the active adapters as plain tensors, read by the forward in the frozen topology mode, see `freeze_topology`
+        self._frozen = None
+        self._frozen_num_tokens = None
 
         base_layer = self.get_base_layer()
         if isinstance(base_layer, nn.Linear):
             in_features, out_features = base_layer.in_features, base_layer.out_features
         elif isinstance(base_layer, nn.Embedding):
             in_features, out_features = base_layer.num_embeddings, base_layer.embedding_dim
+        elif isinstance(base_layer, nn.Conv2d):
+            in_features, out_features = base_layer.in_channels, base_layer.out_channels
         elif isinstance(base_layer, Conv1D):
             in_features, out_features = (
                 base_layer.weight.ds_shape if hasattr(base_layer.weight, "ds_shape") else base_layer.weight.shape
@@ -73,6 +87,54 @@ class VeraLayer(BaseTunerLayer):
     @property
     def merged(self) -> bool:
         return bool(self.merged_adapters)
+
+    def freeze_topology(self, num_tokens: Optional[int] = None) -> None:
+        """
+        Snapshots the tensors of the active adapters, so that the forward reads them from a plain tuple instead of
+        looking them up per adapter, without checks nor dropout. See `VeraModel.freeze_topology`.
+
+        Args:
+            num_tokens (`int`, *optional*):
+                Expected number of tokens per call, only used by the `Linear` layers. Defaults to `None`.
+        """
+        if self.merged:
+            raise ValueError("The topology of a merged layer cannot be frozen, unmerge it first.")
+        adapters = [] if self.disable_adapters else [a for a in self.active_adapters if a in self.vera_lambda_d]
+        if adapters and (self.vera_A is None or self.vera_B is None):
+            msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
+            raise ValueError(msg)
+        self._frozen = tuple(self._frozen_adapter(adapter) for adapter in adapters)
+        self._frozen_num_tokens = num_tokens
+
+    def unfreeze_topology(self) -> None:
+        self._frozen = None
+
+    @abstractmethod
+    def _frozen_adapter(self, adapter: str) -> tuple:
+        """The tensors and constants of `adapter` read by the forward once the topology is frozen."""
+
+    def set_precision_policy(self, adapter: str, policy: PrecisionPolicy) -> None:
+        """
+        Sets the precision policy of `adapter` and casts its lambdas to the storage dtype. The shared projections are
+        cast to the compute dtype by `VeraModel`, see `VeraConfig.precision_policy`.
+        """
+        self.precision_policy[adapter] = policy
+        if policy.storage_dtype is None:
+            return
+        for name in self.adapter_layer_names:
+            lambdas = getattr(self, name)
+            if adapter in lambdas and lambdas[adapter].dtype != policy.storage_dtype:
+                lambdas[adapter].data = lambdas[adapter].data.to(policy.storage_dtype)
+
+    def _compute_dtype(self, adapter: str) -> torch.dtype:
+        # the dtype of the adapter GEMMs, the one of the lambdas by default
+        dtype = self.vera_lambda_d[adapter].dtype
+        policy = self.precision_policy.get(adapter)
+        return dtype if policy is None else policy.compute(dtype)
+
+    def _accumulate_dtype(self, adapter: str) -> Optional[torch.dtype]:
+        policy = self.precision_policy.get(adapter)
+        return None if policy is None else policy.accumulate_dtype
     
     
     def update_layer(
@@ -99,10 +161,10 @@ class VeraLayer(BaseTunerLayer):
             vera_dropout_layer = nn.Identity()
 
         self.vera_dropout.update(nn.ModuleDict({adapter_name: vera_dropout_layer}))
-        # Actual trainable parameters
+        # Actual trainable parameters, lambda_c scales the input features
         self.vera_lambda_b[adapter_name] = nn.Parameter(torch.ones(self.out_features), requires_grad=True)
         self.vera_lambda_d[adapter_name] = nn.Parameter(torch.ones(r), requires_grad=True)
-        self.vera_lambda_c[adapter_name] = nn.Parameter(torch.ones(self.out_features), requires_grad=True)
+        self.vera_lambda_c[adapter_name] = nn.Parameter(torch.ones(self.in_features), requires_grad=True)
         if use_rsvera:
             self.scaling[adapter_name] = vera_alpha / math.sqrt(r)
         else:
@@ -143,11 +205,18 @@ class VeraLayer(BaseTunerLayer):
         use_rsvera,
         d_initial: float = 1.0,
         c_initial: float = 1.0,
+        projection_prng_key: Optional[int] = None,
     ):
         if r <= 0:
             raise ValueError(f"`r` should be a positive integer value but the value passed is {r}")
+        if adapter_name not in vera_A and projection_prng_key is None:
+            raise ValueError(
+                f"No `vera_A` projection for {adapter_name}, a `projection_prng_key` is needed to generate it."
+            )
         self.r[adapter_name] = r
         self.vera_alpha[adapter_name] = vera_alpha
+        if adapter_name not in vera_A:
+            self.projection_prng_key[adapter_name] = projection_prng_key
         if vera_dropout > 0.0:
             vera_dropout_layer = nn.Dropout(p=vera_dropout)
         else:
@@ -177,7 +246,8 @@ class VeraLayer(BaseTunerLayer):
         weight = getattr(self.get_base_layer(), "weight", None)
         if weight is not None:
             # the layer is already completely initialized, this is an update
-            self.to(self.weight.device, dtype=weight.dtype)
+            self.to(weight.device, dtype=weight.dtype)
+        self.set_adapter(self.active_adapters)
 
     def reset_vera_parameters(self, adapter_name, d_initial: float = 1.0, c_initial: float = 1.0):
         if adapter_name in self.vera_lambda_d.keys():
@@ -200,7 +270,16 @@ class VeraLayer(BaseTunerLayer):
 
 
 class Linear(nn.Linear, VeraLayer):
-    # Vera implemented in a dense layer
+    # Vera implemented in a dense layer.
+    # With `memory_efficient_backward`, the adapter branch goes through `VeraLinearFunction` when gradients are
+    # enabled: only the input is kept for the backward, the rank `r` projections are recomputed.
+    # `execution_strategy` selects how the forward applies the adapters, see `select_execution_strategy`.
+    # With a `sibling_group`, the low rank branch is computed together with the sibling layers, see `SiblingGroup`.
+    # Once the topology is frozen, the forward is `_frozen_forward`, see `freeze_topology`.
+    # After `prune_ranks`, an adapter reads its own gathered sub-projections instead of the shared ones, see
+    # `_projections`.
+    other_param_names = VeraLayer.other_param_names + ("pruned_vera_A", "pruned_vera_B", "rank_indices")
+
     def __init__(
         self,
         base_layer,
@@ -216,6 +295,8 @@ class Linear(nn.Linear, VeraLayer):
         use_rsvera: bool = False,
         d_initial: float = 1.0,
         c_initial: float = 1.0,
+        memory_efficient_backward: bool = True,
+        execution_strategy: str = "low_rank",
         **kwargs,
     ) -> None:
         # this gets the init from nn.Linear's super perspective, i.e.
@@ -223,11 +304,27 @@ class Linear(nn.Linear, VeraLayer):
         super(nn.Linear, self).__init__()
         VeraLayer.__init__(self, base_layer, **kwargs)
         self.fan_in_fan_out = fan_in_fan_out
+        self.memory_efficient_backward = memory_efficient_backward
+        if execution_strategy not in ("auto", "low_rank", "dense", "merged"):
+            raise ValueError(f"Invalid execution_strategy: {execution_strategy}")
+        self.execution_strategy = execution_strategy
+        # the strategy of the last forward, and the (key, weight) of the `dense`/`merged` strategies
+        self.last_execution_strategy = None
+        self._cached_weight = None
+        self.sibling_group: Optional[SiblingGroup] = None
+        # the weight of the `merged` or `dense` strategy frozen by `freeze_topology`
+        self._frozen_merged_weight = None
+        self._frozen_delta_weight = None
+        # the rank components of the shared projections kept by `prune_ranks`, and their contiguous copies
+        self.rank_indices = {}
+        self.pruned_vera_A = BufferDict({}, persistent=False)
+        self.pruned_vera_B = BufferDict({}, persistent=False)
 
         self._active_adapter = adapter_name
         self.update_layer(adapter_name, vera_A, vera_B, r, vera_alpha, vera_dropout, init_vera_weights,use_rsvera, d_initial=d_initial, c_initial=c_initial)
         self.is_target_conv_1d_layer = is_target_conv_1d_layer
 
+    @torch.no_grad()
     def merge(
         self,
         adapter_names: Optional[List[str]] = None,
@@ -252,7 +349,11 @@ class Linear(nn.Linear, VeraLayer):
             )
 
         if adapter_names is None:
-            adapter_names = self.active_adapter
+            adapter_names = self.active_adapters
+        if not self.get_base_layer().weight.dtype.is_floating_point:
+            raise ValueError("Cannot merge into a quantized base layer, use `VeraModel.merge_and_unload`.")
+        # the frozen forward would add the merged adapters a second time
+        self.unfreeze_topology()
 
         for active_adapter in adapter_names:
             if active_adapter in self.vera_lambda_d.keys():
@@ -274,6 +375,7 @@ class Linear(nn.Linear, VeraLayer):
                     base_layer.weight.data += self.get_delta_weight(active_adapter)
                 self.merged_adapters.append(active_adapter)
 
+    @torch.no_grad()
     def unmerge(self) -> None:
         if not self.merged:
             warnings.warn("Already unmerged. Nothing to do.")
@@ -294,45 +396,480 @@ class Linear(nn.Linear, VeraLayer):
         if self.vera_A is None or self.vera_B is None:
             msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
             raise ValueError(msg)
-        vera_A = self.vera_A[adapter]
-        vera_B = self.vera_B[adapter]
-
-        device = vera_B.device
-        dtype = vera_B.dtype
-
-        # In case users wants to merge the adapter weights that are in
-        # float16 while being on CPU, we need to cast the weights to float32, perform the merge and then cast back to
-        # float16 because the `@` and matmul operation in general is not supported in torch + cpu + fp16.
-        cast_to_fp32 = device.type == "cpu" and dtype == torch.float16
+        return delta_weight(*self._delta_factors(adapter), scaling=self.scaling[adapter])
 
+    def _delta_factors(self, adapter) -> tuple:
+        # same as the forward: lambda_b scales the output features and lambda_c the input features. The product is
+        # laid out like the base weight, `(in_features, out_features)` for `fan_in_fan_out`, so that the delta comes
+        # out of the GEMM contiguous instead of as a transposed view of it
+        vera_A, vera_B = self._projections(adapter)
+        lambda_b = self.vera_lambda_b[adapter]
         lambda_d = self.vera_lambda_d[adapter]
         lambda_c = self.vera_lambda_c[adapter]
-        lambda_b = self.vera_lambda_b[adapter]
+        if self.fan_in_fan_out:
+            return vera_A.T, lambda_d, vera_B.T, lambda_c, lambda_b
+        return vera_B, lambda_d, vera_A, lambda_b, lambda_c
+
+    def _projections(self, adapter: str) -> tuple:
+        # the `(vera_A, vera_B)` of `adapter`: its sub-projections once pruned, the shared projections otherwise
+        if adapter in self.pruned_vera_A:
+            return self.pruned_vera_A[adapter], self.pruned_vera_B[adapter]
+        return self.vera_A[adapter], self.vera_B[adapter]
+
+    @torch.no_grad()
+    def prune_ranks(self, adapter: str, threshold: float) -> dict:
+        """
+        Drops the rank components of `adapter` that contribute little to its delta weight. Component `i` adds the rank
+        one matrix `scaling * lambda_d[i] * outer(lambda_b * vera_B[:, i], vera_A[i] * lambda_c)`, whose Frobenius
+        norm is its score, and is dropped when its score is below `threshold` times the largest one. The kept rows of
+        `vera_A` and columns of `vera_B` are gathered into contiguous projections of the layer, and `vera_lambda_d` and
+        `r` are reduced to the kept rank, the scaling is unchanged. The low rank branch then costs `kept_rank / rank`
+        of the full one.
 
-        if cast_to_fp32:
-            vera_A = vera_A.float()
-            vera_B = vera_B.float()
-            lambda_d = lambda_d.float()
-            lambda_c = lambda_c.float()
-            lambda_b = lambda_b.float()
+        Args:
+            adapter (`str`):
+                The name of the adapter to prune.
+            threshold (`float`):
+                Relative score, between 0 (nothing is dropped) and 1 (only the largest components are kept), below
+                which the rank components are dropped.
+
+        Returns a dict with the `rank` before pruning, the `kept_rank` and the `delta_rel_error`, the Frobenius error of
+        the pruned delta weight relative to the delta weight before pruning.
+        """
+        if not 0.0 <= threshold <= 1.0:
+            raise ValueError(f"`threshold` should be between 0 and 1 but the value passed is {threshold}")
+        if adapter in self.merged_adapters:
+            raise ValueError(f"Adapter {adapter} is merged, unmerge it before pruning its ranks.")
+        # the frozen tensors and the cached weights are those of the full rank
+        self.unfreeze_topology()
+        self._cached_weight = None
+
+        vera_A, vera_B = self._projections(adapter)
+        lambda_d = self.vera_lambda_d[adapter]
+        # the (out, r) and (r, in) factors of the rank one components, in float32
+        left = self.vera_lambda_b[adapter].float().unsqueeze(-1) * vera_B.float() * lambda_d.float()
+        left = left * self.scaling[adapter]
+        right = vera_A.float() * self.vera_lambda_c[adapter].float()
+        scores = left.norm(dim=0) * right.norm(dim=1)
+        kept = scores >= threshold * scores.max()
+        rank, kept_rank = len(scores), int(kept.sum())
+
+        # ||sum_i left_i right_i^T||^2 = sum_ij (left_i . left_j) (right_i . right_j), restricted to the dropped ones
+        products = (left.T @ left) * (right @ right.T)
+        dropped = ~kept
+        dropped_norm = products[dropped][:, dropped].sum().clamp_min(0)
+        total_norm = products.sum()
+        error = (dropped_norm / total_norm).sqrt().item() if total_norm > 0 else 0.0
+
+        if kept_rank < rank:
+            keep = kept.nonzero().squeeze(-1)
+            self.pruned_vera_A[adapter] = vera_A[keep].contiguous()
+            self.pruned_vera_B[adapter] = vera_B[:, keep].contiguous()
+            self.vera_lambda_d[adapter] = nn.Parameter(lambda_d[keep], requires_grad=lambda_d.requires_grad)
+            # indices into the shared projections, across successive prunings
+            previous = self.rank_indices.get(adapter)
+            self.rank_indices[adapter] = keep if previous is None else previous[keep]
+            self.r[adapter] = kept_rank
+        return {"rank": rank, "kept_rank": kept_rank, "delta_rel_error": error}
+
+    def select_execution_strategy(self, num_tokens: int) -> str:
+        """
+        Selects how `forward` applies the active adapters to `num_tokens` tokens:
+
+        - `low_rank`: the two projections, `r * (in_features + out_features)` FLOPs per token and adapter.
+        - `dense`: the delta weight of the active adapters, cached, is applied to the input and added to the output of
+          the base layer, `in_features * out_features` FLOPs per token.
+        - `merged`: a cached copy of the base weight with the delta weight merged in replaces the base layer, the
+          adapters cost nothing per token.
+
+        Building the cached weight costs `r * in_features * out_features` FLOPs per adapter, and it is rebuilt whenever
+        a lambda, the scaling, the active adapters or the base weight change. When gradients are needed for the
+        lambdas, or dropout is active, only `low_rank` is correct and is always selected. Otherwise a fixed
+        `execution_strategy` is used as is, and `auto` selects `low_rank` as long as it is cheaper than `dense`: per
+        token in eval mode, where the cached weight outlives the call, and including the cost of a stale cached weight
+        in training mode, where the lambdas are about to change. `auto` prefers `merged` to `dense`. When the base
+        layer has no floating point weight to merge into, `dense` is used instead of `merged`, whichever the
+        `execution_strategy`.
+
+        Both cached weights are as large as the base weight: `dense` and `merged` keep one more copy of it per layer,
+        until the strategy or the cached weight changes, or the layer is trained again.
+        """
+        adapters = [adapter for adapter in self.active_adapters if adapter in self.vera_lambda_d]
+        if not adapters:
+            return "low_rank"
+        if torch.is_grad_enabled() and any(
+            getattr(self, name)[adapter].requires_grad for name in self.adapter_layer_names for adapter in adapters
+        ):
+            return "low_rank"
+        if self.training and any(not isinstance(self.vera_dropout[adapter], nn.Identity) for adapter in adapters):
+            return "low_rank"
+        # there is no floating point weight to merge into, e.g. an `Int8Linear` base layer
+        mergeable = self.get_base_layer().weight.dtype.is_floating_point
+        if self.execution_strategy != "auto":
+            return "dense" if self.execution_strategy == "merged" and not mergeable else self.execution_strategy
+
+        rank = sum(self.r[adapter] for adapter in adapters)
+        low_rank_flops = num_tokens * rank * (self.in_features + self.out_features)
+        dense_flops = num_tokens * self.in_features * self.out_features
+        strategy = "merged" if mergeable else "dense"
+        if self.training and (self._cached_weight is None or self._cached_weight[0] != self._cache_key(strategy)):
+            dense_flops += rank * self.in_features * self.out_features
+        return strategy if dense_flops < low_rank_flops else "low_rank"
+
+    def _cache_key(self, strategy: str) -> tuple:
+        adapters = [adapter for adapter in self.active_adapters if adapter in self.vera_lambda_d]
+        weight = self.get_base_layer().weight
+        # in-place updates of the lambdas (optimizer steps, `load_state_dict`) bump their version
+        lambda_versions = tuple(
+            getattr(self, name)[adapter]._version for name in self.adapter_layer_names for adapter in adapters
+        )
+        projections = tuple(tuple(map(id, self._projections(adapter))) for adapter in adapters)
+        scalings = tuple(self.scaling[adapter] for adapter in adapters)
+        compute_dtypes = tuple(self._compute_dtype(adapter) for adapter in adapters)
+        # `.to()`, `.half()`, ... swap the tensors of the parameters through `param.data`, which keeps their id and
+        # version, the device and dtype tell the moved or cast weight apart
+        base_weight = (id(weight), weight._version, weight.device, weight.dtype)
+        if strategy != "merged":
+            base_weight = base_weight[2:]
+        return strategy, tuple(adapters), lambda_versions, projections, scalings, compute_dtypes, base_weight
+
+    def _get_cached_weight(self, strategy: str) -> torch.Tensor:
+        # the summed delta weights of the active adapters (`dense`), or the base weight they are merged into (`merged`)
+        key = self._cache_key(strategy)
+        if self._cached_weight is None or self._cached_weight[0] != key:
+            # the previous weight is released before the new one is built
+            self._cached_weight = None
+            with torch.no_grad():
+                weight = sum(self.get_delta_weight(adapter) for adapter in key[1])
+                # the merged weight replaces the base weight, the delta weight is applied like the adapter GEMMs
+                if strategy == "merged":
+                    base_weight = self.get_base_layer().weight
+                    weight = (weight + base_weight).to(base_weight.dtype)
+                else:
+                    weight = weight.to(self._compute_dtype(key[1][0]))
+            self._cached_weight = (key, weight)
+        return self._cached_weight[1]
 
-        lambda_b = lambda_b.unsqueeze(-1)
-        lambda_d = lambda_d.unsqueeze(-1)
-        lambda_c = lambda_c.unsqueeze(-1)
-        output_tensor = transpose((lambda_b * vera_B) @ (lambda_d * vera_A) * lambda_c, self.fan_in_fan_out)
+    def _apply_weight(self, x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None):
+        # `weight` has the layout of the base weight, `(in_features, out_features)` for `fan_in_fan_out`
+        return F.linear(x.to(weight.dtype), weight.T if self.fan_in_fan_out else weight, bias)
 
-        if cast_to_fp32:
-            output_tensor = output_tensor.to(dtype=dtype)
+    def freeze_topology(self, num_tokens: Optional[int] = None) -> None:
+        """
+        Snapshots the active adapters, see `VeraLayer.freeze_topology`. With `num_tokens`, the layers for which
+        `select_execution_strategy(num_tokens)` picks the `merged` or `dense` strategy (evaluated here, without
+        gradients) freeze that weight instead; it is not updated with the lambdas until the topology is frozen again.
+        """
+        super().freeze_topology(num_tokens)
+        self._frozen_merged_weight = self._frozen_delta_weight = None
+        if num_tokens is None or not self._frozen:
+            return
+        with torch.no_grad():
+            strategy = self.select_execution_strategy(num_tokens)
+            if strategy == "low_rank":
+                return
+            weight = self._get_cached_weight(strategy)
+        if strategy == "merged":
+            self._frozen_merged_weight = weight
+        else:
+            self._frozen_delta_weight = weight
+        self._frozen = ()
+
+    def unfreeze_topology(self) -> None:
+        super().unfreeze_topology()
+        self._frozen_merged_weight = self._frozen_delta_weight = None
+
+    def _frozen_adapter(self, adapter: str) -> tuple:
+        return (
+            self.vera_lambda_b[adapter],
+            self.vera_lambda_d[adapter],
+            self.vera_lambda_c[adapter],
+            *self._projections(adapter),
+            self.scaling[adapter],
+            self._compute_dtype(adapter),
+            self._accumulate_dtype(adapter),
+        )
 
-            # cast back the weights
-            # TODO: why?
-            self.vera_lambda_d[adapter].data = lambda_d.to(dtype)
-            self.vera_lambda_b[adapter].data = lambda_b.to(dtype)
-            self.vera_lambda_c[adapter].data = lambda_c.to(dtype)
+    def _frozen_forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        # the attributes tested here are fixed until the topology is unfrozen, `torch.compile` guards on them
+        previous_dtype = x.dtype
+        if self._frozen_merged_weight is not None:
+            result = self._apply_weight(x, self._frozen_merged_weight, self.get_base_layer().bias)
+        else:
+            result = self.base_layer(x, *args, **kwargs)
+        if self._frozen_delta_weight is not None:
+            result = result + self._apply_weight(x, self._frozen_delta_weight)
+        for lambda_b, lambda_d, lambda_c, vera_A, vera_B, scaling, dtype, accumulate_dtype in self._frozen:
+            if accumulate_dtype is not None:
+                result = result.to(accumulate_dtype)
+            x = promotes_to(x, dtype)
+            after_A = lambda_d.to(dtype) * F.linear(x * lambda_c.to(dtype), vera_A.to(dtype))
+            result = result + (lambda_b.to(dtype) * F.linear(after_A, vera_B.to(dtype))) * scaling
+        return result.to(previous_dtype)
 
-        return output_tensor
+    def forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        if self._frozen is not None:
+            return self._frozen_forward(x, *args, **kwargs)
+        previous_dtype = x.dtype
+
+        if self.disable_adapters:
+            if self.merged:
+                self.unmerge()
+            result = self.base_layer(x, *args, **kwargs)
+        elif self.merged:
+            result = self.base_layer(x, *args, **kwargs)
+        else:
+            if self.vera_A is None or self.vera_B is None:
+                msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
+                raise ValueError(msg)
+
+            strategy = self.select_execution_strategy(x.numel() // x.shape[-1])
+            self.last_execution_strategy = strategy
+            if strategy == "low_rank" and torch.is_grad_enabled():
+                # training, the cached weight would only hold memory and go stale
+                self._cached_weight = None
+
+            if strategy == "merged":
+                result = self._apply_weight(x, self._get_cached_weight(strategy), self.get_base_layer().bias)
+                return result.to(previous_dtype)
+
+            result = self.base_layer(x, *args, **kwargs)
+            if strategy == "dense":
+                result = result + self._apply_weight(x, self._get_cached_weight(strategy))
+                return result.to(previous_dtype)
+
+            # the siblings recognise the input they share by identity, before any cast
+            layer_input = x
+            for active_adapter in self.active_adapters:
+                if active_adapter not in self.vera_lambda_d.keys():
+                    continue
+
+                accumulate_dtype = self._accumulate_dtype(active_adapter)
+                if accumulate_dtype is not None:
+                    result = result.to(accumulate_dtype)
+
+                if self.sibling_group is not None and self.sibling_group.applies(self, layer_input, active_adapter):
+                    result += self.sibling_group.adapter_output(self, layer_input, active_adapter)
+                    continue
+
+                # the lambdas are cast to the compute dtype rather than the input, which the product by lambda_c
+                # promotes, see `promotes_to`; the projections are already stored in it, the casts are no-ops
+                dtype = self._compute_dtype(active_adapter)
+                lambda_d = self.vera_lambda_d[active_adapter].to(dtype)
+                lambda_c = self.vera_lambda_c[active_adapter].to(dtype)
+                lambda_b = self.vera_lambda_b[active_adapter].to(dtype)
+
+                vera_A, vera_B = (projection.to(dtype) for projection in self._projections(active_adapter))
+
+                dropout = self.vera_dropout[active_adapter]
+                scaling = self.scaling[active_adapter]
+                x = promotes_to(x, dtype)
+                if self.memory_efficient_backward and torch.is_grad_enabled():
+                    result += vera_linear(dropout(x), lambda_b, lambda_d, lambda_c, vera_A, vera_B, scaling)
+                else:
+                    result += (
+                        lambda_b * F.linear(lambda_d * F.linear((dropout(x) * lambda_c), vera_A), vera_B)
+                    ) * scaling
+
+        result = result.to(previous_dtype)
+        return result
+
+
+class Conv2d(nn.Module, VeraLayer):
+    # Vera implemented in a conv2d layer.
+    # The shared projections are a frozen `(r, in_channels, *kernel_size)` convolution `vera_A`, with the stride,
+    # padding and dilation of the base layer, followed by a frozen `(out_channels, r, 1, 1)` convolution `vera_B`. They
+    # are shared by all the targeted convolutions of the same weight shape, and stored under `projection_keys[adapter]`
+    # in the `vera_A`/`vera_B` BufferDicts. `lambda_c`, `lambda_d` and `lambda_b` scale the input, rank and output
+    # channels.
+    def __init__(
+        self,
+        base_layer: nn.Module,
+        vera_A: BufferDict,
+        vera_B: BufferDict,
+        adapter_name: str,
+        projection_key: str,
+        r: int = 0,
+        vera_alpha: int = 1,
+        vera_dropout: float = 0.0,
+        init_vera_weights: Union[bool, str] = True,
+        use_rsvera: bool = False,
+        d_initial: float = 1.0,
+        c_initial: float = 1.0,
+        **kwargs,
+    ) -> None:
+        super().__init__()
+        VeraLayer.__init__(self, base_layer, **kwargs)
+        self.projection_keys = {}
+
+        self._active_adapter = adapter_name
+        self.update_layer(
+            adapter_name,
+            vera_A,
+            vera_B,
+            r,
+            vera_alpha,
+            vera_dropout,
+            init_vera_weights,
+            use_rsvera,
+            d_initial=d_initial,
+            c_initial=c_initial,
+            projection_key=projection_key,
+        )
+
+    def update_layer(
+        self,
+        adapter_name,
+        vera_A: BufferDict,
+        vera_B: BufferDict,
+        r,
+        vera_alpha,
+        vera_dropout,
+        init_vera_weights,
+        use_rsvera,
+        d_initial: float = 1.0,
+        c_initial: float = 1.0,
+        projection_key: Optional[str] = None,
+    ):
+        if self.get_base_layer().groups != 1:
+            raise ValueError("Vera `Conv2d` layers only support convolutions with `groups=1`.")
+        if projection_key not in vera_A or projection_key not in vera_B:
+            raise ValueError(f"No `vera_A`/`vera_B` projections {projection_key} for the adapter {adapter_name}.")
+        self.projection_keys[adapter_name] = projection_key
+        super().update_layer(
+            adapter_name,
+            vera_A,
+            vera_B,
+            r,
+            vera_alpha,
+            vera_dropout,
+            init_vera_weights,
+            use_rsvera,
+            d_initial=d_initial,
+            c_initial=c_initial,
+        )
+
+    def delete_adapter(self, adapter_name: str) -> None:
+        # the projections are stored under the projection key of the adapter rather than its name, which
+        # `BaseTunerLayer.delete_adapter` would leave behind. They belong to `adapter_name` only, see
+        # `VeraModel._get_conv_projection_key`
+        projection_key = self.projection_keys.pop(adapter_name, None)
+        super().delete_adapter(adapter_name)
+        if projection_key is not None:
+            for projections in (self.vera_A, self.vera_B):
+                if projections is not None and projection_key in projections:
+                    del projections[projection_key]
+
+    @torch.no_grad()
+    def merge(self, safe_merge: bool = False, adapter_names: Optional[List[str]] = None) -> None:
+        """
+        Merge the active adapter weights inside the base weights
+
+        Args:
+            safe_merge (`bool`, *optional*):
+                If True, the merge operation will be performed in a copy of the original weights and check for NaNs
+                before merging the weights. This is useful if you want to check if the merge operation will produce
+                NaNs. Defaults to `False`.
+            adapter_names (`List[str]`, *optional*):
+                The list of adapter names that should be merged. If None, all active adapters will be merged. Defaults
+                to `None`.
+        """
+        if self.merged:
+            warnings.warn(
+                f"Already following adapters were merged {','.join(self.merged_adapters)}. "
+                f"You are now additionally merging {','.join(self.active_adapters)}."
+            )
+
+        if adapter_names is None:
+            adapter_names = self.active_adapters
+        # the frozen forward would add the merged adapters a second time
+        self.unfreeze_topology()
+
+        for active_adapter in adapter_names:
+            if active_adapter in self.vera_lambda_d.keys():
+                base_layer = self.get_base_layer()
+                if safe_merge:
+                    # Note that safe_merge will be slower than the normal merge
+                    # because of the copy operation.
+                    orig_weights = base_layer.weight.data.clone()
+                    orig_weights += self.get_delta_weight(active_adapter)
+
+                    if not torch.isfinite(orig_weights).all():
+                        raise ValueError(
+                            f"NaNs detected in the merged weights. The adapter {active_adapter} seems to be broken"
+                        )
+                    base_layer.weight.data = orig_weights
+                else:
+                    base_layer.weight.data += self.get_delta_weight(active_adapter)
+                self.merged_adapters.append(active_adapter)
+
+    @torch.no_grad()
+    def unmerge(self) -> None:
+        if not self.merged:
+            warnings.warn("Already unmerged. Nothing to do.")
+            return
+        while len(self.merged_adapters) > 0:
+            active_adapter = self.merged_adapters.pop()
+            if active_adapter in self.vera_lambda_d.keys():
+                self.get_base_layer().weight.data -= self.get_delta_weight(active_adapter)
+
+    def get_delta_weight(self, adapter) -> torch.Tensor:
+        """
+        Compute the delta weight for the given adapter.
+
+        Args:
+            adapter (str):
+                The name of the adapter for which the delta weight should be computed.
+        """
+        if self.vera_A is None or self.vera_B is None:
+            msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
+            raise ValueError(msg)
+        projection_key = self.projection_keys[adapter]
+        vera_A = self.vera_A[projection_key]
+        vera_B = self.vera_B[projection_key]
+
+        # the 1x1 `vera_B` composed with the kxk `vera_A` is a single kxk convolution: an (out, r) @ (r, in * k * k)
+        # product of the flattened kernels, lambda_c scales the `k * k` columns of every input channel
+        lambda_c = self.vera_lambda_c[adapter].repeat_interleave(vera_A[0, 0].numel())
+        output_tensor = delta_weight(
+            vera_B.flatten(1),
+            self.vera_lambda_d[adapter],
+            vera_A.flatten(1),
+            self.vera_lambda_b[adapter],
+            lambda_c,
+            scaling=self.scaling[adapter],
+        )
+        return output_tensor.view(self.get_base_layer().weight.shape)
+
+    def _frozen_adapter(self, adapter: str) -> tuple:
+        projection_key = self.projection_keys[adapter]
+        return (
+            self.vera_lambda_b[adapter],
+            self.vera_lambda_d[adapter],
+            self.vera_lambda_c[adapter],
+            self.vera_A[projection_key],
+            self.vera_B[projection_key],
+            self.scaling[adapter],
+            self._compute_dtype(adapter),
+            self._accumulate_dtype(adapter),
+        )
+
+    def _frozen_forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        previous_dtype = x.dtype
+        result = self.base_layer(x, *args, **kwargs)
+        base_layer = self.get_base_layer()
+        for lambda_b, lambda_d, lambda_c, vera_A, vera_B, scaling, dtype, accumulate_dtype in self._frozen:
+            if accumulate_dtype is not None:
+                result = result.to(accumulate_dtype)
+            x = promotes_to(x, dtype)
+            after_A = base_layer._conv_forward(x * lambda_c.to(dtype).view(-1, 1, 1), vera_A.to(dtype), None)
+            after_B = F.conv2d(after_A * lambda_d.to(dtype).view(-1, 1, 1), vera_B.to(dtype))
+            result = result + after_B * (lambda_b.to(dtype) * scaling).view(-1, 1, 1)
+        return result.to(previous_dtype)
 
     def forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        if self._frozen is not None:
+            return self._frozen_forward(x, *args, **kwargs)
         previous_dtype = x.dtype
 
         if self.disable_adapters:
@@ -348,29 +885,43 @@ class Linear(nn.Linear, VeraLayer):
                 msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
                 raise ValueError(msg)
 
+            base_layer = self.get_base_layer()
             for active_adapter in self.active_adapters:
                 if active_adapter not in self.vera_lambda_d.keys():
                     continue
 
-                lambda_d = self.vera_lambda_d[active_adapter]
-                lambda_c = self.vera_lambda_c[active_adapter]
-                lambda_b = self.vera_lambda_b[active_adapter]
+                accumulate_dtype = self._accumulate_dtype(active_adapter)
+                if accumulate_dtype is not None:
+                    result = result.to(accumulate_dtype)
+
+                # as in `Linear`, the input is promoted by the product by lambda_c rather than cast
+                dtype = self._compute_dtype(active_adapter)
+                lambda_d = self.vera_lambda_d[active_adapter].to(dtype)
+                lambda_c = self.vera_lambda_c[active_adapter].to(dtype)
+                lambda_b = self.vera_lambda_b[active_adapter].to(dtype)
 
-                vera_A = self.vera_A[active_adapter]
-                vera_B = self.vera_B[active_adapter]
+                projection_key = self.projection_keys[active_adapter]
+                vera_A = self.vera_A[projection_key].to(dtype)
+                vera_B = self.vera_B[projection_key].to(dtype)
 
                 dropout = self.vera_dropout[active_adapter]
                 scaling = self.scaling[active_adapter]
-                x = x.to(lambda_d.dtype)
-                result += (lambda_b * F.linear(lambda_d * F.linear((dropout(x) * lambda_c), vera_A), vera_B)) * scaling
-                
+                x = promotes_to(x, dtype)
+                # `_conv_forward` applies the stride, padding (and padding mode) and dilation of the base layer
+                after_A = base_layer._conv_forward(dropout(x) * lambda_c.view(-1, 1, 1), vera_A, None)
+                after_B = F.conv2d(after_A * lambda_d.view(-1, 1, 1), vera_B)
+                result = result + after_B * (lambda_b * scaling).view(-1, 1, 1)
 
         result = result.to(previous_dtype)
         return result
 
 
 class Embedding(nn.Embedding, VeraLayer):
-    # Vera implemented in a Embedding layer
+    # Vera implemented in a Embedding layer.
+    # Without an entry in `vera_A` for the adapter, the `(r, num_embeddings)` projection is never materialised: the
+    # columns of the looked up token ids are generated on the fly from `projection_prng_key`, see `counter_projection`.
+    # With `unique_tokens`, the adapter branch is computed once per distinct token id of the input and gathered, so
+    # that its cost (forward and backward) scales with the number of distinct tokens instead of batch x seq.
     def __init__(
         self,
         base_layer,
@@ -378,17 +929,42 @@ class Embedding(nn.Embedding, VeraLayer):
         vera_B: BufferDict,
         adapter_name: str,
         r: int = 0,
+        vera_alpha: int = 1,
         vera_dropout: float = 0.0,
         use_rsvera: bool = False,
         d_initial: float = 1.0,
         c_initial: float = 1.0,
+        projection_prng_key: Optional[int] = None,
+        unique_tokens: bool = True,
         **kwargs,
     ) -> None:
         init_vera_weights = kwargs.pop("init_vera_weights", True)
+        # nn.Module.__init__ only, the weights are the ones of the base layer
+        super(nn.Embedding, self).__init__()
         VeraLayer.__init__(self, base_layer, **kwargs)
+
+        self.unique_tokens = unique_tokens
+        self._active_adapter = adapter_name
         self.update_layer_embedding(
-            adapter_name, vera_A, vera_B, r, vera_dropout, init_vera_weights, use_rsvera, d_initial=d_initial, c_initial=c_initial
+            adapter_name,
+            vera_A,
+            vera_B,
+            r,
+            vera_alpha,
+            vera_dropout,
+            init_vera_weights,
+            use_rsvera,
+            d_initial=d_initial,
+            c_initial=c_initial,
+            projection_prng_key=projection_prng_key,
         )
+
+    # the attributes of the base embedding, used by `_embed`
+    padding_idx = property(lambda self: self.get_base_layer().padding_idx)
+    max_norm = property(lambda self: self.get_base_layer().max_norm)
+    norm_type = property(lambda self: self.get_base_layer().norm_type)
+    scale_grad_by_freq = property(lambda self: self.get_base_layer().scale_grad_by_freq)
+    sparse = property(lambda self: self.get_base_layer().sparse)
     def update_layer(self, adapter_name, vera_A: BufferDict, vera_B: BufferDict, r, vera_alpha, vera_dropout, init_vera_weights, use_rsvera, d_initial: float = 1, c_initial: float = 1.0):
         if r <= 0:
             raise ValueError(f"`r` should be a positive integer value but the value passed is {r}")
@@ -401,7 +977,8 @@ class Embedding(nn.Embedding, VeraLayer):
             self.scaling[adapter_name] = vera_alpha / r
         #self.scaling[adapter_name] = vera_alpha / math.sqrt(r)
     
-    def merge(self, safe_merge: bool = False) -> None:
+    @torch.no_grad()
+    def merge(self, safe_merge: bool = False, adapter_names: Optional[List[str]] = None) -> None:
         """
         Merge the active adapter weights into the base weights
 
@@ -410,19 +987,28 @@ class Embedding(nn.Embedding, VeraLayer):
                 If True, the merge operation will be performed in a copy of the original weights and check for NaNs
                 before merging the weights. This is useful if you want to check if the merge operation will produce
                 NaNs. Defaults to `False`.
+            adapter_names (`List[str]`, *optional*):
+                The list of adapter names that should be merged. If None, all active adapters will be merged. Defaults
+                to `None`.
         """
         if self.merged:
             warnings.warn(
                 f"Already following adapters were merged {','.join(self.merged_adapters)}. "
                 f"You are now additionally merging {','.join(self.active_adapters)}."
             )
-        for active_adapter in self.active_adapters:
+
+        if adapter_names is None:
+            adapter_names = self.active_adapters
+        # the frozen forward would add the merged adapters a second time
+        self.unfreeze_topology()
+
+        for active_adapter in adapter_names:
             if active_adapter in self.vera_lambda_d.keys():
                 base_layer = self.get_base_layer()
                 if safe_merge:
                     # Note that safe_merge will be slower than the normal merge
                     # because of the copy operation.
-                    orig_weights = base_layer.weight.data.copy()
+                    orig_weights = base_layer.weight.data.clone()
                     orig_weights += self.get_delta_weight(active_adapter)
 
                     if not torch.isfinite(orig_weights).all():
@@ -435,6 +1021,7 @@ class Embedding(nn.Embedding, VeraLayer):
                     base_layer.weight.data += self.get_delta_weight(active_adapter)
                 self.merged_adapters.append(active_adapter)
 
+    @torch.no_grad()
     def unmerge(self) -> None:
         if not self.merged:
             warnings.warn("Already unmerged. Nothing to do.")
@@ -442,54 +1029,51 @@ class Embedding(nn.Embedding, VeraLayer):
         while len(self.merged_adapters) > 0:
             active_adapter = self.merged_adapters.pop()
             if active_adapter in self.vera_lambda_d.keys():
-                self.weight.data -= self.get_delta_weight(active_adapter)
+                self.get_base_layer().weight.data -= self.get_delta_weight(active_adapter)
 
-    def get_delta_weight(self, adapter) -> torch.Tensor:
+    def _projection(self, x: torch.Tensor, adapter: str) -> torch.Tensor:
+        """Columns of `vera_A` of the token ids `x`, with shape `(*x.shape, r)`."""
+        if adapter in self.vera_A:
+            return self._embed(x, self.vera_A[adapter].T)
+        return counter_projection(
+            self.projection_prng_key[adapter], x, self.r[adapter], dtype=self._compute_dtype(adapter)
+        )
+
+    def get_delta_weight(self, adapter, chunk_size: int = 4096) -> torch.Tensor:
         """
         Compute the delta weight for the given adapter.
 
         Args:
             adapter (str):
                 The name of the adapter for which the delta weight should be computed.
+            chunk_size (int):
+                Number of rows of the delta weight computed at once, this bounds the memory of the generated
+                projection columns.
         """
         if self.vera_A is None or self.vera_B is None:
             msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
             raise ValueError(msg)
 
-        vera_A = self.vera_A[adapter]
         vera_B = self.vera_B[adapter]
 
-        device = vera_A.device
-        dtype = vera_A.dtype
-
-        # In case users wants to merge the adapter weights that are in
-        # float16 while being on CPU, we need to cast the weights to float32, perform the merge and then cast back to
-        # float16 because the `@` and matmul operation in general is not supported in torch + cpu + fp16.
-        cast_to_fp32 = device.type == "cpu" and dtype == torch.float16
-
-        lambda_d = self.vera_lambda_d[adapter]
-        lambda_c = self.vera_lambda_c[adapter]
-        lambda_b = self.vera_lambda_b[adapter]
-
-        if cast_to_fp32:
-            vera_A = vera_A.float()
-            vera_B = vera_B.float()
-            lambda_d = lambda_d.float()
-            lambda_c = lambda_c.float()
-            lambda_b = lambda_b.float()
+        device = vera_B.device
+        dtype = vera_B.dtype
 
-        lambda_b = lambda_b.unsqueeze(-1)
-        lambda_d = lambda_d.unsqueeze(-1)
-        lambda_c = lambda_c.unsqueeze(-1)
-        output_tensor = transpose((lambda_b * vera_B) @ (lambda_d * vera_A) * lambda_c, True)
+        # as in `delta.delta_weight`, float16 and bfloat16 chunks are computed in float32 on CPU and written directly
+        # into the low precision output
+        compute_dtype = torch.float32 if is_blocked(vera_B) else dtype
 
-        if cast_to_fp32:
-            output_tensor = output_tensor.to(dtype=dtype)
+        lambda_d = self.vera_lambda_d[adapter].to(compute_dtype)
+        lambda_c = self.vera_lambda_c[adapter].to(compute_dtype)
+        lambda_b = self.vera_lambda_b[adapter].to(compute_dtype)
 
-            # cast back the weights
-            self.vera_lambda_d[adapter].data = lambda_d.to(dtype)
-            self.vera_lambda_c[adapter].data = lambda_c.to(dtype)
-            self.vera_lambda_b[adapter].data = lambda_b.to(dtype)
+        # same as the forward for every token id: lambda_b and lambda_c both scale the embedding dimension
+        right = (lambda_b * lambda_c * self.scaling[adapter]).unsqueeze(-1) * vera_B.to(compute_dtype)
+        output_tensor = torch.empty(self.in_features, self.out_features, dtype=dtype, device=device)
+        for start in range(0, self.in_features, chunk_size):
+            ids = torch.arange(start, min(start + chunk_size, self.in_features), device=device)
+            after_A = lambda_d * self._projection(ids, adapter).to(compute_dtype)
+            output_tensor[start : start + len(ids)] = after_A @ right.T
 
         return output_tensor
 
@@ -505,7 +1089,40 @@ class Embedding(nn.Embedding, VeraLayer):
             sparse=self.sparse,
         )
 
+    def _frozen_adapter(self, adapter: str) -> tuple:
+        # the looked up `vera_A` columns, or `None` to generate them from the PRNG key
+        table = self.vera_A[adapter].T if adapter in self.vera_A else None
+        return (
+            self.vera_lambda_b[adapter],
+            self.vera_lambda_d[adapter],
+            self.vera_lambda_c[adapter],
+            table,
+            self.projection_prng_key.get(adapter),
+            self.r[adapter],
+            self.vera_B[adapter],
+            self.scaling[adapter],
+            self._compute_dtype(adapter),
+            self._accumulate_dtype(adapter),
+        )
+
+    def _frozen_forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        # per position, without `unique_tokens`: `torch.unique` has a data-dependent output shape
+        result = self.base_layer(x, *args, **kwargs)
+        previous_dtype = result.dtype
+        for lambda_b, lambda_d, lambda_c, table, prng_key, r, vera_B, scaling, dtype, accumulate_dtype in self._frozen:
+            if accumulate_dtype is not None:
+                result = result.to(accumulate_dtype)
+            if table is None:
+                projection = counter_projection(prng_key, x, r, dtype=dtype)
+            else:
+                projection = self._embed(x, table.to(dtype))
+            after_B = (lambda_d.to(dtype) * projection) @ vera_B.to(dtype).T
+            result = result + (lambda_b.to(dtype) * after_B * lambda_c.to(dtype)) * scaling
+        return result.to(previous_dtype)
+
     def forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        if self._frozen is not None:
+            return self._frozen_forward(x, *args, **kwargs)
         if self.disable_adapters:
             if self.merged:
                 self.unmerge()
@@ -514,24 +1131,39 @@ class Embedding(nn.Embedding, VeraLayer):
             result = self.base_layer(x, *args, **kwargs)
         else:
             result = self.base_layer(x, *args, **kwargs)
+            # the embeddings keep the dtype of the base layer, whatever the compute and accumulate dtypes
+            previous_dtype = result.dtype
 
             if self.vera_A is None or self.vera_B is None:
                 msg = "Attempted to get reference to `vera_A` or `vera_B` but it was `None`! Ensure these are set using the `update_layer` methods"
                 raise ValueError(msg)
 
+            if self.unique_tokens:
+                # the adapter output only depends on the token id: compute it for the distinct ids, then gather
+                token_ids, inverse = torch.unique(x, return_inverse=True)
+            else:
+                token_ids = x
+
             for active_adapter in self.active_adapters:
                 if active_adapter not in self.vera_lambda_d:
                     continue
-                lambda_d = self.vera_lambda_d[active_adapter]
-                lambda_c = self.vera_lambda_c[active_adapter]
-                lambda_b = self.vera_lambda_b[active_adapter]
+                accumulate_dtype = self._accumulate_dtype(active_adapter)
+                if accumulate_dtype is not None:
+                    result = result.to(accumulate_dtype)
+
+                dtype = self._compute_dtype(active_adapter)
+                lambda_d = self.vera_lambda_d[active_adapter].to(dtype)
+                lambda_c = self.vera_lambda_c[active_adapter].to(dtype)
+                lambda_b = self.vera_lambda_b[active_adapter].to(dtype)
 
-                vera_A = self.vera_A[active_adapter]
-                vera_B = self.vera_B[active_adapter]
+                vera_B = self.vera_B[active_adapter].to(dtype)
                 scaling = self.scaling[active_adapter]
 
-                after_A = lambda_d * self._embed(x, vera_A.T)
-                result += (lambda_b * (after_A @ vera_B.T) * lambda_c) * scaling
-                
+                after_A = lambda_d * self._projection(token_ids, active_adapter).to(dtype)
+                adapter_output = (lambda_b * (after_A @ vera_B.T) * lambda_c) * scaling
+                if self.unique_tokens:
+                    adapter_output = F.embedding(inverse, adapter_output)
+                result = result + adapter_output
+            result = result.to(previous_dtype)
 
         return result
\ No newline at end of file
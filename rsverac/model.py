@@ -13,12 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
+import operator
 import warnings
-import re
-from dataclasses import asdict
+from dataclasses import asdict, replace
 from enum import Enum
-from itertools import chain
-from typing import List, Optional, Tuple, Union
+from functools import reduce
+from typing import Callable, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -26,22 +26,32 @@ from torch.nn.init import _calculate_correct_fan
 from tqdm import tqdm
 from transformers.pytorch_utils import Conv1D
 
-import pandas as pd
-
 from peft.tuners.tuners_utils import BaseTuner, BaseTunerLayer, check_target_module_exists
 from peft.utils import (
     TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING,
     ModulesToSaveWrapper,
+    _freeze_adapter,
     _get_submodules,
 )
 
+from utils.parallel import parallel_map
+from utils.precision import PrecisionPolicy
+from utils.profiler import ProfilingMixin
+from utils.registry import TunerLayerRegistry
+from utils.target_index import TargetModuleIndex, config_signature, module_keys
+
 TRANSFORMERS_MODELS_TO_VERA_TARGET_MODULES_MAPPING = TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING
 
 from .config import PeftConfig
 from peft.tuners.tuners_utils import _maybe_include_all_linear_layers
 from .buffer_dict import BufferDict
+from .combine_utils import VeraTerm, refit_lambdas, relative_error
 from .config import VeraConfig
-from .layer import Embedding, Linear, VeraLayer
+from .counter_rng import counter_projection
+from .delta import delta_weight, is_blocked
+from .fused import SiblingGroup
+from .layer import Conv2d, Embedding, Linear, VeraLayer
+from .quantization import Int8Linear
 
 
 def _kaiming_init(
@@ -73,7 +83,7 @@ def _kaiming_init(
         return tensor.uniform_(-bound, bound, generator=generator)
 
 
-class VeraModel(BaseTuner):
+class VeraModel(ProfilingMixin, BaseTuner):
     """
     Creates Vector-based Random Matrix Adaptation (Vera) model from a pretrained transformers model.
 
@@ -138,50 +148,86 @@ class VeraModel(BaseTuner):
 
         This will be used for determining the size of the shared vera_A and vera_B matrices.
 
-        This will throw an error if there are multiple layers of the same type with different shapes.
+        This will throw an error if there are multiple layers of the same type with different shapes. The `Conv2d`
+        layers are not constrained, their projections are created per weight shape, see `_get_conv_projection_key`.
         """
 
-        _check_for_modules_to_save = getattr(config, "modules_to_save", None) is not None
-
         model_config = getattr(self.model, "config", {"model_type": "custom"})
         if hasattr(model_config, "to_dict"):
             model_config = model_config.to_dict()
 
         peft_config = self._prepare_adapter_config(config, model_config)
         peft_config = _maybe_include_all_linear_layers(peft_config, self.model)
+        index = self._get_target_index(peft_config)
+
+        first_linear, first_embedding, has_conv = None, None, False
+        for key in index.matched_keys:
+            module = self.model.get_submodule(key)
+            # the adapters added after the first one find the layers already wrapped
+            if isinstance(module, BaseTunerLayer):
+                module = module.get_base_layer()
+            if isinstance(module, (nn.Linear, Conv1D)):
+                module_shape = tuple(module.weight.shape)
+                if isinstance(module, Conv1D):  # TODO: feels fragile, thoughts?
+                    module_shape = module_shape[::-1]
+
+                if first_linear is not None and module_shape != first_linear:
+                    raise ValueError(
+                        "Multiple target linear layers with different dimensions were specified! Vera only supports a"
+                        f" single dimension size. Got '{module_shape}' expected '{first_linear}"
+                    )
+                first_linear = module_shape
+
+            elif isinstance(module, nn.Embedding):
+                if first_embedding is not None and tuple(module.weight.shape) != first_embedding:
+                    raise ValueError(
+                        "Multiple target embedding layers with different dimensions or vocabulary sizes were"
+                        " specified! Vera only supports a single size."
+                    )
+                first_embedding = tuple(module.weight.shape)
 
-        first_linear, first_embedding = None, None
-        for key, module in self.model.named_modules():
-            if (
-                _check_for_modules_to_save
-                and any(key.endswith(f"{module_to_save}") for module_to_save in peft_config.modules_to_save)
-            ) or self._check_target_module_exists(peft_config, key):
-                if isinstance(module, (nn.Linear, Conv1D)):
-                    module_shape = tuple(module.weight.shape)
-                    if isinstance(module, Conv1D):  # TODO: feels fragile, thoughts?
-                        module_shape = module_shape[::-1]
-
-                    if first_linear is not None and module_shape != first_linear:
-                        raise ValueError(
-                            "Multiple target linear layers with different dimensions were specified! Vera only supports a"
-                            f" single dimension size. Got '{module_shape}' expected '{first_linear}"
-                        )
-                    first_linear = module_shape
-
-                elif isinstance(module, nn.Embedding):
-                    if first_embedding is not None and tuple(module.weight.shape) != first_embedding:
-                        raise ValueError(
-                            "Multiple target embedding layers with different dimensions or vocabulary sizes were"
-                            " specified! Vera only supports a single size."
-                        )
-                    first_embedding = tuple(module.weight.shape)
-
-        if first_linear is None and first_embedding is None:
+            elif isinstance(module, nn.Conv2d):
+                has_conv = True
+
+        if first_linear is None and first_embedding is None and not has_conv:
             msg = "No `VeraLayer`s were found in `self.model`, so cannot determine rank of projection matrices!"
             raise ValueError(msg)
 
         return first_linear, first_embedding
 
+    def _init_projections(self, config, adapter_name: str) -> None:
+        """
+        Creates the shared `vera_A`/`vera_B` projections, and `vera_embedding_B` (as well as `vera_embedding_A` for
+        the `dense` embedding projection), of `adapter_name` if it has none yet, when `inject_adapter` injects the
+        first adapter or one added later by `add_adapter` or `load_adapter` (a checkpoint saved with
+        `save_projection=True` then overwrites them). The projections are drawn deterministically, so the adapters of
+        the same rank share the same ones.
+        """
+        first_linear, first_embedding = self._find_first_dim(config)
+
+        # deterministic init of vera_A and vera_B if we know the key
+        generator = torch.Generator(device="cpu").manual_seed(1)
+        if first_linear is not None:
+            first_linear_out_dim, first_linear_in_dim = first_linear
+            # drawn even when they exist, so that the embedding projections are the same either way
+            vera_A = _kaiming_init((config.r, first_linear_in_dim), generator=generator)
+            vera_B = _kaiming_init((first_linear_out_dim, config.r), generator=generator)
+            if adapter_name not in self.vera_A:
+                self.vera_A[adapter_name] = vera_A
+                self.vera_B[adapter_name] = vera_B
+
+        # as above, but for embedding layer if at least one has been wrapped with Vera. The vocabulary sized
+        # projection is only materialised on request, otherwise the layers generate the columns they need.
+        if first_embedding is not None and adapter_name not in self.vera_embedding_B:
+            first_embedding_vocab_size, first_embedding_dim = first_embedding
+            vera_embedding_B = torch.randn((first_embedding_dim, config.r), generator=generator)
+            self.vera_embedding_B[adapter_name] = vera_embedding_B
+
+            if config.embedding_projection == "dense":
+                token_ids = torch.arange(first_embedding_vocab_size)
+                vera_embedding_A = counter_projection(config.projection_prng_key, token_ids, config.r).T.contiguous()
+                self.vera_embedding_A[adapter_name] = vera_embedding_A
+
     def __tuner_init__(self, model, peft_config, adapter_name: str) -> None:
         r"""
         Used for the separated init calls. This is used as a replacement for the `BaseTuner.__init__` call the only
@@ -227,13 +273,6 @@ class VeraModel(BaseTuner):
             msg = "`config.projection_prng_key` must not be `None` when using VeRA!"
             raise ValueError(msg)
 
-        first_linear, first_embedding = self._find_first_dim(config)
-
-        if first_embedding is not None:
-            first_embedding_vocab_size, first_embedding_dim = first_embedding
-        if first_linear is not None:
-            first_linear_out_dim, first_linear_in_dim = first_linear
-
         # use of persistent to exclude vera_A and vera_B from the state dict
         # if we choose not to save them.
         self.vera_A = BufferDict({}, persistent=config.save_projection)
@@ -242,33 +281,12 @@ class VeraModel(BaseTuner):
         self.vera_embedding_A = BufferDict({}, persistent=config.save_projection)
         self.vera_embedding_B = BufferDict({}, persistent=config.save_projection)
 
-        # deterministic init of vera_A and vera_B if we know the key
-        generator = torch.Generator(device="cpu").manual_seed(1)
-        if first_linear is not None:
-            vera_A = _kaiming_init((config.r, first_linear_in_dim), generator=generator)
-            vera_B = _kaiming_init((first_linear_out_dim, config.r), generator=generator)
-            
-            df = pd.DataFrame(vera_A.numpy())
-            #df.to_csv('vera_A_1.csv', index=False)
-            
-            df = pd.DataFrame(vera_B.numpy())
-            #df.to_csv('vera_B_1.csv', index=False)
-            
-            norm_vera_A = torch.norm(vera_A)
-            norm_vera_B = torch.norm(vera_B)
-            
-            self.vera_A[adapter_name] = vera_A
-            self.vera_B[adapter_name] = vera_B
-            
-        
-
-        # as above, but for embedding layer if at least one has been wrapped with Vera.
-        if first_embedding is not None:
-            vera_embedding_A = torch.randn((config.r, first_embedding_vocab_size), generator=generator)
-            vera_embedding_B = torch.randn((first_embedding_dim, config.r), generator=generator)
-
-            self.vera_embedding_A[adapter_name] = vera_embedding_A
-            self.vera_embedding_B[adapter_name] = vera_embedding_B
+        # the projections of the `Conv2d` layers, created per weight shape when the layers are injected
+        self.vera_conv_A = BufferDict({}, persistent=config.save_projection)
+        self.vera_conv_B = BufferDict({}, persistent=config.save_projection)
+        # the groups of sibling layers computed together, see `_group_siblings`
+        self._sibling_groups = []
+        # the projections of the adapter are created by `inject_adapter`, see `_init_projections`
 
         if not config.save_projection:
             warnings.warn(
@@ -281,7 +299,11 @@ class VeraModel(BaseTuner):
         # super(BaseTuner, self).__init__(model, config, adapter_name)
         self.__tuner_init__(model, config, adapter_name)
 
-        self.to(self.dtype)
+        # plain `nn.Module` backbones, e.g. torchvision ones, have no `dtype`, their layers already cast the adapters
+        dtype = getattr(self.model, "dtype", None)
+        if dtype is not None:
+            self.to(dtype)
+        self._apply_precision_policies()
 
     def _check_new_adapter_config(self, config: VeraConfig) -> None:
         """
@@ -306,6 +328,164 @@ class VeraModel(BaseTuner):
     def _check_target_module_exists(vera_config, key):
         return check_target_module_exists(vera_config, key)
 
+    def _get_layer_registry(self) -> TunerLayerRegistry:
+        """The Vera layers and `ModulesToSaveWrapper`s of the model, recorded when they are injected."""
+        if getattr(self, "_layer_registry", None) is None:
+            self._layer_registry = TunerLayerRegistry()
+        return self._layer_registry
+
+    def _get_target_index(self, vera_config) -> TargetModuleIndex:
+        """
+        Returns the targets of `vera_config`, with their rank and alpha. The index is cached per config signature, and
+        the module keys of the model are listed once per injection (see `inject_adapter`), as injecting adapters does
+        not change them.
+        """
+        if getattr(self, "_target_indexes", None) is None:
+            self._target_indexes = {}
+            self._module_keys = module_keys(self.model)
+        signature = config_signature(vera_config, "r", "vera_alpha")
+        if signature not in self._target_indexes:
+            self._target_indexes[signature] = TargetModuleIndex(
+                self._module_keys, vera_config, vera_config.r, vera_config.vera_alpha
+            )
+        return self._target_indexes[signature]
+
+    def _register_modules_to_save(self) -> None:
+        # `PeftModel` wraps the `modules_to_save` of the task (e.g. the SEQ_CLS `classifier`) after the injection and
+        # adds them to the config, their keys are resolved by the cached target indexes whenever the configs change
+        signature = tuple(config_signature(config, "r", "vera_alpha") for config in self.peft_config.values())
+
+        def keys():
+            indexes = [self._get_target_index(config) for config in self.peft_config.values()]
+            return [key for index in indexes for key in index.modules_to_save]
+
+        self._get_layer_registry().register_modules_to_save(self.model, keys, signature)
+
+    def _get_conv_projection_key(self, vera_config, adapter_name: str, r: int, target: nn.Module) -> str:
+        """
+        Returns the key of the `vera_conv_A`/`vera_conv_B` projections of `adapter_name` for a `Conv2d` of rank `r`
+        with the weight shape of `target`, and creates them on first use. All the targeted convolutions of the same
+        weight shape and rank share them: a `(r, in_channels, *kernel_size)` kernel `vera_A` and a `(out_channels, r,
+        1, 1)` kernel `vera_B`, drawn from `projection_prng_key` so that they can be restored without the checkpoint.
+        """
+        base_layer = target.get_base_layer() if isinstance(target, BaseTunerLayer) else target
+        weight_shape = tuple(base_layer.weight.shape)
+        projection_key = f"{adapter_name}_r{r}_" + "x".join(str(dim) for dim in weight_shape)
+        if projection_key not in self.vera_conv_A:
+            out_channels, in_channels, *kernel_size = weight_shape
+            generator = torch.Generator(device="cpu").manual_seed(vera_config.projection_prng_key)
+            self.vera_conv_A[projection_key] = _kaiming_init((r, in_channels, *kernel_size), generator=generator)
+            self.vera_conv_B[projection_key] = _kaiming_init((out_channels, r, 1, 1), generator=generator)
+        return projection_key
+
+    def inject_adapter(self, model: nn.Module, adapter_name: str):
+        r"""
+        Creates adapter layers and replaces the target modules with the adapter layers, like
+        `BaseTuner.inject_adapter`, but resolves the targets with the cached [`~utils.target_index.TargetModuleIndex`]
+        instead of matching every module of the model.
+
+        Args:
+            model (`nn.Module`):
+                The model to be tuned.
+            adapter_name (`str`):
+                The adapter name.
+        """
+        peft_config = self.peft_config[adapter_name]
+        self._check_new_adapter_config(peft_config)
+
+        model_config = getattr(model, "config", {"model_type": "custom"})
+        if hasattr(model_config, "to_dict"):
+            model_config = model_config.to_dict()
+
+        peft_config = self._prepare_adapter_config(peft_config, model_config)
+        self._prepare_model(peft_config, model)
+        peft_config = _maybe_include_all_linear_layers(peft_config, model)
+        # modules may have been added to the model since the last injection, the module keys are listed again
+        self._target_indexes = None
+        index = self._get_target_index(peft_config)
+        if index.targets:
+            self._init_projections(peft_config, adapter_name)
+
+        for key in index.modules_to_save:
+            parent, target, target_name = _get_submodules(model, key)
+            if not isinstance(target, ModulesToSaveWrapper):
+                new_module = ModulesToSaveWrapper(target, adapter_name)
+                setattr(parent, target_name, new_module)
+                self._get_layer_registry().register(key, new_module)
+            else:
+                target.update(adapter_name)
+
+        if not index.targets and not index.modules_to_save:
+            raise ValueError(
+                f"Target modules {peft_config.target_modules} not found in the base model. "
+                f"Please check the target modules and try again."
+            )
+        for key in index.targets:
+            self.targeted_module_names.append(key)
+            parent, target, target_name = _get_submodules(model, key)
+            self._create_and_replace(peft_config, adapter_name, target, target_name, parent, current_key=key)
+
+        self._mark_only_adapters_as_trainable(model)
+
+        if self.peft_config[adapter_name].inference_mode:
+            for n, p in model.named_parameters():
+                if adapter_name in n:
+                    p.requires_grad = False
+
+        if index.modules_to_save:
+            if not hasattr(model, "modules_to_save"):
+                model.modules_to_save = set(peft_config.modules_to_save)
+            else:
+                model.modules_to_save.update(set(peft_config.modules_to_save))
+
+        if peft_config.fuse_sibling_projections:
+            self._group_siblings()
+        # the layers of the new adapter cast all the adapters to the dtype of the base layers
+        self._apply_precision_policies()
+
+    def _apply_precision_policies(self) -> None:
+        """
+        Applies the `precision_policy` of every adapter, once its layers and projections have the dtype of the
+        backbone: the layers cast the lambdas to the storage dtype, and the shared projections of the adapter are cast
+        to the compute dtype here, once, rather than in every forward. See [`~utils.precision.PrecisionPolicy`].
+        """
+        layers = self._get_layer_registry().modules(VeraLayer)
+        for adapter, config in self.peft_config.items():
+            policy = PrecisionPolicy.from_dict(getattr(config, "precision_policy", None))
+            projections = [
+                (projections, adapter)
+                for projections in (self.vera_A, self.vera_B, self.vera_embedding_A, self.vera_embedding_B)
+            ]
+            for layer in layers:
+                if adapter not in layer.vera_lambda_d:
+                    continue
+                layer.set_precision_policy(adapter, policy)
+                if isinstance(layer, Conv2d):
+                    key = layer.projection_keys[adapter]
+                    projections += [(self.vera_conv_A, key), (self.vera_conv_B, key)]
+
+            dtype = policy.compute_dtype or policy.storage_dtype
+            for buffers, key in projections:
+                if dtype is not None and key in buffers and buffers[key].dtype != dtype:
+                    buffers[key] = buffers[key].to(dtype)
+
+    def _group_siblings(self) -> None:
+        """
+        Groups the Vera `Linear` layers by parent module and input size, e.g. the query, key and value of every
+        attention block, so that their low rank branches are computed together. See [`~fused.SiblingGroup`].
+        """
+        siblings = {}
+        for key, module in self._get_layer_registry().items():
+            if isinstance(module, Linear):
+                siblings.setdefault((key.rpartition(".")[0], module.in_features), []).append(module)
+        self._sibling_groups = []
+        for layers in siblings.values():
+            group = SiblingGroup(layers) if len(layers) > 1 else None
+            for layer in layers:
+                layer.sibling_group = group
+            if group is not None:
+                self._sibling_groups.append(group)
+
     def _create_and_replace(
         self,
         vera_config,
@@ -321,11 +501,9 @@ class VeraModel(BaseTuner):
 
         #r = vera_config.r
         #alpha = vera_config.vera_alpha
-        
-        pattern_keys = list(chain(vera_config.rank_pattern.keys(), vera_config.alpha_pattern.keys()))
-        target_name_key = next(filter(lambda key: re.match(f".*\.{key}$", current_key), pattern_keys), current_key)
-        r = vera_config.rank_pattern.get(target_name_key, vera_config.r)
-        alpha = vera_config.alpha_pattern.get(target_name_key, vera_config.vera_alpha)
+
+        index = self._get_target_index(vera_config)
+        r, alpha = index.targets.get(current_key) or index.rank_and_alpha(current_key)
         
         bias = hasattr(target, "bias") and target.bias is not None
         kwargs = {
@@ -355,9 +533,24 @@ class VeraModel(BaseTuner):
                 alpha,
                 vera_config.vera_dropout,
                 vera_config.init_vera_weights,
-                #vera_config.use_rsvera,
+                vera_config.use_rsvera,
+                d_initial=vera_config.d_initial,
+                c_initial=vera_config.c_initial,
+                projection_prng_key=vera_config.projection_prng_key,
+            )
+        elif isinstance(target, Conv2d):
+            target.update_layer(
+                adapter_name,
+                self.vera_conv_A,
+                self.vera_conv_B,
+                r,
+                alpha,
+                vera_config.vera_dropout,
+                vera_config.init_vera_weights,
+                vera_config.use_rsvera,
                 d_initial=vera_config.d_initial,
                 c_initial=vera_config.c_initial,
+                projection_key=self._get_conv_projection_key(vera_config, adapter_name, r, target),
             )
         elif isinstance(target, Linear):
             target.update_layer(
@@ -373,11 +566,21 @@ class VeraModel(BaseTuner):
                 c_initial=vera_config.c_initial,
             )
         else:
-            new_module = self._create_new_module(vera_config, self.vera_A, self.vera_B, adapter_name, target, **kwargs)
+            if isinstance(target, nn.Embedding):
+                vera_A, vera_B = self.vera_embedding_A, self.vera_embedding_B
+            elif isinstance(target, nn.Conv2d):
+                vera_A, vera_B = self.vera_conv_A, self.vera_conv_B
+                kwargs["projection_key"] = self._get_conv_projection_key(vera_config, adapter_name, r, target)
+            else:
+                vera_A, vera_B = self.vera_A, self.vera_B
+                if vera_config.quantize_backbone == "int8" and type(target) is nn.Linear:
+                    target = Int8Linear.from_float(target)
+            new_module = self._create_new_module(vera_config, vera_A, vera_B, adapter_name, target, **kwargs)
             if adapter_name != self.active_adapter:
                 # adding an additional adapter: it is not automatically trainable
                 new_module.requires_grad_(False)
             self._replace_module(parent, target_name, new_module, target)
+        self._get_layer_registry().register(current_key, getattr(parent, target_name))
 
     @staticmethod
     def _replace_module(parent, child_name, new_module, child):
@@ -446,8 +649,22 @@ class VeraModel(BaseTuner):
                 adapter_name,
                 d_initial=vera_config.d_initial,
                 c_initial=vera_config.c_initial,
+                projection_prng_key=vera_config.projection_prng_key,
+                unique_tokens=vera_config.embedding_unique_tokens,
                 **embedding_kwargs,
             )
+        elif isinstance(target_base_layer, torch.nn.Conv2d):
+            conv_kwargs = kwargs.copy()
+            conv_kwargs.pop("fan_in_fan_out", None)
+            new_module = Conv2d(
+                target,
+                vera_A,
+                vera_B,
+                adapter_name,
+                d_initial=vera_config.d_initial,
+                c_initial=vera_config.c_initial,
+                **conv_kwargs,
+            )
         else:
             if isinstance(target_base_layer, torch.nn.Linear):
                 if kwargs["fan_in_fan_out"]:
@@ -467,7 +684,7 @@ class VeraModel(BaseTuner):
             else:
                 raise ValueError(
                     f"Target module {target} is not supported. Currently, only the following modules are supported: "
-                    "`torch.nn.Linear`, `torch.nn.Embedding`, `transformers.pytorch_utils.Conv1D`."
+                    "`torch.nn.Linear`, `torch.nn.Embedding`, `torch.nn.Conv2d`, `transformers.pytorch_utils.Conv1D`."
                 )
             new_module = Linear(
                 target,
@@ -477,11 +694,22 @@ class VeraModel(BaseTuner):
                 bias=bias,
                 d_initial=vera_config.d_initial,
                 c_initial=vera_config.c_initial,
+                memory_efficient_backward=vera_config.memory_efficient_backward,
+                execution_strategy=vera_config.execution_strategy,
                 **kwargs,
             )
 
         return new_module
 
+    def forward(self, *args, **kwargs):
+        try:
+            return self.model.forward(*args, **kwargs)
+        finally:
+            # the outputs kept for siblings that were not called on the same input, e.g. a cross-attention key and
+            # value, would otherwise keep their autograd graph alive until the group runs again
+            for group in self._sibling_groups:
+                group.clear()
+
     def __getattr__(self, name: str):
         """Forward missing attributes to the wrapped module."""
         try:
@@ -499,9 +727,10 @@ class VeraModel(BaseTuner):
         return config
 
     def _set_adapter_layers(self, enabled=True):
-        for module in self.model.modules():
-            if isinstance(module, (BaseTunerLayer, ModulesToSaveWrapper)):
-                module.enable_adapters(enabled)
+        self.unfreeze_topology()
+        self._register_modules_to_save()
+        for module in self._get_layer_registry().modules((BaseTunerLayer, ModulesToSaveWrapper)):
+            module.enable_adapters(enabled)
 
     def enable_adapter_layers(self):
         self._set_adapter_layers(enabled=True)
@@ -518,12 +747,12 @@ class VeraModel(BaseTuner):
         self._set_adapter_layers(enabled=False)
 
     def set_adapter(self, adapter_name):
-        for module in self.model.modules():
-            if isinstance(module, VeraLayer):
-                if module.merged:
-                    warnings.warn("Adapter cannot be set when the model is merged. Unmerging t first.")
-                    module.unmerge()
-                module.set_adapter(adapter_name)
+        self.unfreeze_topology()
+        for module in self._get_layer_registry().modules(VeraLayer):
+            if module.merged:
+                warnings.warn("Adapter cannot be set when the model is merged. Unmerging t first.")
+                module.unmerge()
+            module.set_adapter(adapter_name)
 
     @staticmethod
     def _prepare_adapter_config(peft_config, model_config):
@@ -535,30 +764,439 @@ class VeraModel(BaseTuner):
             )
         return peft_config
 
+    def add_weighted_adapter(
+        self,
+        adapters,
+        weights,
+        adapter_name,
+        combination_type="linear",
+        refit_steps=10,
+        refit_tol=1e-4,
+    ) -> None:
+        """
+        This method adds a new adapter by combining the given adapters with the given weights, such that the new
+        adapter approximates `sum(weight * delta_weight)` of the given adapters in every Vera `Linear`. It only works
+        on the lambda vectors and the shared projections, the delta weights are never materialised.
+
+        The combination is exact when all the adapters share `vera_lambda_b` and `vera_lambda_c` in a layer: the
+        `vera_lambda_d` are then summed (`linear`) or concatenated (`cat`). Otherwise, the lambdas of the new adapter
+        are refitted by alternating least squares, with a cost of `O((out + in) * r^2)` per layer and step, and a
+        warning reports the largest relative error of the refit.
+
+        Args:
+            adapters (`list`):
+                List of adapter names to be combined.
+            weights (`list`):
+                List of weights for each adapter.
+            adapter_name (`str`):
+                Name of the new adapter.
+            combination_type (`str`):
+                Type of combination. Can be one of [`linear`, `cat`]. `linear` reuses the projections of the first
+                adapter, all the adapters must then have the same `r` and the same projections. `cat` concatenates the
+                projections, the rank of the new adapter is the sum of all adapters ranks. The concatenated projections
+                cannot be restored from `projection_prng_key`, use `save_projection=True` to checkpoint such an
+                adapter.
+            refit_steps (`int`, *optional*):
+                Maximum number of alternating least squares steps of the refit. Defaults to 10.
+            refit_tol (`float`, *optional*):
+                The refit stops early once its relative error is below this value. Defaults to 1e-4.
+        """
+        if adapter_name in list(self.peft_config.keys()):
+            return
+        for adapter in adapters:
+            if adapter not in list(self.peft_config.keys()):
+                raise ValueError(f"Adapter {adapter} does not exist")
+            if adapter not in self.vera_A or adapter not in self.vera_B:
+                raise ValueError(
+                    f"Adapter {adapter} has no projections `vera_A`/`vera_B`, only the adapters of Vera `Linear` "
+                    "layers can be combined"
+                )
+            if any(adapter in module.rank_indices for module in self._get_layer_registry().modules(Linear)):
+                raise ValueError(f"Adapter {adapter} was pruned by `prune_ranks`, it cannot be combined")
+        if len(weights) != len(adapters):
+            raise ValueError("`weights` must have the same length as `adapters`")
+
+        # if there is only one adapter, the projections can always be reused
+        combination_type = "linear" if len(adapters) == 1 else combination_type
+
+        adapters_ranks = [self.peft_config[adapter].r for adapter in adapters]
+        if combination_type == "linear":
+            same_projections = all(
+                torch.equal(self.vera_A[adapter], self.vera_A[adapters[0]])
+                and torch.equal(self.vera_B[adapter], self.vera_B[adapters[0]])
+                for adapter in adapters
+            )
+            if not same_projections:
+                raise ValueError("All adapters must share their projections when using `linear` combination_type")
+            new_rank = adapters_ranks[0]
+            vera_A = self.vera_A[adapters[0]]
+            vera_B = self.vera_B[adapters[0]]
+        elif combination_type == "cat":
+            # adapters ranks may be different, new rank is sum of all ranks
+            new_rank = sum(adapters_ranks)
+            vera_A = torch.cat([self.vera_A[adapter] for adapter in adapters], dim=0)
+            vera_B = torch.cat([self.vera_B[adapter] for adapter in adapters], dim=1)
+        else:
+            raise ValueError(f"Invalid combination_type: {combination_type}")
+
+        target_module_types = [type(self.peft_config[adapter].target_modules) for adapter in adapters]
+        if len(set(target_module_types)) > 1:
+            raise ValueError(
+                "all adapter configs should follow the same target modules type. "
+                "Combining adapters with `target_modules` type being a mix of list/set and string is not supported."
+            )
+
+        if target_module_types[0] == str:
+            new_target_modules = "|".join(f"({self.peft_config[adapter].target_modules})" for adapter in adapters)
+        elif target_module_types[0] == set:
+            new_target_modules = reduce(
+                operator.or_, (self.peft_config[adapter].target_modules for adapter in adapters)
+            )
+        else:
+            raise TypeError(f"Invalid type {target_module_types[0]} found in target_modules")
+
+        self.peft_config[adapter_name] = replace(
+            self.peft_config[adapters[0]],
+            r=new_rank,
+            target_modules=new_target_modules,
+            rank_pattern={},
+        )
+        self.vera_A[adapter_name] = vera_A
+        self.vera_B[adapter_name] = vera_B
+        self.inject_adapter(self.model, adapter_name)
+        _freeze_adapter(self.model, adapter_name)
+
+        max_error = 0.0
+        for module in self._get_layer_registry().modules(VeraLayer):
+            if adapter_name not in module.vera_lambda_d:
+                continue
+            if not isinstance(module, Linear):
+                raise ValueError("`add_weighted_adapter` only supports Vera `Linear` layers.")
+            error = self._combine_layer_lambdas(
+                module, adapters, adapters_ranks, weights, adapter_name, combination_type, refit_steps, refit_tol
+            )
+            max_error = max(max_error, error)
+
+        if max_error > refit_tol:
+            warnings.warn(
+                f"The adapters could not be combined exactly, the lambdas of {adapter_name} were refitted with a "
+                f"relative error of up to {max_error:.2e}."
+            )
+
+    @staticmethod
+    def _combine_layer_lambdas(
+        target, adapters, adapters_ranks, weights, adapter_name, combination_type, refit_steps, refit_tol
+    ):
+        # all the computations are done in float32, on the device of the layer
+        def as_float(tensor):
+            return tensor.detach().float()
+
+        vera_A = as_float(target.vera_A[adapter_name])
+        vera_B = as_float(target.vera_B[adapter_name])
+        terms = []
+        for adapter, weight in zip(adapters, weights):
+            if adapter not in target.vera_lambda_d:
+                continue
+            terms.append(
+                VeraTerm(
+                    weight * target.scaling[adapter],
+                    as_float(target.vera_lambda_b[adapter]),
+                    as_float(target.vera_B[adapter]).to(vera_B.device),
+                    as_float(target.vera_lambda_d[adapter]),
+                    as_float(target.vera_A[adapter]).to(vera_A.device),
+                    as_float(target.vera_lambda_c[adapter]),
+                )
+            )
+
+        scaling = target.scaling[adapter_name]
+        if not terms:
+            lambda_b = torch.zeros_like(as_float(target.vera_lambda_b[adapter_name]))
+            lambda_d = torch.zeros(vera_A.shape[0], device=vera_A.device)
+            lambda_c = torch.zeros_like(as_float(target.vera_lambda_c[adapter_name]))
+            fit = VeraTerm(scaling, lambda_b, vera_B, lambda_d, vera_A, lambda_c)
+            error = 0.0
+        else:
+            # exact when lambda_b and lambda_c are shared, a weighted sum or a concatenation of the lambda_d
+            lambda_ds = [t.coef / scaling * t.lambda_d for t in terms]
+            if combination_type == "linear":
+                lambda_d = sum(lambda_ds)
+            else:
+                # adapters missing from this layer keep a zero block, of the rank of their config
+                blocks = {
+                    adapter: torch.zeros(rank, device=vera_A.device) for adapter, rank in zip(adapters, adapters_ranks)
+                }
+                present = [adapter for adapter in adapters if adapter in target.vera_lambda_d]
+                blocks.update(zip(present, (lambda_d.to(vera_A.device) for lambda_d in lambda_ds)))
+                lambda_d = torch.cat([blocks[adapter] for adapter in adapters])
+            lambda_b = torch.stack([t.lambda_b for t in terms]).mean(0)
+            lambda_c = torch.stack([t.lambda_c for t in terms]).mean(0)
+            fit = VeraTerm(scaling, lambda_b, vera_B, lambda_d, vera_A, lambda_c)
+            error = relative_error(terms, fit)
+            if error > refit_tol and refit_steps > 0:
+                for _ in range(refit_steps):
+                    fit, error = refit_lambdas(terms, fit, steps=1)
+                    if error <= refit_tol:
+                        break
+
+        with torch.no_grad():
+            target.vera_lambda_b[adapter_name].copy_(fit.lambda_b)
+            target.vera_lambda_d[adapter_name].copy_(fit.lambda_d)
+            target.vera_lambda_c[adapter_name].copy_(fit.lambda_c)
+        return error
+
+    def prune_ranks(self, threshold: float, adapter_name: Optional[str] = None) -> dict:
+        """
+        Post-training compaction of an adapter: in every Vera `Linear`, drops the rank components whose contribution
+        to the delta weight, `|lambda_d[i]|` weighted by the norms of the `lambda_b`-scaled column of `vera_B` and of
+        the `lambda_c`-scaled row of `vera_A`, is below `threshold` times the largest one of the layer. The layers then
+        use gathered, contiguous sub-projections of the kept rank, see [`Linear.prune_ranks`]. The `Conv2d` and
+        `Embedding` layers are left as they are.
+
+        Meant for inference: the pruned `vera_lambda_d` are new, smaller parameters, and the state dict of the adapter
+        can only be loaded into a model pruned the same way, so save the adapter before pruning it. A pruned adapter
+        cannot be combined by [`add_weighted_adapter`].
+
+        Args:
+            threshold (`float`):
+                Relative score below which the rank components are dropped, between 0 and 1.
+            adapter_name (`str`, *optional*):
+                The adapter to prune. Defaults to the active adapter.
+
+        Returns a dict with the `rank`, `kept_rank` and relative Frobenius `delta_rel_error` of the delta weight of
+        every pruned layer under `layers`, by module key, and the total `rank` and `kept_rank` of the pruned layers.
+        """
+        if adapter_name is None:
+            if len(self.active_adapters) != 1:
+                raise ValueError("Several adapters are active, pass the `adapter_name` to prune.")
+            adapter_name = self.active_adapters[0]
+        if adapter_name not in self.peft_config:
+            raise ValueError(f"Adapter {adapter_name} does not exist")
+
+        layers = {}
+        for key, module in self._get_layer_registry().items():
+            if isinstance(module, Linear) and adapter_name in module.vera_lambda_d:
+                layers[key] = module.prune_ranks(adapter_name, threshold)
+        # the pruned layers no longer share the projections of their siblings
+        for module in self._get_layer_registry().modules(Linear):
+            if module.sibling_group is not None:
+                module.sibling_group.clear()
+        return {
+            "rank": sum(report["rank"] for report in layers.values()),
+            "kept_rank": sum(report["kept_rank"] for report in layers.values()),
+            "layers": layers,
+        }
+
+    def execution_strategies(self) -> dict:
+        """
+        Returns the strategy (`low_rank`, `dense` or `merged`) of the last forward of every Vera `Linear`, by module
+        key, `None` for the layers that have not run yet. See [`Linear.select_execution_strategy`].
+        """
+        return {
+            key: module.last_execution_strategy
+            for key, module in self._get_layer_registry().items()
+            if isinstance(module, Linear)
+        }
+
+    def freeze_topology(self, num_tokens: Optional[int] = None) -> None:
+        """
+        Freezes the adapter topology for `torch.compile`: every Vera layer snapshots the tensors of its active
+        adapters into a plain tuple, and its forward becomes a straight sequence of tensor operations over them,
+        without adapter lookups, execution strategy selection, sibling fusion, checks nor dropout. The compiled graph
+        then only guards on these attributes and does not break on the layers. Meant for inference, e.g.
+
+        ```py
+        >>> model.eval()
+        >>> model.base_model.freeze_topology(num_tokens=batch_size * seq_len)
+        >>> compiled = torch.compile(model)
+        ```
+
+        Activating, enabling, disabling, deleting, merging or unloading adapters unfreezes the topology. The lambdas
+        are read at every call, except for the weights frozen for `num_tokens` (see [`Linear.freeze_topology`]), so
+        call `freeze_topology` again after updating them. Moving or casting the model (`.to()`, `.double()`, ...)
+        through the `PeftModel` or this model freezes the layers again with the moved tensors; after moving only a
+        submodule of the backbone, call `freeze_topology` again.
+
+        Args:
+            num_tokens (`int`, *optional*):
+                Expected number of tokens per call. When given, the `Linear` layers whose `execution_strategy` picks a
+                cached weight for that many tokens (`dense`, `merged`, or `auto` when faster) freeze that weight
+                instead. Defaults to `None`, i.e. the low rank branches.
+        """
+        for module in self._get_layer_registry().modules(VeraLayer):
+            module.freeze_topology(num_tokens)
+
+    def unfreeze_topology(self) -> None:
+        """Goes back to the regular forward of the Vera layers, see [`freeze_topology`]."""
+        for module in self._get_layer_registry().modules(VeraLayer):
+            module.unfreeze_topology()
+
+    def _apply(self, fn, *args, **kwargs):
+        # `.to()`, `.double()`, ... replace the projection buffers and the cached weights are left behind, the frozen
+        # layers would keep reading the tensors of before the move or cast
+        module = super()._apply(fn, *args, **kwargs)
+        for layer in self._get_layer_registry().modules(VeraLayer):
+            if isinstance(layer, Linear):
+                layer._cached_weight = None
+            if layer._frozen is not None:
+                layer.freeze_topology(layer._frozen_num_tokens)
+        return module
+
+    @staticmethod
+    def _batched_delta_weights(targets: List[Linear], adapter: str) -> torch.Tensor:
+        """
+        Computes the delta weights of `adapter` for `targets`, layers sharing the same projections, shapes and
+        `fan_in_fan_out`, in a single GEMM against the shared projection of the weight columns (`vera_A` for
+        `(out_features, in_features)` weights, `vera_B.T` for `fan_in_fan_out` ones). Returns a `(len(targets),
+        *weight.shape)` tensor whose `[i]` slice is the contiguous delta weight of `targets[i]`, already laid out like
+        its base weight.
+        """
+        vera_A, vera_B = targets[0]._projections(adapter)
+        dtype = vera_B.dtype
+        if is_blocked(vera_B):
+            # the float32 tiles of the low precision products are written layer by layer into the stacked output
+            weight = targets[0].get_base_layer().weight
+            delta = torch.empty((len(targets), *weight.shape), dtype=dtype, device=vera_B.device)
+            for i, target in enumerate(targets):
+                delta_weight(*target._delta_factors(adapter), scaling=target.scaling[adapter], out=delta[i])
+            return delta
+
+        lambda_b = torch.stack([target.vera_lambda_b[adapter] * target.scaling[adapter] for target in targets])
+        lambda_d = torch.stack([target.vera_lambda_d[adapter] for target in targets])
+        lambda_c = torch.stack([target.vera_lambda_c[adapter] for target in targets])
+        lambda_b, lambda_d, lambda_c = lambda_b.to(dtype), lambda_d.to(dtype), lambda_c.to(dtype)
+
+        # the (n, rows, r) left factors of all the layers, stacked so that one (n * rows, r) @ (r, columns) product
+        # covers them, the lambdas of the columns are applied to the product
+        if targets[0].fan_in_fan_out:
+            left, right = vera_A.T, vera_B.T
+            row_scales, column_scales = lambda_c, lambda_b
+        else:
+            left, right = vera_B, vera_A
+            row_scales, column_scales = lambda_b, lambda_c
+        left = row_scales.unsqueeze(-1) * left * lambda_d.unsqueeze(1)
+        delta = (left.flatten(0, 1) @ right).view(len(targets), left.shape[1], right.shape[1])
+        return delta.mul_(column_scales.unsqueeze(1))
+
+    def _batched_merge(
+        self,
+        targets: List[VeraLayer],
+        safe_merge: bool = False,
+        adapter_names: Optional[List[str]] = None,
+        chunk_size: int = 16,
+        num_workers: int = 1,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
+        """
+        Merges the adapters into `targets`. The `Linear` layers sharing an adapter, its projections and their weight
+        shape, dtype and device are merged together, `chunk_size` layers at a time to bound the memory of the stacked
+        delta weights. Other layers are merged one by one. The chunks and layers are merged by `num_workers` threads,
+        see [`~utils.parallel.parallel_map`].
+        """
+        groups = {}
+        others = []
+        for target in targets:
+            names = target.active_adapters if adapter_names is None else adapter_names
+            if not isinstance(target, Linear):
+                others.append((target, names))
+                continue
+            if target.merged:
+                warnings.warn(
+                    f"Already following adapters were merged {','.join(target.merged_adapters)}. "
+                    f"You are now additionally merging {','.join(names)}."
+                )
+            weight = target.get_base_layer().weight
+            for adapter in names:
+                if adapter not in target.vera_lambda_d:
+                    continue
+                vera_A, vera_B = target._projections(adapter)
+                key = (adapter, id(vera_A), id(vera_B), weight.shape, weight.dtype, weight.device)
+                groups.setdefault(key + (target.fan_in_fan_out,), []).append(target)
+
+        def merge_chunk(work):
+            adapter, chunk = work
+            if adapter is None:
+                target, names = chunk
+                target.merge(safe_merge=safe_merge, adapter_names=names)
+                return
+            with torch.no_grad():
+                delta = self._batched_delta_weights(chunk, adapter)
+                for i, target in enumerate(chunk):
+                    base_layer = target.get_base_layer()
+                    delta_weight = delta[i].to(base_layer.weight.dtype)
+                    if safe_merge:
+                        orig_weights = base_layer.weight.data + delta_weight
+                        if not torch.isfinite(orig_weights).all():
+                            raise ValueError(
+                                f"NaNs detected in the merged weights. The adapter {adapter} seems to be broken"
+                            )
+                        base_layer.weight.data = orig_weights
+                    else:
+                        base_layer.weight.data += delta_weight
+                    target.merged_adapters.append(adapter)
+
+        # a layer is in a single group per adapter, so the work of one round never touches the same weight twice. The
+        # adapters are merged round after round, in order.
+        rounds = {}
+        for (adapter, *_), group in groups.items():
+            for start in range(0, len(group), chunk_size):
+                rounds.setdefault(adapter, []).append((adapter, group[start : start + chunk_size]))
+        rounds = list(rounds.values())
+        if others:
+            rounds.insert(0, [(None, other) for other in others])
+
+        total = sum(len(works) for works in rounds)
+        done = 0
+
+        def callback(round_done, _):
+            if progress_callback is not None:
+                progress_callback(done + round_done, total)
+
+        for works in rounds:
+            parallel_map(merge_chunk, works, num_workers=num_workers, progress_callback=callback)
+            done += len(works)
+
     def _unload_and_optionally_merge(
         self,
         merge=True,
         progressbar: bool = False,
         safe_merge: bool = False,
         adapter_names: Optional[List[str]] = None,
+        merge_chunk_size: int = 16,
+        num_workers: int = 1,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
     ):
-        # we cannot use self.prefix as we want to include non-trainable vera parameters
-        key_list = [key for key, _ in self.model.named_modules() if "vera" not in key]
+        # the base layers are handed back to the user, they must not keep the profiling hooks
+        self.disable_profiling()
+        self.unfreeze_topology()
+        self._register_modules_to_save()
+        # the base layers are merged into and handed back in floating point
+        dtype = getattr(self.model, "dtype", torch.float32)
+        for target in self._get_layer_registry().modules(Linear):
+            if isinstance(target.base_layer, Int8Linear):
+                target.base_layer = target.base_layer.dequantize(dtype)
+        if merge:
+            targets = self._get_layer_registry().modules(VeraLayer)
+            self._batched_merge(
+                targets,
+                safe_merge=safe_merge,
+                adapter_names=adapter_names,
+                chunk_size=merge_chunk_size,
+                num_workers=num_workers,
+                progress_callback=progress_callback,
+            )
+
+        registry = self._get_layer_registry()
         desc = "Unloading " + ("and merging " if merge else "") + "model"
-        for key in tqdm(key_list, disable=not progressbar, desc=desc):
-            try:
-                parent, target, target_name = _get_submodules(self.model, key)
-            except AttributeError:
-                continue
+        for key, target in tqdm(registry.items(), disable=not progressbar, desc=desc):
+            parent, _, target_name = _get_submodules(self.model, key)
 
             if hasattr(target, "base_layer"):
-                if merge:
-                    target.merge(safe_merge=safe_merge, adapter_names=adapter_names)
-
                 self._replace_module(parent, target_name, target.get_base_layer(), target)
             elif isinstance(target, ModulesToSaveWrapper):
                 # save any additional trainable modules part of `modules_to_save`
                 setattr(parent, target_name, target.modules_to_save[target.active_adapter])
+        registry.clear()
+        self._sibling_groups = []
 
         return self.model
 
@@ -572,26 +1210,32 @@ class VeraModel(BaseTuner):
         if adapter_name not in list(self.peft_config.keys()):
             raise ValueError(f"Adapter {adapter_name} does not exist")
         del self.peft_config[adapter_name]
+        self.unfreeze_topology()
 
-        # we cannot use self.prefix as we want to include non-trainable vera parameters
-        key_list = [key for key, _ in self.model.named_modules() if "vera" not in key]
         new_adapter = None
-        for key in key_list:
-            _, target, _ = _get_submodules(self.model, key)
-            if isinstance(target, VeraLayer):
-                target.delete_adapter(adapter_name)
-                if new_adapter is None:
-                    new_adapter = target.active_adapter[:]
+        for target in self._get_layer_registry().modules(VeraLayer):
+            target.delete_adapter(adapter_name)
+            if new_adapter is None:
+                new_adapter = target.active_adapter[:]
 
         self.active_adapter = new_adapter or []
 
     def merge_and_unload(
-        self, progressbar: bool = False, safe_merge: bool = False, adapter_names: Optional[List[str]] = None
+        self,
+        progressbar: bool = False,
+        safe_merge: bool = False,
+        adapter_names: Optional[List[str]] = None,
+        merge_chunk_size: int = 16,
+        num_workers: int = 1,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
     ):
         r"""
         This method merges the Vera layers into the base model. This is needed if someone wants to use the base model
         as a standalone model.
 
+        The delta weights of the `Linear` layers sharing the same projections and weight shape are computed together,
+        with a single matrix product per chunk of `merge_chunk_size` layers.
+
         Args:
             progressbar (`bool`):
                 whether to show a progressbar indicating the unload and merge process
@@ -601,6 +1245,15 @@ class VeraModel(BaseTuner):
             adapter_names (`List[str]`, *optional*):
                 The list of adapter names that should be merged. If None, all active adapters will be merged. Defaults
                 to `None`.
+            merge_chunk_size (`int`):
+                Maximum number of layers whose delta weights are computed at once. The peak memory of the merge grows
+                linearly with it. Defaults to 16.
+            num_workers (`int`):
+                Number of threads merging the chunks of layers concurrently, every one of them using
+                `torch.get_num_threads() // num_workers` intra-op threads. The merged weights do not depend on the
+                scheduling of the layers. Defaults to 1, i.e. a serial merge.
+            progress_callback (`Callable[[int, int], None]`, *optional*):
+                Called as `progress_callback(done, total)` after every merged chunk. Defaults to `None`.
 
         Example:
 
@@ -615,7 +1268,12 @@ class VeraModel(BaseTuner):
         ```
         """
         return self._unload_and_optionally_merge(
-            progressbar=progressbar, safe_merge=safe_merge, adapter_names=adapter_names
+            progressbar=progressbar,
+            safe_merge=safe_merge,
+            adapter_names=adapter_names,
+            merge_chunk_size=merge_chunk_size,
+            num_workers=num_workers,
+            progress_callback=progress_callback,
         )
 
     def unload(self):
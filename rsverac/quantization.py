@@ -0,0 +1,118 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Int8 frozen base layers of the VeRA-plus `Linear` layers.
+
+VeRA-plus never updates the base weights, they are only needed for the forward and for the gradient of the input in
+the backward. `Int8Linear` holds them as int8 with one scale per output feature, a quarter of the float32 memory. On
+CPU both products run on `torch._int_mm` (int8 x int8 -> int32), the activations and output gradients being quantized
+on the fly with one scale per row; on the other devices the weight is dequantized for the product.
+"""
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+
+def quantize_rows(tensor: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization of the rows of a 2D tensor, returns the int8 values and the `(rows, 1)` scales."""
+    tensor = tensor.float()
+    # all-zero rows keep a positive scale, their values quantize to 0
+    scale = (tensor.abs().amax(dim=1, keepdim=True) / 127).clamp_min(torch.finfo(torch.float32).tiny)
+    return torch.mul(tensor, scale.reciprocal()).round_().clamp_(-127, 127).to(torch.int8), scale
+
+
+def _int8_mm(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    # float (n, k) @ int8 (k, m) -> float32 (n, m)
+    if a.device.type != "cpu":
+        return a.float() @ b.float()
+    a, a_scale = quantize_rows(a)
+    return torch._int_mm(a, b).float() * a_scale
+
+
+class Int8LinearFunction(torch.autograd.Function):
+    """`x @ (weight * weight_scale).T + bias` for a 2D `x` and an int8 `weight`, which gets no gradient."""
+
+    @staticmethod
+    def forward(ctx, x, weight, weight_scale, bias):
+        ctx.save_for_backward(weight, weight_scale)
+        ctx.has_bias = bias is not None
+        output = _int8_mm(x, weight.T) * weight_scale
+        if bias is not None:
+            output = output + bias
+        return output.to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight, weight_scale = ctx.saved_tensors
+        grad_x = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            # the scales of the output features are folded into the gradient before it is quantized
+            grad_x = _int8_mm(grad_output * weight_scale, weight).to(grad_output.dtype)
+        if ctx.has_bias and ctx.needs_input_grad[3]:
+            grad_bias = grad_output.sum(0)
+        return grad_x, None, None, grad_bias
+
+
+class Int8Linear(nn.Linear):
+    """
+    Frozen `nn.Linear` with an int8 `weight` and a float32 `weight_scale` per output feature, see
+    [`Int8LinearFunction`]. Build it from a floating point layer with `from_float`, and go back with `dequantize`.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, device=None, dtype=None) -> None:
+        # the float weight of `nn.Linear.__init__` is not allocated
+        nn.Module.__init__(self)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(
+            torch.zeros(out_features, in_features, dtype=torch.int8, device=device), requires_grad=False
+        )
+        self.register_buffer("weight_scale", torch.ones(out_features, device=device))
+        if bias:
+            self.bias = nn.Parameter(torch.zeros(out_features, device=device, dtype=dtype), requires_grad=False)
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear) -> "Int8Linear":
+        weight = linear.weight.detach()
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, device=weight.device)
+        with torch.no_grad():
+            weight, scale = quantize_rows(weight)
+            module.weight.copy_(weight)
+            module.weight_scale.copy_(scale.squeeze(1))
+            if linear.bias is not None:
+                module.bias = nn.Parameter(linear.bias.detach().clone(), requires_grad=linear.bias.requires_grad)
+        return module
+
+    def dequantize(self, dtype: torch.dtype = torch.float32) -> nn.Linear:
+        """Returns a floating point `nn.Linear` with the dequantized weight."""
+        linear = nn.Linear(
+            self.in_features, self.out_features, bias=self.bias is not None, device=self.weight.device, dtype=dtype
+        )
+        with torch.no_grad():
+            linear.weight.copy_(self.weight.float() * self.weight_scale.float().unsqueeze(1))
+            if self.bias is not None:
+                linear.bias.copy_(self.bias)
+        linear.weight.requires_grad_(False)
+        if self.bias is not None:
+            linear.bias.requires_grad_(self.bias.requires_grad)
+        return linear
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # the leading dimensions are flattened outside of the function: its outputs must not be views
+        output = Int8LinearFunction.apply(x.reshape(-1, x.shape[-1]), self.weight, self.weight_scale, self.bias)
+        return output.view(*x.shape[:-1], -1)
@@ -0,0 +1,96 @@
+"""
+Small, randomly initialized models shared by the tests (no downloads).
+
+`TinyModel` is an embedding followed by blocks of `query`, `key` and `value` linear layers fed the same hidden states,
+as in self-attention. The adapters are built with non-trivial lambdas: the default initialization has
+`lambda_b == 0`, for which every adapter output is zero.
+"""
+import warnings
+
+import torch
+import torch.nn as nn
+
+from rsverac.buffer_dict import BufferDict
+from rsverac.config import VeraConfig
+from rsverac.layer import Linear
+from rsverac.model import VeraModel, _kaiming_init
+
+
+ADAPTER_NAME = "default"
+VOCAB_SIZE = 50
+HIDDEN = 32
+
+
+class Block(nn.Module):
+    def __init__(self, hidden: int) -> None:
+        super().__init__()
+        self.query = nn.Linear(hidden, hidden)
+        self.key = nn.Linear(hidden, hidden)
+        self.value = nn.Linear(hidden, hidden)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return torch.tanh(self.query(hidden_states) + self.key(hidden_states) * self.value(hidden_states))
+
+
+class TinyModel(nn.Module):
+    def __init__(self, vocab_size: int = VOCAB_SIZE, hidden: int = HIDDEN, layers: int = 2) -> None:
+        super().__init__()
+        self.embed = nn.Embedding(vocab_size, hidden)
+        self.layers = nn.ModuleList(Block(hidden) for _ in range(layers))
+
+    @property
+    def dtype(self) -> torch.dtype:
+        # like `transformers.PreTrainedModel`, the rsvera `VeraModel` casts its adapters to it
+        return self.embed.weight.dtype
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        hidden_states = self.embed(input_ids)
+        for layer in self.layers:
+            hidden_states = layer(hidden_states)
+        return hidden_states
+
+
+def randomize_lambdas(model: nn.Module, seed: int = 1, std: float = 0.5) -> None:
+    """Draws the lambdas of `model`, the same ones for models with the same parameter names and shapes."""
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for name, param in sorted(model.named_parameters(), key=lambda item: item[0]):
+            if "vera_lambda_" in name:
+                param.copy_(1 + std * torch.randn(param.shape, generator=generator))
+
+
+def make_vera_model(seed: int = 0, hidden: int = HIDDEN, r: int = 8, **config_kwargs) -> VeraModel:
+    """A `rsverac.VeraModel` of a `TinyModel`, targeting its linear layers unless `target_modules` is given."""
+    torch.manual_seed(seed)
+    base_model = TinyModel(hidden=hidden)
+    config_kwargs.setdefault("target_modules", ["query", "key", "value"])
+    config = VeraConfig(r=r, vera_alpha=8, projection_prng_key=0xABC, d_initial=0.1, c_initial=0.1, **config_kwargs)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = VeraModel(base_model, {ADAPTER_NAME: config}, ADAPTER_NAME)
+    randomize_lambdas(model)
+    return model
+
+
+def make_vera_linear(in_features: int = 32, out_features: int = 24, r: int = 8, **kwargs) -> Linear:
+    """A `rsverac.layer.Linear` with its own projections and non-trivial lambdas."""
+    generator = torch.Generator().manual_seed(0)
+    vera_A = BufferDict({}, persistent=True)
+    vera_B = BufferDict({}, persistent=True)
+    vera_A[ADAPTER_NAME] = _kaiming_init((r, in_features), generator=generator)
+    vera_B[ADAPTER_NAME] = _kaiming_init((out_features, r), generator=generator)
+    torch.manual_seed(0)
+    layer = Linear(nn.Linear(in_features, out_features), vera_A, vera_B, ADAPTER_NAME, r=r, vera_alpha=8, **kwargs)
+    layer.get_base_layer().requires_grad_(False)
+    randomize_lambdas(layer)
+    return layer
+
+
+def relative_error(actual: torch.Tensor, expected: torch.Tensor) -> float:
+    return ((actual - expected).norm() / expected.norm()).item()
+
+
+def lambda_grads(model: nn.Module) -> torch.Tensor:
+    """The gradients of the lambdas of `model`, concatenated in the order of the parameter names."""
+    params = sorted((name, param) for name, param in model.named_parameters() if "vera_lambda_" in name)
+    return torch.cat([param.grad.flatten() for _, param in params])
@@ -0,0 +1,95 @@
+import dataclasses
+
+import pytest
+import torch
+
+from rsverac.combine_utils import VeraTerm, relative_error
+from rsverac.layer import Linear
+
+from .common import ADAPTER_NAME, make_vera_model
+
+
+def _linear_layers(model):
+    return [module for module in model.model.modules() if isinstance(module, Linear)]
+
+
+def make_two_adapter_model():
+    """A model with the adapters `default` and `other`, which share `lambda_b` and `lambda_c` in every layer."""
+    model = make_vera_model()
+    model.peft_config["other"] = dataclasses.replace(model.peft_config[ADAPTER_NAME])
+    model.inject_adapter(model.model, "other")
+    generator = torch.Generator().manual_seed(2)
+    with torch.no_grad():
+        for layer in _linear_layers(model):
+            layer.vera_lambda_b["other"].copy_(layer.vera_lambda_b[ADAPTER_NAME])
+            layer.vera_lambda_c["other"].copy_(layer.vera_lambda_c[ADAPTER_NAME])
+            layer.vera_lambda_d["other"].copy_(torch.randn(layer.r["other"], generator=generator))
+    return model
+
+
+@pytest.mark.parametrize("combination_type", ["linear", "cat"])
+def test_shared_lambdas_combine_exactly(combination_type, recwarn):
+    model = make_two_adapter_model()
+    weights = [0.7, -0.4]
+    model.add_weighted_adapter([ADAPTER_NAME, "other"], weights, "combined", combination_type=combination_type)
+    assert not any("refitted" in str(warning.message) for warning in recwarn)
+
+    rank = model.peft_config[ADAPTER_NAME].r
+    for layer in _linear_layers(model):
+        assert layer.r["combined"] == (rank if combination_type == "linear" else 2 * rank)
+        with torch.no_grad():
+            expected = weights[0] * layer.get_delta_weight(ADAPTER_NAME) + weights[1] * layer.get_delta_weight("other")
+            actual = layer.get_delta_weight("combined")
+        torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-5)
+
+
+def _mean_lambda_b_delta_weight(layer, adapters):
+    # the initial guess of the refit: the delta weights of the adapters, with their mean `lambda_b`
+    lambda_bs = [layer.vera_lambda_b[adapter].detach().clone() for adapter in adapters]
+    mean = torch.stack(lambda_bs).mean(0)
+    for adapter in adapters:
+        layer.vera_lambda_b[adapter].copy_(mean)
+    delta_weight = sum(layer.get_delta_weight(adapter) for adapter in adapters)
+    for adapter, lambda_b in zip(adapters, lambda_bs):
+        layer.vera_lambda_b[adapter].copy_(lambda_b)
+    return delta_weight
+
+
+def test_refit_warns_and_reduces_error():
+    model = make_two_adapter_model()
+    adapters = [ADAPTER_NAME, "other"]
+    generator = torch.Generator().manual_seed(3)
+    with torch.no_grad():
+        for layer in _linear_layers(model):
+            layer.vera_lambda_b["other"].copy_(torch.randn(layer.out_features, generator=generator))
+        initial_deltas = [_mean_lambda_b_delta_weight(layer, adapters) for layer in _linear_layers(model)]
+    with pytest.warns(UserWarning, match="refitted"):
+        model.add_weighted_adapter(adapters, [1.0, 1.0], "combined", combination_type="cat")
+
+    for layer, initial_delta in zip(_linear_layers(model), initial_deltas):
+        with torch.no_grad():
+            expected = sum(layer.get_delta_weight(adapter) for adapter in adapters)
+            actual = layer.get_delta_weight("combined")
+        # alternating least squares never increases the error of its initial guess
+        assert (actual - expected).norm() <= (initial_delta - expected).norm() * (1 + 1e-4)
+
+
+def test_relative_error_matches_dense_delta_weights():
+    generator = torch.Generator().manual_seed(0)
+
+    def term(coef, out_features=12, in_features=10, r=4):
+        def randn(*shape):
+            return torch.randn(*shape, generator=generator, dtype=torch.double)
+
+        return VeraTerm(
+            coef, randn(out_features), randn(out_features, r), randn(r), randn(r, in_features), randn(in_features)
+        )
+
+    def dense(t):
+        return t.coef * t.lambda_b.unsqueeze(-1) * ((t.vera_B * t.lambda_d) @ t.vera_A) * t.lambda_c
+
+    targets = [term(0.5), term(-1.5)]
+    approximation = term(0.8)
+    target = sum(dense(t) for t in targets)
+    expected = ((target - dense(approximation)).norm() / target.norm()).item()
+    assert relative_error(targets, approximation) == pytest.approx(expected, rel=1e-6)
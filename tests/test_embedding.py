@@ -0,0 +1,63 @@
+import torch
+
+from rsverac.counter_rng import counter_projection
+
+from .common import ADAPTER_NAME, VOCAB_SIZE, lambda_grads, make_vera_model
+
+
+def make_embedding_model(**config_kwargs):
+    return make_vera_model(target_modules=["embed"], **config_kwargs)
+
+
+def _output_and_lambda_grads(model, input_ids):
+    output = model(input_ids)
+    target = torch.randn(output.shape, generator=torch.Generator().manual_seed(1))
+    (output * target).sum().backward()
+    return output.detach(), lambda_grads(model)
+
+
+def test_counter_projection_is_deterministic_per_token():
+    token_ids = torch.tensor([[3, 7, 3], [0, 49, 7]])
+    projection = counter_projection(0xABC, token_ids, 8)
+    assert projection.shape == (2, 3, 8)
+    torch.testing.assert_close(projection, counter_projection(0xABC, token_ids, 8), rtol=0, atol=0)
+    torch.testing.assert_close(projection[0, 0], projection[0, 2], rtol=0, atol=0)
+    torch.testing.assert_close(projection[1, 2], counter_projection(0xABC, torch.tensor([7]), 8)[0], rtol=0, atol=0)
+    assert not torch.equal(projection, counter_projection(0xABD, token_ids, 8))
+
+
+def test_counter_projection_matches_dense_projection():
+    input_ids = torch.randint(0, VOCAB_SIZE, (3, 9))
+    counter = make_embedding_model(embedding_projection="counter")
+    dense = make_embedding_model(embedding_projection="dense")
+    assert ADAPTER_NAME not in counter.vera_embedding_A
+    assert dense.vera_embedding_A[ADAPTER_NAME].shape == (8, VOCAB_SIZE)
+
+    counter_output, counter_grads = _output_and_lambda_grads(counter, input_ids)
+    dense_output, dense_grads = _output_and_lambda_grads(dense, input_ids)
+    torch.testing.assert_close(counter_output, dense_output)
+    torch.testing.assert_close(counter_grads, dense_grads)
+
+
+def test_counter_delta_weight_matches_forward():
+    model = make_embedding_model(embedding_projection="counter")
+    layer = model.model.embed
+    token_ids = torch.arange(VOCAB_SIZE)
+    with torch.no_grad():
+        adapter_output = layer(token_ids) - layer.get_base_layer()(token_ids)
+        # a chunk size smaller than the vocabulary covers the chunked path
+        delta_weight = layer.get_delta_weight(ADAPTER_NAME, chunk_size=16)
+    torch.testing.assert_close(delta_weight, adapter_output)
+
+
+def test_unique_tokens_match_per_position():
+    # few distinct ids over many positions, every id is repeated
+    input_ids = torch.randint(0, 5, (4, 16))
+    unique = make_embedding_model(embedding_unique_tokens=True)
+    per_position = make_embedding_model(embedding_unique_tokens=False)
+    assert unique.model.embed.unique_tokens and not per_position.model.embed.unique_tokens
+
+    unique_output, unique_grads = _output_and_lambda_grads(unique, input_ids)
+    per_position_output, per_position_grads = _output_and_lambda_grads(per_position, input_ids)
+    torch.testing.assert_close(unique_output, per_position_output)
+    torch.testing.assert_close(unique_grads, per_position_grads, rtol=1e-5, atol=1e-5)
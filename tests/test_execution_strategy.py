@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from .common import make_vera_linear, make_vera_model
+
+
+STRATEGIES = ["low_rank", "dense", "merged"]
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_linear_strategies_match(strategy):
+    x = torch.randn(3, 5, 32)
+    reference = make_vera_linear(execution_strategy="low_rank").eval()
+    layer = make_vera_linear(execution_strategy=strategy).eval()
+    with torch.no_grad():
+        expected = reference(x)
+        actual = layer(x)
+    assert layer.last_execution_strategy == strategy
+    torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_cached_weight_follows_lambda_updates(strategy):
+    x = torch.randn(3, 5, 32)
+    reference = make_vera_linear(execution_strategy="low_rank").eval()
+    layer = make_vera_linear(execution_strategy=strategy).eval()
+    with torch.no_grad():
+        layer(x)
+        for model in (reference, layer):
+            model.vera_lambda_d["default"].mul_(2)
+        torch.testing.assert_close(layer(x), reference(x), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_gradients_force_low_rank(strategy):
+    layer = make_vera_linear(execution_strategy=strategy)
+    layer(torch.randn(3, 5, 32)).sum().backward()
+    assert layer.last_execution_strategy == "low_rank"
+    assert layer.vera_lambda_b["default"].grad is not None
+
+
+@pytest.mark.parametrize("strategy", ["auto", "dense", "merged"])
+def test_model_strategies_match(strategy):
+    input_ids = torch.randint(0, 50, (2, 7))
+    reference = make_vera_model().eval()
+    model = make_vera_model(execution_strategy=strategy).eval()
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids), reference(input_ids), rtol=1e-5, atol=1e-5)
@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from rsverac.functional import VeraLinearFunction, vera_linear
+
+
+def _inputs(in_features=6, out_features=5, r=3, dtype=torch.double):
+    generator = torch.Generator().manual_seed(0)
+
+    def randn(*shape, requires_grad=True):
+        return torch.randn(*shape, generator=generator, dtype=dtype).requires_grad_(requires_grad)
+
+    x = randn(2, 4, in_features)
+    lambda_b, lambda_d, lambda_c = randn(out_features), randn(r), randn(in_features)
+    vera_A = randn(r, in_features, requires_grad=False)
+    vera_B = randn(out_features, r, requires_grad=False)
+    return x, lambda_b, lambda_d, lambda_c, vera_A, vera_B
+
+
+def test_vera_linear_function_gradcheck():
+    assert torch.autograd.gradcheck(VeraLinearFunction.apply, (*_inputs(), 0.7))
+
+
+def test_vera_linear_function_matches_autograd():
+    inputs = _inputs(dtype=torch.float32)
+    x, lambda_b, lambda_d, lambda_c, vera_A, vera_B = inputs
+    scaling = 0.7
+    grad_output = torch.randn(2, 4, lambda_b.shape[0])
+
+    VeraLinearFunction.apply(*inputs, scaling).backward(grad_output)
+    grads = [tensor.grad.clone() for tensor in (x, lambda_b, lambda_d, lambda_c)]
+    for tensor in (x, lambda_b, lambda_d, lambda_c):
+        tensor.grad = None
+    expected = lambda_b * ((lambda_d * ((x * lambda_c) @ vera_A.T)) @ vera_B.T) * scaling
+    expected.backward(grad_output)
+    for grad, tensor in zip(grads, (x, lambda_b, lambda_d, lambda_c)):
+        torch.testing.assert_close(grad, tensor.grad)
+
+
+def test_vera_linear_rejects_trainable_projections():
+    x, lambda_b, lambda_d, lambda_c, vera_A, vera_B = _inputs()
+    with pytest.raises(ValueError):
+        vera_linear(x, lambda_b, lambda_d, lambda_c, vera_A.requires_grad_(), vera_B, 0.7)
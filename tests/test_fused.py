@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from .common import lambda_grads, make_vera_model
+
+
+def test_siblings_are_grouped():
+    model = make_vera_model(fuse_sibling_projections=True)
+    block = model.model.layers[0]
+    assert block.query.sibling_group is not None
+    assert block.query.sibling_group is block.key.sibling_group is block.value.sibling_group
+    assert block.query.sibling_group is not model.model.layers[1].query.sibling_group
+
+
+@pytest.mark.parametrize("training", [False, True])
+def test_fused_forward_and_backward_match_unfused(training):
+    input_ids = torch.randint(0, 50, (2, 7))
+    reference = make_vera_model().train(training)
+    model = make_vera_model(fuse_sibling_projections=True).train(training)
+
+    expected = reference(input_ids)
+    actual = model(input_ids)
+    torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
+    target = torch.randn_like(expected)
+    (expected * target).sum().backward()
+    (actual * target).sum().backward()
+    torch.testing.assert_close(lambda_grads(model), lambda_grads(reference), rtol=1e-5, atol=1e-5)
+
+
+def test_fused_forward_matches_unfused_without_gradients():
+    input_ids = torch.randint(0, 50, (2, 7))
+    reference = make_vera_model().eval()
+    model = make_vera_model(fuse_sibling_projections=True).eval()
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids), reference(input_ids), rtol=1e-5, atol=1e-5)
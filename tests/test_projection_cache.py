@@ -0,0 +1,58 @@
+import warnings
+
+import pytest
+import torch
+
+from rsvera.config import VeraConfig
+from rsvera.model import VeraModel
+
+from .common import ADAPTER_NAME, TinyModel, lambda_grads, randomize_lambdas
+
+
+def make_rsvera_model(share_input_projection: bool) -> VeraModel:
+    torch.manual_seed(0)
+    config = VeraConfig(
+        r=8,
+        target_modules=["query", "key", "value"],
+        projection_prng_key=0xABC,
+        d_initial=0.1,
+        share_input_projection=share_input_projection,
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = VeraModel(TinyModel(), {ADAPTER_NAME: config}, ADAPTER_NAME)
+    randomize_lambdas(model)
+    return model
+
+
+@pytest.mark.parametrize("training", [False, True])
+def test_shared_projection_matches_separate_ones(training):
+    input_ids = torch.randint(0, 50, (2, 7))
+    reference = make_rsvera_model(share_input_projection=False).train(training)
+    model = make_rsvera_model(share_input_projection=True).train(training)
+
+    expected = reference(input_ids)
+    actual = model(input_ids)
+    torch.testing.assert_close(actual, expected)
+    # query, key and value share their input: one miss and two hits per block
+    assert model._projection_cache.misses == 2
+    assert model._projection_cache.hits == 4
+
+    target = torch.randn_like(expected)
+    (expected * target).sum().backward()
+    (actual * target).sum().backward()
+    torch.testing.assert_close(lambda_grads(model), lambda_grads(reference), rtol=1e-5, atol=1e-5)
+
+
+def test_projection_cache_sees_in_place_updates():
+    hidden_states = torch.randn(2, 7, 32)
+    reference = make_rsvera_model(share_input_projection=False).eval()
+    model = make_rsvera_model(share_input_projection=True).eval()
+    with torch.no_grad():
+        model.model.layers[0].query(hidden_states)
+        for vera_model in (reference, model):
+            vera_model.vera_A[ADAPTER_NAME].mul_(2)
+        expected = reference.model.layers[0].key(hidden_states)
+        actual = model.model.layers[0].key(hidden_states)
+    torch.testing.assert_close(actual, expected)
+    assert model._projection_cache.hits == 0
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from rsverac.layer import Linear
+
+from .common import ADAPTER_NAME, make_vera_model
+
+
+def _linear_layers(model):
+    return {key: module for key, module in model.model.named_modules() if isinstance(module, Linear)}
+
+
+def test_zero_threshold_keeps_outputs():
+    input_ids = torch.randint(0, 50, (2, 7))
+    model = make_vera_model().eval()
+    with torch.no_grad():
+        expected = model(input_ids)
+    report = model.prune_ranks(0.0)
+    assert report["kept_rank"] == report["rank"] == 8 * len(_linear_layers(model))
+    for layer_report in report["layers"].values():
+        assert layer_report["delta_rel_error"] == 0.0
+    with torch.no_grad():
+        assert torch.equal(model(input_ids), expected)
+
+
+@pytest.mark.parametrize("threshold", [0.3, 1.0])
+def test_pruned_delta_weight_error_is_reported(threshold):
+    model = make_vera_model()
+    with torch.no_grad():
+        full_deltas = {key: layer.get_delta_weight(ADAPTER_NAME) for key, layer in _linear_layers(model).items()}
+    report = model.prune_ranks(threshold)
+    assert report["kept_rank"] <= report["rank"]
+    if threshold == 1.0:
+        # only the largest component of every layer
+        assert report["kept_rank"] == len(full_deltas)
+
+    assert report["layers"].keys() == full_deltas.keys()
+    for key, layer_report in report["layers"].items():
+        layer = model.model.get_submodule(key)
+        assert layer.r[ADAPTER_NAME] == layer_report["kept_rank"]
+        assert layer.vera_lambda_d[ADAPTER_NAME].shape == (layer_report["kept_rank"],)
+        with torch.no_grad():
+            pruned_delta = layer.get_delta_weight(ADAPTER_NAME)
+        full_delta = full_deltas[key]
+        error = ((pruned_delta - full_delta).norm() / full_delta.norm()).item()
+        assert error == pytest.approx(layer_report["delta_rel_error"], abs=1e-4)
+
+
+def test_pruned_forward_matches_pruned_delta_weight():
+    x = torch.randn(2, 7, 32)
+    model = make_vera_model()
+    model.prune_ranks(0.3)
+    layer = model.model.layers[0].query
+    with torch.no_grad():
+        expected = layer.get_base_layer()(x) + x @ layer.get_delta_weight(ADAPTER_NAME).T
+        torch.testing.assert_close(layer(x), expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from rsverac.quantization import Int8Linear, Int8LinearFunction
+
+from .common import lambda_grads, make_vera_model, relative_error
+
+
+# one rounding error of at most half a step of `max / 127` on each operand of every product
+LINEAR_REL_TOL = 2e-2
+# through the two blocks of `TinyModel`, whose base layers are all quantized
+MODEL_REL_TOL = 5e-2
+MIN_GRAD_COSINE = 0.99
+
+
+def _linear(in_features=64, out_features=48):
+    torch.manual_seed(0)
+    return nn.Linear(in_features, out_features)
+
+
+def test_int8_linear_forward_matches_float():
+    linear = _linear()
+    x = torch.randn(4, 8, linear.in_features)
+    expected = linear(x)
+    actual = Int8Linear.from_float(linear)(x)
+    assert actual.shape == expected.shape
+    assert actual.dtype == expected.dtype
+    assert relative_error(actual, expected) < LINEAR_REL_TOL
+
+
+def test_int8_linear_input_gradient_matches_float():
+    linear = _linear()
+    quantized = Int8Linear.from_float(linear)
+    x = torch.randn(4, 8, linear.in_features)
+    grad_output = torch.randn(4, 8, linear.out_features)
+
+    x_float = x.clone().requires_grad_()
+    linear(x_float).backward(grad_output)
+    x_int8 = x.clone().requires_grad_()
+    quantized(x_int8).backward(grad_output)
+    assert relative_error(x_int8.grad, x_float.grad) < LINEAR_REL_TOL
+
+
+def test_int8_linear_dequantize_round_trip():
+    linear = _linear()
+    dequantized = Int8Linear.from_float(linear).dequantize()
+    assert relative_error(dequantized.weight, linear.weight) < LINEAR_REL_TOL
+    assert torch.equal(dequantized.bias, linear.bias)
+
+
+def test_int8_linear_function_gradcheck():
+    # the activations and output gradients are quantized on CPU, so that the gradient of `x` is not the derivative of
+    # the (piecewise constant) forward and cannot be gradchecked, it is compared to the float one above. The output is
+    # exactly affine in the bias.
+    quantized = Int8Linear.from_float(_linear())
+    x = torch.randn(32, quantized.in_features, dtype=torch.double)
+    bias = torch.randn(quantized.out_features, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(
+        lambda bias: Int8LinearFunction.apply(x, quantized.weight, quantized.weight_scale, bias), (bias,)
+    )
+
+
+def test_int8_linear_function_input_gradient_is_dequantized_weight_product():
+    quantized = Int8Linear.from_float(_linear())
+    x = torch.randn(32, quantized.in_features, requires_grad=True)
+    grad_output = torch.randn(32, quantized.out_features)
+    Int8LinearFunction.apply(x, quantized.weight, quantized.weight_scale, quantized.bias).backward(grad_output)
+    expected = grad_output @ quantized.dequantize().weight
+    assert relative_error(x.grad, expected) < LINEAR_REL_TOL
+
+
+def _lambda_grads_and_output(model, input_ids, target):
+    output = model(input_ids)
+    (output * target).sum().backward()
+    return lambda_grads(model), output.detach()
+
+
+def test_int8_backbone_matches_float_backbone():
+    input_ids = torch.randint(0, 50, (4, 8), generator=torch.Generator().manual_seed(0))
+    float_model = make_vera_model(hidden=64)
+    int8_model = make_vera_model(hidden=64, quantize_backbone="int8")
+    assert isinstance(int8_model.model.layers[0].query.base_layer, Int8Linear)
+    target = torch.randn(4, 8, 64, generator=torch.Generator().manual_seed(1))
+
+    float_grads, float_output = _lambda_grads_and_output(float_model, input_ids, target)
+    int8_grads, int8_output = _lambda_grads_and_output(int8_model, input_ids, target)
+    assert relative_error(int8_output, float_output) < MODEL_REL_TOL
+    assert F.cosine_similarity(int8_grads, float_grads, dim=0).item() > MIN_GRAD_COSINE
+    assert relative_error(int8_grads, float_grads) < MODEL_REL_TOL
@@ -0,0 +1,18 @@
+from .async_eval import AsyncEvaluator, trainable_state_dict
+from .glue_metrics import GlueMetric
+from .parallel import parallel_map
+from .precision import PrecisionPolicy
+from .profiler import AdapterProfiler, ProfilingMixin
+from .zero_order import ZeroOrderSGD
+
+
+__all__ = [
+    "AdapterProfiler",
+    "AsyncEvaluator",
+    "GlueMetric",
+    "PrecisionPolicy",
+    "ProfilingMixin",
+    "ZeroOrderSGD",
+    "parallel_map",
+    "trainable_state_dict",
+]
@@ -0,0 +1,175 @@
+import queue
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+
+def _argmax_predictions(logits: torch.Tensor) -> torch.Tensor:
+    return logits.argmax(dim=-1)
+
+
+def trainable_state_dict(model: torch.nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    Returns a detached CPU copy of the parameters that require gradients.
+
+    For Vera this is only the `vera_lambda_*` vectors and the classification head, so the snapshot is a few KB/MB
+    regardless of the size of the frozen backbone.
+    """
+    return {n: p.detach().to("cpu", copy=True) for n, p in model.named_parameters() if p.requires_grad}
+
+
+def _eval_worker(model, eval_dataloader, metric, device, num_threads, predict_fn, requests, results):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    model.to(device)
+    model.eval()
+    params = dict(model.named_parameters())
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        tag, snapshot = request
+        try:
+            with torch.no_grad():
+                for name, value in snapshot.items():
+                    params[name].copy_(value)
+
+                for batch in eval_dataloader:
+                    batch.to(device)
+                    outputs = model(**batch)
+                    metric.add_batch(predictions=predict_fn(outputs.logits), references=batch["labels"])
+            results.put((tag, metric.compute(), None))
+        except Exception as exc:  # surfaced in the training process by `poll`/`close`
+            results.put((tag, None, f"{type(exc).__name__}: {exc}"))
+
+
+class AsyncEvaluator:
+    """
+    Evaluates snapshots of the trainable parameters in a separate process while training continues.
+
+    The worker is forked from the training process when the evaluator is created, so it holds its own copy of the
+    frozen backbone through copy-on-write memory. Every call to `submit` only ships the trainable parameters (the
+    Vera lambdas or LoRA matrices and the classification head) to the worker, which loads them into its copy of the
+    model and runs the full evaluation loop.
+
+    The evaluator must be created before the model is moved to CUDA, since CUDA cannot be used in forked processes.
+    The worker evaluates on `device`, which defaults to the CPU.
+
+    Args:
+        model (`torch.nn.Module`):
+            The (peft) model being trained.
+        eval_dataloader (`torch.utils.data.DataLoader`):
+            The evaluation dataloader. Batches must contain a `labels` entry.
+        metric:
+            Any object with the `add_batch(predictions=..., references=...)` / `compute()` interface of
+            `evaluate.EvaluationModule`.
+        device (`str`):
+            The device the worker evaluates on. Defaults to `"cpu"`.
+        num_threads (`int`, *optional*):
+            Number of intra-op threads of the worker. Set this so that the trainer and the worker do not oversubscribe
+            the available cores. Defaults to the torch default.
+        predict_fn (`Callable`, *optional*):
+            Maps the logits to the predictions passed to the metric. Defaults to an argmax over the last dimension.
+
+    Example:
+
+        ```py
+        >>> evaluator = AsyncEvaluator(model, eval_dataloader, metric, num_threads=4)
+        >>> for epoch in range(num_epochs):
+        ...     train_one_epoch(model)
+        ...     evaluator.submit(epoch, model)
+        ...     for epoch, eval_metric in evaluator.poll():
+        ...         print(f"epoch {epoch}:", eval_metric)
+        >>> for epoch, eval_metric in evaluator.close():
+        ...     print(f"epoch {epoch}:", eval_metric)
+        ```
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        eval_dataloader,
+        metric,
+        device: str = "cpu",
+        num_threads: Optional[int] = None,
+        predict_fn: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+    ) -> None:
+        if "fork" not in mp.get_all_start_methods():
+            raise RuntimeError("`AsyncEvaluator` requires the `fork` start method, which is not available here.")
+
+        ctx = mp.get_context("fork")
+        self._requests = ctx.Queue()
+        self._results = ctx.Queue()
+        self._pending = 0
+        self._process = ctx.Process(
+            target=_eval_worker,
+            args=(
+                model,
+                eval_dataloader,
+                metric,
+                device,
+                num_threads,
+                predict_fn or _argmax_predictions,
+                self._requests,
+                self._results,
+            ),
+            daemon=True,
+        )
+        self._process.start()
+
+    def submit(self, tag: Any, model: torch.nn.Module) -> None:
+        """
+        Snapshots the trainable parameters of `model` and queues an evaluation of them.
+
+        Args:
+            tag:
+                Returned alongside the metrics of this evaluation, e.g. the epoch number.
+            model (`torch.nn.Module`):
+                The model being trained.
+        """
+        if not self._process.is_alive():
+            raise RuntimeError("The evaluation worker is not running.")
+        self._requests.put((tag, trainable_state_dict(model)))
+        self._pending += 1
+
+    def _collect(self, block: bool, timeout: Optional[float] = None) -> List[Tuple[Any, Dict[str, float]]]:
+        finished = []
+        while self._pending > 0:
+            try:
+                tag, eval_metric, error = self._results.get(block=block, timeout=timeout)
+            except queue.Empty:
+                if block:
+                    raise RuntimeError(f"Timed out waiting for {self._pending} pending evaluation(s).")
+                break
+            self._pending -= 1
+            if error is not None:
+                raise RuntimeError(f"Evaluation {tag} failed in the worker process: {error}")
+            finished.append((tag, eval_metric))
+        return finished
+
+    def poll(self) -> List[Tuple[Any, Dict[str, float]]]:
+        """
+        Returns the `(tag, metrics)` pairs of all evaluations that finished since the last call, without waiting.
+        """
+        return self._collect(block=False)
+
+    def close(self, timeout: Optional[float] = None) -> List[Tuple[Any, Dict[str, float]]]:
+        """
+        Waits for all pending evaluations, stops the worker and returns the remaining `(tag, metrics)` pairs.
+
+        Args:
+            timeout (`float`, *optional*):
+                Maximum number of seconds to wait for each pending evaluation. Defaults to waiting indefinitely.
+        """
+        try:
+            finished = self._collect(block=True, timeout=timeout)
+        finally:
+            self._requests.put(None)
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        return finished
@@ -0,0 +1,133 @@
+from typing import Dict, Optional
+
+import torch
+
+
+# number of classes of the classification tasks, stsb is a regression task
+GLUE_TASKS_NUM_LABELS = {
+    "cola": 2,
+    "mnli": 3,
+    "mnli_matched": 3,
+    "mnli_mismatched": 3,
+    "mrpc": 2,
+    "qnli": 2,
+    "qqp": 2,
+    "rte": 2,
+    "sst2": 2,
+    "wnli": 2,
+    "ax": 3,
+}
+
+
+def _rank(values: torch.Tensor) -> torch.Tensor:
+    """Ranks of `values` starting at 1, tied values get the average of their ranks (as `scipy.stats.rankdata`)."""
+    sorted_values, order = torch.sort(values)
+    _, inverse, counts = torch.unique_consecutive(sorted_values, return_inverse=True, return_counts=True)
+    # average rank of each group of tied values
+    ends = torch.cumsum(counts, dim=0).to(torch.float64)
+    group_ranks = ends - (counts.to(torch.float64) - 1) / 2
+    ranks = torch.empty(values.shape, dtype=torch.float64, device=values.device)
+    ranks[order] = group_ranks[inverse]
+    return ranks
+
+
+def _pearson(x: torch.Tensor, y: torch.Tensor) -> float:
+    x = x - x.mean()
+    y = y - y.mean()
+    denom = torch.sqrt((x * x).sum() * (y * y).sum())
+    if denom == 0:
+        return float("nan")
+    return ((x * y).sum() / denom).item()
+
+
+class GlueMetric:
+    """
+    Drop-in replacement for `evaluate.load("glue", task)` that accumulates on the device of the predictions.
+
+    Classification tasks accumulate a `(num_labels, num_labels)` confusion matrix with a single `bincount` per batch,
+    so `add_batch` never synchronizes with the host nor converts tensors to Python lists. STS-B keeps the predictions
+    and references as tensors on the device. All metrics are finalized once in `compute`, which also resets the
+    state, like `evaluate.EvaluationModule.compute`.
+
+    The returned metrics are the ones of the GLUE metric of `evaluate`: `accuracy` (plus `f1` for mrpc and qqp),
+    `matthews_correlation` for cola and `pearson`/`spearmanr` for stsb.
+
+    Args:
+        task (`str`):
+            The GLUE task, e.g. `"mrpc"` or `"stsb"`.
+    """
+
+    def __init__(self, task: str) -> None:
+        if task != "stsb" and task not in GLUE_TASKS_NUM_LABELS:
+            raise ValueError(f"Task {task} not supported.")
+        self.task = task
+        self.num_labels = GLUE_TASKS_NUM_LABELS.get(task)
+        self._confusion: Optional[torch.Tensor] = None
+        self._predictions = []
+        self._references = []
+
+    def add_batch(self, predictions: torch.Tensor, references: torch.Tensor) -> None:
+        predictions = torch.as_tensor(predictions)
+        references = torch.as_tensor(references, device=predictions.device)
+
+        if self.task == "stsb":
+            self._predictions.append(predictions.detach().reshape(-1).to(torch.float64))
+            self._references.append(references.reshape(-1).to(torch.float64))
+            return
+
+        # rows are references, columns are predictions
+        indices = references.reshape(-1).long() * self.num_labels + predictions.detach().reshape(-1).long()
+        counts = torch.bincount(indices, minlength=self.num_labels * self.num_labels)
+        if self._confusion is None:
+            self._confusion = counts
+        else:
+            self._confusion += counts.to(self._confusion.device)
+
+    def reset(self) -> None:
+        self._confusion = None
+        self._predictions = []
+        self._references = []
+
+    def compute(self) -> Dict[str, float]:
+        if self.task == "stsb":
+            result = self._compute_regression()
+        else:
+            result = self._compute_classification()
+        self.reset()
+        return result
+
+    def _compute_regression(self) -> Dict[str, float]:
+        if not self._predictions:
+            raise ValueError("No predictions were added, call `add_batch` before `compute`.")
+        predictions = torch.cat(self._predictions)
+        references = torch.cat(self._references).to(predictions.device)
+        return {
+            "pearson": _pearson(predictions, references),
+            "spearmanr": _pearson(_rank(predictions), _rank(references)),
+        }
+
+    def _compute_classification(self) -> Dict[str, float]:
+        if self._confusion is None:
+            raise ValueError("No predictions were added, call `add_batch` before `compute`.")
+        confusion = self._confusion.reshape(self.num_labels, self.num_labels).to("cpu", torch.float64)
+        total = confusion.sum()
+        correct = confusion.trace()
+
+        if self.task == "cola":
+            # multiclass Matthews correlation coefficient, as in `sklearn.metrics.matthews_corrcoef`
+            true_counts = confusion.sum(dim=1)
+            pred_counts = confusion.sum(dim=0)
+            cov_ytyp = correct * total - (true_counts * pred_counts).sum()
+            cov_ypyp = total * total - (pred_counts * pred_counts).sum()
+            cov_ytyt = total * total - (true_counts * true_counts).sum()
+            if cov_ypyp * cov_ytyt == 0:
+                return {"matthews_correlation": 0.0}
+            return {"matthews_correlation": (cov_ytyp / torch.sqrt(cov_ytyt * cov_ypyp)).item()}
+
+        result = {"accuracy": (correct / total).item()}
+        if self.task in ("mrpc", "qqp"):
+            # binary F1 of the positive class
+            tp, fp, fn = confusion[1, 1], confusion[0, 1], confusion[1, 0]
+            denom = 2 * tp + fp + fn
+            result["f1"] = (2 * tp / denom).item() if denom > 0 else 0.0
+        return result
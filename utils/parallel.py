@@ -0,0 +1,62 @@
+"""
+Thread-pool execution of independent per-layer work, e.g. merging the adapters of many layers.
+
+The heavy lifting of such work happens in torch ops that release the GIL, so threads are enough to use several cores.
+Every worker limits its intra-op parallelism to `threads_per_worker` threads, so that `num_workers *
+threads_per_worker` stays within the budget of the process.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, List, Optional, TypeVar
+
+import torch
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def parallel_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    num_workers: int = 1,
+    threads_per_worker: Optional[int] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+) -> List[R]:
+    """
+    Applies `fn` to every item, with `num_workers` threads, and returns the results in the order of `items`.
+
+    The items must be independent, i.e. no two calls may write to the same tensors: the results are then the same as
+    with a serial loop, whatever the scheduling. `threads_per_worker` defaults to `torch.get_num_threads() //
+    num_workers` (at least 1). `progress_callback(done, total)` is called from the calling thread after every
+    completed item. With `num_workers <= 1`, `fn` is applied serially in the calling thread.
+    """
+    items = list(items)
+    total = len(items)
+    if num_workers <= 1 or total <= 1:
+        results = []
+        for done, item in enumerate(items, start=1):
+            results.append(fn(item))
+            if progress_callback is not None:
+                progress_callback(done, total)
+        return results
+
+    num_threads = torch.get_num_threads()
+    if threads_per_worker is None:
+        threads_per_worker = max(1, num_threads // num_workers)
+
+    def init_worker():
+        # the intra-op thread count is per thread for OpenMP, but set it in every worker to be safe
+        torch.set_num_threads(threads_per_worker)
+
+    results = [None] * total
+    try:
+        with ThreadPoolExecutor(max_workers=min(num_workers, total), initializer=init_worker) as executor:
+            futures = {executor.submit(fn, item): index for index, item in enumerate(items)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                results[futures[future]] = future.result()
+                if progress_callback is not None:
+                    progress_callback(done, total)
+    finally:
+        # some backends share the setting between threads, restore the one of the caller
+        torch.set_num_threads(num_threads)
+    return results
@@ -0,0 +1,67 @@
+"""
+Mixed precision policy of the adapter layers.
+
+The adapter branch of a layer has three dtypes: the one its trainable weights are stored in (what the optimizer
+updates and what gets saved), the one its GEMMs run in, and the one its output is summed with the output of the base
+layer in. By default the three are the dtype of the adapter weights, which `VeraModel` and `LoraModel` cast to the
+dtype of the backbone, and the activations are cast to it. A `PrecisionPolicy` sets them independently, e.g. float32
+lambdas with bfloat16 GEMMs on a bfloat16 backbone: the optimizer keeps full precision, the GEMMs run on the native
+bfloat16 units of the CPU and no activation is ever copied to another dtype.
+"""
+from dataclasses import dataclass, fields
+from typing import Dict, Optional
+
+import torch
+
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16, "float64": torch.float64}
+
+
+@dataclass(frozen=True)
+class PrecisionPolicy:
+    """
+    Dtypes of the adapter branch of a layer, `None` keeping the default.
+
+    Args:
+        storage_dtype (`torch.dtype`, *optional*): dtype of the trainable adapter weights, the lambdas of VeRA and the
+            `lora_A`/`lora_B` weights of LoRA. Defaults to the dtype of the backbone.
+        compute_dtype (`torch.dtype`, *optional*): dtype of the adapter GEMMs. The trainable weights are cast to it in
+            the forward, the frozen VeRA projections are stored in it. Defaults to the storage dtype.
+        accumulate_dtype (`torch.dtype`, *optional*): dtype the adapter outputs are summed with the output of the base
+            layer in, before the result is cast back to the dtype of the input. Defaults to the dtype of the output
+            of the base layer.
+    """
+
+    storage_dtype: Optional[torch.dtype] = None
+    compute_dtype: Optional[torch.dtype] = None
+    accumulate_dtype: Optional[torch.dtype] = None
+
+    @classmethod
+    def from_dict(cls, policy: Optional[Dict[str, str]]) -> "PrecisionPolicy":
+        """Builds the policy of a config, e.g. `{"storage_dtype": "float32", "compute_dtype": "bfloat16"}`."""
+        policy = dict(policy or {})
+        names = {field.name for field in fields(cls)}
+        unknown = set(policy) - names
+        if unknown:
+            raise ValueError(f"Unknown precision policy keys {sorted(unknown)}, expected some of {sorted(names)}")
+        dtypes = {}
+        for name, dtype in policy.items():
+            if dtype is None:
+                continue
+            if dtype not in DTYPES:
+                raise ValueError(f"Invalid {name} {dtype!r}, expected one of {list(DTYPES)}")
+            dtypes[name] = DTYPES[dtype]
+        return cls(**dtypes)
+
+    def compute(self, storage_dtype: torch.dtype) -> torch.dtype:
+        """The dtype of the adapter GEMMs for adapter weights stored in `storage_dtype`."""
+        return self.compute_dtype or storage_dtype
+
+
+def promotes_to(x: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """
+    `x` for a computation in `dtype` starting with a product by a `dtype` tensor. Inputs that type promotion turns into
+    `dtype` are returned as they are, the product reads them in their own dtype instead of a cast copy; only the
+    others, e.g. float32 activations for bfloat16 GEMMs, are cast.
+    """
+    return x if torch.promote_types(x.dtype, dtype) == dtype else x.to(dtype)
@@ -0,0 +1,462 @@
+import json
+import statistics
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+from .precision import promotes_to
+
+
+def _element_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+def _adapter_dtype(layer: nn.Module, adapter: str) -> Optional[torch.dtype]:
+    # the compute dtype of the adapter, see `utils.precision.PrecisionPolicy`
+    if hasattr(layer, "vera_lambda_d") and adapter in layer.vera_lambda_d:
+        dtype = layer.vera_lambda_d[adapter].dtype
+    elif hasattr(layer, "lora_A") and adapter in layer.lora_A:
+        dtype = layer.lora_A[adapter].weight.dtype
+    elif hasattr(layer, "lora_embedding_A") and adapter in layer.lora_embedding_A:
+        dtype = layer.lora_embedding_A[adapter].dtype
+    else:
+        return None
+    policy = getattr(layer, "precision_policy", {}).get(adapter)
+    return dtype if policy is None else policy.compute(dtype)
+
+
+def _casts_input(layer: nn.Module, input_dtype: torch.dtype, dtype: torch.dtype) -> bool:
+    if hasattr(layer, "vera_lambda_c"):
+        # VeRA-plus: the product by lambda_c promotes narrower inputs, see `utils.precision.promotes_to`
+        return torch.promote_types(input_dtype, dtype) != dtype
+    return input_dtype != dtype
+
+
+def _is_embedding(layer: nn.Module) -> bool:
+    return isinstance(layer.get_base_layer(), nn.Embedding)
+
+
+def _is_conv2d(layer: nn.Module) -> bool:
+    return isinstance(layer.get_base_layer(), nn.Conv2d)
+
+
+def _active_adapters(layer: nn.Module) -> List[str]:
+    return [adapter for adapter in layer.active_adapters if adapter in getattr(layer, "r", {})]
+
+
+def execution_strategy(layer: nn.Module) -> str:
+    """
+    How the last forward of `layer` applied its adapters: `low_rank`, or for the VeRA-plus `Linear` layers `dense` (a
+    cached delta weight) or `merged` (a cached merged weight, the base layer is not called). See
+    `rsverac.layer.Linear.select_execution_strategy`.
+    """
+    if getattr(layer, "_frozen", None) is not None:
+        if getattr(layer, "_frozen_merged_weight", None) is not None:
+            return "merged"
+        return "dense" if getattr(layer, "_frozen_delta_weight", None) is not None else "low_rank"
+    return getattr(layer, "last_execution_strategy", None) or "low_rank"
+
+
+def layer_costs(
+    layer: nn.Module, input_shape: Tuple[int, ...], input_dtype: torch.dtype, output_shape=None, strategy=None
+) -> dict:
+    """
+    Analytical FLOPs and bytes of one forward of `layer` for an input of the given shape and dtype.
+
+    The base layer and the adapter branch are reported separately. `adapter_bytes` are the bytes of the intermediate
+    tensors the adapter branch allocates, including the copies made by dtype casts. `strategy` is the execution
+    strategy of the forward, that of the last forward of `layer` by default (see `execution_strategy`): `dense` costs
+    a GEMM against the cached delta weight instead of the low rank branches, and `merged` only the GEMM against the
+    merged weight, reported as the base layer.
+    """
+    base_layer = layer.get_base_layer()
+    if _is_embedding(layer):
+        tokens = 1
+        for dim in input_shape:
+            tokens *= dim
+        in_features = None
+    elif _is_conv2d(layer):
+        # every output pixel is one "token" of a (in_channels * kh * kw) -> out_channels matmul
+        tokens = output_shape[0] * output_shape[2] * output_shape[3] if output_shape is not None else 0
+        kh, kw = base_layer.kernel_size
+        in_features = layer.in_features * kh * kw // base_layer.groups
+    else:
+        tokens = 1
+        for dim in input_shape[:-1]:
+            tokens *= dim
+        in_features = layer.in_features
+    out_features = layer.out_features
+
+    base_flops = 0 if in_features is None else 2 * tokens * in_features * out_features
+    adapter_flops, adapter_bytes = 0, 0
+    strategy = strategy or execution_strategy(layer)
+    adapters = [] if layer.disable_adapters or layer.merged else _active_adapters(layer)
+    if adapters and strategy != "low_rank":
+        if strategy == "dense":
+            dtype = _adapter_dtype(layer, adapters[0]) or input_dtype
+            size = _element_size(dtype)
+            # (tokens, in) @ (in, out) against the delta weight, then the accumulation into the result
+            adapter_flops = 2 * tokens * in_features * out_features + tokens * out_features
+            adapter_bytes = tokens * out_features * size
+            if dtype != input_dtype:
+                adapter_bytes += tokens * in_features * size
+        adapters = []
+    if adapters:
+        for adapter in adapters:
+            r = layer.r[adapter]
+            dtype = _adapter_dtype(layer, adapter) or input_dtype
+            size = _element_size(dtype)
+            if in_features is None:
+                # embedding: lookup of r values per token, then (tokens, r) @ (r, out)
+                adapter_flops += 2 * tokens * r * out_features
+                adapter_bytes += tokens * (r + out_features) * size
+            else:
+                adapter_flops += 2 * tokens * r * (in_features + out_features)
+                adapter_bytes += tokens * (r + out_features) * size
+            if in_features is not None and _casts_input(layer, input_dtype, dtype):
+                # copy of the input made by `x.to(dtype)`
+                adapter_bytes += tokens * in_features * size
+            if hasattr(layer, "vera_lambda_d"):
+                # lambda_d and lambda_b scaling, plus lambda_c scaling of the input for VeRA-plus
+                adapter_flops += tokens * (r + 2 * out_features)
+                adapter_bytes += tokens * (r + out_features) * size
+                if hasattr(layer, "vera_lambda_c") and in_features is not None:
+                    adapter_flops += tokens * in_features
+                    adapter_bytes += tokens * in_features * size
+            else:
+                adapter_flops += tokens * out_features
+                adapter_bytes += tokens * out_features * size
+            # accumulation into the result
+            adapter_flops += tokens * out_features
+
+    return {
+        "base_flops": base_flops,
+        "adapter_flops": adapter_flops,
+        "adapter_bytes": adapter_bytes,
+    }
+
+
+def adapter_stages(layer: nn.Module, adapter: str, x: torch.Tensor) -> List[Tuple[str, Callable]]:
+    """
+    Splits the adapter branch of a `Linear` adapter layer into its individual operations.
+
+    Returns a list of `(stage name, fn)` where every `fn` takes the output of the previous stage. This mirrors the
+    `forward` of `lora.layer.Linear`, `rsvera.layer.Linear` and `rsverac.layer.Linear` so that each operation can be
+    timed in isolation.
+    """
+    previous_dtype = x.dtype
+    dtype = _adapter_dtype(layer, adapter)
+    if hasattr(layer, "vera_lambda_d"):
+        lambda_d = layer.vera_lambda_d[adapter].to(dtype)
+        lambda_b = layer.vera_lambda_b[adapter].to(dtype)
+        lambda_c = layer.vera_lambda_c[adapter].to(dtype) if hasattr(layer, "vera_lambda_c") else None
+        # the sub-projections of the VeRA-plus adapters pruned by `prune_ranks`
+        if hasattr(layer, "_projections"):
+            vera_A, vera_B = (projection.to(dtype) for projection in layer._projections(adapter))
+        else:
+            vera_A, vera_B = layer.vera_A[adapter].to(dtype), layer.vera_B[adapter].to(dtype)
+        dropout = layer.vera_dropout[adapter]
+        scaling = layer.scaling[adapter]
+        if lambda_c is not None:
+            stages = [("cast_input", lambda h: promotes_to(h, dtype))]
+        else:
+            stages = [("cast_input", lambda h: h.to(dtype))]
+        if lambda_c is not None:
+            stages.append(("dropout_lambda_c", lambda h: dropout(h) * lambda_c))
+        else:
+            stages.append(("dropout", lambda h: dropout(h)))
+        stages += [
+            ("down_projection", lambda h: F.linear(h, vera_A)),
+            ("lambda_d", lambda h: lambda_d * h),
+            ("up_projection", lambda h: F.linear(h, vera_B)),
+            ("lambda_b_scaling", lambda h: (lambda_b * h) * scaling),
+        ]
+    else:
+        weight_A = layer.lora_A[adapter].weight.to(dtype)
+        weight_B = layer.lora_B[adapter].weight.to(dtype)
+        dropout = layer.lora_dropout[adapter]
+        scaling = layer.scaling[adapter]
+        stages = [
+            ("cast_input", lambda h: h.to(dtype)),
+            ("dropout", lambda h: dropout(h)),
+            ("down_projection", lambda h: F.linear(h, weight_A)),
+            ("up_projection", lambda h: F.linear(h, weight_B)),
+            ("scaling", lambda h: h * scaling),
+        ]
+    stages.append(("cast_output", lambda h: h.to(previous_dtype)))
+    return stages
+
+
+class _LayerStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.total_s = 0.0
+        self.base_s = 0.0
+        self.base_flops = 0
+        self.adapter_flops = 0
+        self.adapter_bytes = 0
+        self.input_shape = None
+        self.input_dtype = None
+        self.stages = None
+        # calls per execution strategy, see `execution_strategy`
+        self.strategies = defaultdict(int)
+
+    def as_dict(self) -> dict:
+        adapter_s = max(self.total_s - self.base_s, 0.0)
+        result = {
+            "calls": self.calls,
+            "total_ms": self.total_s * 1e3,
+            "base_ms": self.base_s * 1e3,
+            "adapter_ms": adapter_s * 1e3,
+            "adapter_share": adapter_s / self.total_s if self.total_s > 0 else 0.0,
+            "base_flops": self.base_flops,
+            "adapter_flops": self.adapter_flops,
+            "adapter_bytes": self.adapter_bytes,
+            "input_shape": list(self.input_shape) if self.input_shape is not None else None,
+            "input_dtype": str(self.input_dtype).replace("torch.", "") if self.input_dtype is not None else None,
+            "execution_strategies": dict(self.strategies),
+        }
+        if self.stages is not None:
+            result["stages_ms"] = self.stages
+        return result
+
+
+class AdapterProfiler:
+    """
+    Records, per adapter layer, the time spent in the base layer and in the adapter branch, and the execution
+    strategies of its calls. The calls of the `merged` strategy, which does not call the base layer, count as base
+    layer time.
+
+    Forward pre/post hooks are registered on every `BaseTunerLayer` of `model` and on the base layer it wraps; the
+    adapter time is the time of the whole layer minus the time of its base layer. FLOPs and the bytes of the adapter
+    intermediates are derived analytically from the recorded input shapes (see `layer_costs`). `stage_breakdown`
+    additionally replays the adapter branch of the `Linear` layers operation by operation, which attributes the adapter
+    time to the input scaling, the projections and the dtype casts.
+
+    Hooks are only registered while the profiler is enabled, a disabled profiler adds no overhead.
+
+    Args:
+        model (`torch.nn.Module`):
+            The model containing the adapter layers, e.g. `VeraModel.model` or `LoraModel.model`.
+    """
+
+    def __init__(self, model: nn.Module) -> None:
+        self.model = model
+        self._handles = []
+        self._stats: Dict[str, _LayerStats] = defaultdict(_LayerStats)
+        self._events = []
+        self._starts = {}
+        self._origin = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._handles)
+
+    def _layers(self):
+        for name, module in self.model.named_modules():
+            if isinstance(module, BaseTunerLayer):
+                yield name, module
+
+    @staticmethod
+    def _synchronize(args) -> None:
+        if args and isinstance(args[0], torch.Tensor) and args[0].is_cuda:
+            torch.cuda.synchronize(args[0].device)
+
+    def _now(self) -> float:
+        return time.perf_counter() - self._origin
+
+    @staticmethod
+    def _event(name: str, category: str, start: float, end: float) -> dict:
+        # complete event of the Chrome trace event format, times in microseconds
+        return {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": 0,
+            "tid": threading.get_ident(),
+        }
+
+    def _pre_hook(self, key):
+        def hook(module, args):
+            self._synchronize(args)
+            self._starts[key] = self._now()
+
+        return hook
+
+    def _layer_hook(self, name, layer):
+        def hook(module, args, output):
+            self._synchronize((output,))
+            end = self._now()
+            start = self._starts.pop((name, "layer"))
+            stats = self._stats[name]
+            stats.calls += 1
+            stats.total_s += end - start
+            strategy = execution_strategy(layer)
+            stats.strategies[strategy] += 1
+            if strategy == "merged":
+                # the base layer is not called, the GEMM against the merged weight stands for it
+                stats.base_s += end - start
+            x = args[0] if args else None
+            if isinstance(x, torch.Tensor):
+                output_shape = tuple(output.shape) if isinstance(output, torch.Tensor) else None
+                costs = layer_costs(layer, tuple(x.shape), x.dtype, output_shape=output_shape, strategy=strategy)
+                stats.base_flops += costs["base_flops"]
+                stats.adapter_flops += costs["adapter_flops"]
+                stats.adapter_bytes += costs["adapter_bytes"]
+                stats.input_shape = tuple(x.shape)
+                stats.input_dtype = x.dtype
+            self._events.append(self._event(name, "layer", start, end))
+
+        return hook
+
+    def _base_hook(self, name):
+        def hook(module, args, output):
+            self._synchronize((output,))
+            end = self._now()
+            start = self._starts.pop((name, "base"))
+            self._stats[name].base_s += end - start
+            self._events.append(self._event(f"{name} (base)", "base", start, end))
+
+        return hook
+
+    def enable(self) -> "AdapterProfiler":
+        """Registers the hooks on all adapter layers, returns the profiler."""
+        if self.enabled:
+            return self
+        for name, layer in self._layers():
+            base_layer = layer.get_base_layer()
+            self._handles += [
+                layer.register_forward_pre_hook(self._pre_hook((name, "layer"))),
+                layer.register_forward_hook(self._layer_hook(name, layer)),
+                base_layer.register_forward_pre_hook(self._pre_hook((name, "base"))),
+                base_layer.register_forward_hook(self._base_hook(name)),
+            ]
+        return self
+
+    def disable(self) -> None:
+        """Removes all hooks, the recorded statistics are kept."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._starts = {}
+
+    def reset(self) -> None:
+        """Clears all recorded statistics and trace events."""
+        self._stats = defaultdict(_LayerStats)
+        self._events = []
+        self._origin = time.perf_counter()
+
+    def stage_breakdown(self, repeats: int = 10, warmup: int = 2) -> Dict[str, Dict[str, float]]:
+        """
+        Times every operation of the adapter branch of the profiled `Linear` adapter layers.
+
+        Each layer is replayed on a random input with the last shape and dtype recorded for it, with the actual
+        adapter weights of the layer. Returns, per layer, the median time in milliseconds of each stage (see
+        `adapter_stages`), summed over the active adapters. The result is also included in `report`.
+        """
+        breakdown = {}
+        layers = dict(self._layers())
+        with torch.no_grad():
+            for name, stats in self._stats.items():
+                layer = layers.get(name)
+                if layer is None or stats.input_shape is None or _is_embedding(layer) or _is_conv2d(layer):
+                    continue
+                # the stages are those of the low rank branches, the cached weights have none
+                if "low_rank" not in stats.strategies:
+                    continue
+                device = layer.get_base_layer().weight.device
+                times = defaultdict(float)
+                for adapter in _active_adapters(layer):
+                    x = torch.randn(stats.input_shape, dtype=stats.input_dtype, device=device)
+                    for stage, fn in adapter_stages(layer, adapter, x):
+                        samples = []
+                        for i in range(warmup + repeats):
+                            self._synchronize((x,))
+                            start = time.perf_counter()
+                            out = fn(x)
+                            self._synchronize((out,))
+                            if i >= warmup:
+                                samples.append((time.perf_counter() - start) * 1e3)
+                        times[stage] += statistics.median(samples)
+                        x = out
+                stats.stages = dict(times)
+                breakdown[name] = stats.stages
+        return breakdown
+
+    def report(self) -> Dict[str, object]:
+        """
+        Returns the recorded statistics per adapter layer and their totals.
+
+        Times are wall-clock times summed over all recorded calls.
+        """
+        layers = {name: stats.as_dict() for name, stats in self._stats.items()}
+        totals = defaultdict(float)
+        for stats in layers.values():
+            for key in ("total_ms", "base_ms", "adapter_ms", "base_flops", "adapter_flops", "adapter_bytes"):
+                totals[key] += stats[key]
+        for key in ("base_flops", "adapter_flops", "adapter_bytes"):
+            totals[key] = int(totals[key])
+        totals["adapter_share"] = totals["adapter_ms"] / totals["total_ms"] if totals["total_ms"] > 0 else 0.0
+        stages = defaultdict(float)
+        for stats in layers.values():
+            for stage, elapsed in stats.get("stages_ms", {}).items():
+                stages[stage] += elapsed
+        if stages:
+            totals["stages_ms"] = dict(stages)
+        return {"layers": layers, "total": dict(totals)}
+
+    def export_chrome_trace(self, path: str) -> None:
+        """
+        Writes the recorded calls in the Chrome trace event format, viewable in `chrome://tracing` or Perfetto.
+
+        Every call of an adapter layer is one event, with the call of its base layer nested inside.
+        """
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, f)
+
+
+class ProfilingMixin:
+    """
+    Per-layer profiling of a tuner model (`LoraModel`, `VeraModel`), whose adapter layers live in `self.model`. See
+    [`AdapterProfiler`].
+    """
+
+    def enable_profiling(self) -> AdapterProfiler:
+        """
+        Starts recording, per adapter layer, the time spent in the base layer and in the adapter branch, as well as
+        the FLOPs and the bytes of the adapter intermediates. See [`~utils.profiler.AdapterProfiler`].
+
+        Returns the profiler. Its statistics are kept across `disable_profiling` until `reset` is called on it.
+        """
+        if getattr(self, "_profiler", None) is None:
+            self._profiler = AdapterProfiler(self.model)
+        return self._profiler.enable()
+
+    def disable_profiling(self) -> None:
+        """Removes the profiling hooks, the recorded statistics are kept."""
+        if getattr(self, "_profiler", None) is not None:
+            self._profiler.disable()
+
+    def profiling_report(self, stage_breakdown: bool = False) -> dict:
+        """
+        Returns the per-layer statistics recorded since profiling was enabled.
+
+        Args:
+            stage_breakdown (`bool`):
+                Whether to additionally time every operation of the adapter branch of the `Linear` layers (input
+                scaling, projections, dtype casts) by replaying them on the recorded input shapes. Defaults to `False`.
+        """
+        if getattr(self, "_profiler", None) is None:
+            raise ValueError("Profiling was never enabled, call `enable_profiling` first.")
+        if stage_breakdown:
+            self._profiler.stage_breakdown()
+        return self._profiler.report()
@@ -0,0 +1,59 @@
+"""
+Registry of the adapter layers of a tuner model.
+
+Adapter management (activating, enabling, deleting, merging and unloading adapters) only deals with the adapter
+layers and the `ModulesToSaveWrapper`s, a small fraction of the modules of a large backbone. The tuners record them in
+a `TunerLayerRegistry` when they are injected, so that these operations do not walk the whole model. The
+`ModulesToSaveWrapper`s that `PeftModel` creates after the injection, e.g. around the classifier of a SEQ_CLS model,
+are looked up by key by `register_modules_to_save` before these operations, only when the configs changed.
+"""
+from typing import Callable, Dict, Hashable, Iterable, List, Tuple, Type, Union
+
+import torch.nn as nn
+from peft.tuners.tuners_utils import BaseTunerLayer
+from peft.utils import ModulesToSaveWrapper
+
+
+class TunerLayerRegistry:
+    """The adapter layers (`BaseTunerLayer`) and `ModulesToSaveWrapper`s of a model, by module key."""
+
+    def __init__(self):
+        self._modules: Dict[str, nn.Module] = {}
+        # the signature of the configs the `ModulesToSaveWrapper`s were last looked up for
+        self._modules_to_save_signature = None
+
+    def __len__(self) -> int:
+        return len(self._modules)
+
+    def register(self, key: str, module: nn.Module) -> None:
+        self._modules[key] = module
+
+    def register_modules_to_save(
+        self, model: nn.Module, keys: Callable[[], Iterable[str]], signature: Hashable
+    ) -> None:
+        """
+        Registers the `ModulesToSaveWrapper`s of `model` found at `keys()`, the keys of the `modules_to_save` of the
+        adapter configs (see `TargetModuleIndex.modules_to_save`). The keys are only looked up again when `signature`,
+        that of the configs, changes.
+        """
+        if signature == self._modules_to_save_signature:
+            return
+        for key in keys():
+            try:
+                module = model.get_submodule(key)
+            except AttributeError:
+                continue
+            if isinstance(module, ModulesToSaveWrapper):
+                self.register(key, module)
+        self._modules_to_save_signature = signature
+
+    def clear(self) -> None:
+        self._modules.clear()
+        self._modules_to_save_signature = None
+
+    def items(self) -> List[Tuple[str, nn.Module]]:
+        return list(self._modules.items())
+
+    def modules(self, module_cls: Union[Type, Tuple[Type, ...]] = (BaseTunerLayer, ModulesToSaveWrapper)) -> List:
+        """The registered modules that are instances of `module_cls`, in registration order."""
+        return [module for module in self._modules.values() if isinstance(module, module_cls)]
@@ -0,0 +1,150 @@
+"""
+Precompiled target-module matching.
+
+`peft.tuners.tuners_utils.check_target_module_exists` re-evaluates the target modules (and compiles the regexes of
+`layers_pattern`) for every module key, and the rank/alpha patterns are matched again per module. A
+`TargetModuleIndex` compiles all of them once and resolves every module of a model in one pass.
+"""
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch.nn as nn
+from peft.tuners.tuners_utils import BaseTunerLayer
+from peft.utils import ModulesToSaveWrapper
+
+
+def module_keys(model: nn.Module) -> List[str]:
+    """
+    Names of the modules of `model`, without the internals of the adapter layers and of the `ModulesToSaveWrapper`s.
+
+    Wrapping a module keeps its name, so the keys are the same before and after any number of injections.
+    """
+    keys = []
+
+    def visit(module, prefix):
+        keys.append(prefix)
+        if isinstance(module, (BaseTunerLayer, ModulesToSaveWrapper)):
+            return
+        for name, child in module.named_children():
+            visit(child, f"{prefix}.{name}" if prefix else name)
+
+    visit(model, "")
+    return keys
+
+
+def config_signature(config, r_attr: str, alpha_attr: str) -> tuple:
+    """The fields of `config` that determine the targets, ranks and alphas of the index, as a hashable tuple."""
+
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted(value.items()))
+        if isinstance(value, (list, set, tuple)):
+            return tuple(sorted(value, key=str))
+        return value
+
+    return tuple(
+        freeze(getattr(config, name, None))
+        for name in (
+            "target_modules",
+            "layers_to_transform",
+            "layers_pattern",
+            "rank_pattern",
+            "alpha_pattern",
+            "modules_to_save",
+            r_attr,
+            alpha_attr,
+        )
+    )
+
+
+class TargetModuleIndex:
+    """
+    The modules of a model targeted by an adapter config, with their rank and alpha.
+
+    Matches like `check_target_module_exists`, and resolves the rank and alpha like the `rank_pattern`/`alpha_pattern`
+    handling of the tuners: the first pattern key (rank patterns first) that is a dotted suffix of the module key
+    selects the entries of both patterns.
+
+    Args:
+        keys (`Iterable[str]`):
+            The module keys to resolve, see [`module_keys`].
+        config:
+            The adapter config, already prepared (e.g. with `target_modules` resolved).
+        r (`int`):
+            Default rank.
+        alpha (`float`):
+            Default alpha.
+    """
+
+    def __init__(self, keys: Iterable[str], config, r: int, alpha: float):
+        self.r = r
+        self.alpha = alpha
+        self.rank_pattern = getattr(config, "rank_pattern", None) or {}
+        self.alpha_pattern = getattr(config, "alpha_pattern", None) or {}
+        self._compile(config)
+
+        # (rank, alpha) of every targeted key, and the keys of the modules to save, in the order of `keys`
+        self.targets: Dict[str, Tuple[int, float]] = {}
+        self.modules_to_save: List[str] = []
+        self.matched_keys: List[str] = []
+        for key in keys:
+            if self._modules_to_save and any(key.endswith(name) for name in self._modules_to_save):
+                self.modules_to_save.append(key)
+            elif self.matches(key):
+                self.targets[key] = self.rank_and_alpha(key)
+            else:
+                continue
+            self.matched_keys.append(key)
+
+    def _compile(self, config) -> None:
+        target_modules = config.target_modules
+        if isinstance(target_modules, str):
+            self._target_regex = re.compile(target_modules)
+            self._target_names = set()
+            self._layer_indexes = None
+        else:
+            # a key listed as is in `target_modules` is targeted whatever `layers_to_transform`
+            self._target_names = set(target_modules)
+            # any of the names, as is or as a dotted suffix
+            names = "|".join(re.escape(name) for name in target_modules)
+            self._target_regex = re.compile(rf"(?:.*\.)?(?:{names})" if names else r"(?!)")
+
+            layer_indexes = getattr(config, "layers_to_transform", None)
+            layers_pattern = getattr(config, "layers_pattern", None)
+            is_using_layer_indexes = layer_indexes is not None and (
+                len(layer_indexes) != 0 if isinstance(layer_indexes, list) else True
+            )
+            self._layer_indexes = layer_indexes if is_using_layer_indexes else None
+            if layers_pattern is None or len(layers_pattern) == 0:
+                self._layer_regexes = [re.compile(r".*\.[^.]*\.(\d+)\.")]
+            else:
+                layers_pattern = [layers_pattern] if isinstance(layers_pattern, str) else layers_pattern
+                self._layer_regexes = [re.compile(rf".*\.{pattern}\.(\d+)\.") for pattern in layers_pattern]
+
+        self._modules_to_save = list(getattr(config, "modules_to_save", None) or [])
+        pattern_keys = list(self.rank_pattern) + list(self.alpha_pattern)
+        self._pattern_regexes = [(key, re.compile(rf".*\.{key}$")) for key in pattern_keys]
+
+    def matches(self, key: str) -> bool:
+        if key in self._target_names:
+            return True
+        if self._target_regex.fullmatch(key) is None:
+            return False
+        if self._layer_indexes is None:
+            return True
+
+        layer_index = None
+        for regex in self._layer_regexes:
+            layer_index = regex.match(key)
+            if layer_index is not None:
+                break
+        if layer_index is None:
+            return False
+        layer_index = int(layer_index.group(1))
+        if isinstance(self._layer_indexes, int):
+            return layer_index == self._layer_indexes
+        return layer_index in self._layer_indexes
+
+    def rank_and_alpha(self, key: str) -> Tuple[int, float]:
+        pattern_key: Optional[str] = next((name for name, regex in self._pattern_regexes if regex.match(key)), key)
+        return self.rank_pattern.get(pattern_key, self.r), self.alpha_pattern.get(pattern_key, self.alpha)
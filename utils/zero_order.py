@@ -0,0 +1,79 @@
+"""
+Zero-order (forward only) optimization of the trainable parameters, in the style of SPSA and MeZO.
+
+Every step perturbs the trainable parameters in place along a random direction `z`, evaluates the loss at
+`theta + eps * z` and `theta - eps * z` with two forwards, restores them and moves them along `z` by the finite
+difference estimate of the directional derivative. `z` is never stored: it is drawn again from the seed of the step
+every time it is needed. No backward is run and no activation is kept, so training only takes the memory of inference.
+"""
+from typing import Callable, Dict, Iterator, Tuple
+
+import torch
+
+
+class ZeroOrderSGD(torch.optim.Optimizer):
+    """
+    SGD with the SPSA estimate of the gradient, `((loss(theta + eps * z) - loss(theta - eps * z)) / (2 * eps)) * z`
+    for a standard normal `z` over all the trainable parameters (`requires_grad`).
+
+    The parameters are visited in the order of the parameter groups, e.g. the `vera_lambda_*` vectors in the order of
+    `model.named_parameters()`, so `z` is a seeded noise vector over their concatenation. A `torch.optim` optimizer, it
+    works with the learning rate schedulers; `step` requires a closure returning the loss of the current batch, which
+    must be deterministic (no dropout) for the two evaluations to be comparable.
+
+    Args:
+        params: Parameters or parameter groups to optimize.
+        lr (`float`): Learning rate. Defaults to 1e-3.
+        eps (`float`): Scale of the perturbations. Defaults to 1e-3.
+        weight_decay (`float`): Decoupled weight decay. Defaults to 0.
+        seed (`int`): Seed of the sequence of per-step seeds. Defaults to 0.
+    """
+
+    def __init__(self, params, lr: float = 1e-3, eps: float = 1e-3, weight_decay: float = 0.0, seed: int = 0):
+        if eps <= 0.0:
+            raise ValueError(f"Invalid eps: {eps}")
+        super().__init__(params, {"lr": lr, "weight_decay": weight_decay})
+        self.eps = eps
+        self._seeds = torch.Generator().manual_seed(seed)
+        # the finite difference estimate of the directional derivative of the last step
+        self.projected_grad = None
+
+    def _directions(self, seed: int) -> Iterator[Tuple[Dict, torch.Tensor, torch.Tensor]]:
+        # yields every trainable parameter with its group and its slice of `z`, the same ones for the same seed;
+        # like the torch optimizers, the frozen parameters of the groups are left alone
+        generators = {}
+        for group in self.param_groups:
+            for param in group["params"]:
+                if not param.requires_grad:
+                    continue
+                if param.device not in generators:
+                    generators[param.device] = torch.Generator(device=param.device).manual_seed(seed)
+                z = torch.randn(param.shape, generator=generators[param.device], device=param.device)
+                yield group, param, z.to(param.dtype)
+
+    def _perturb(self, seed: int, scale: float) -> None:
+        for _, param, z in self._directions(seed):
+            param.add_(z, alpha=scale * self.eps)
+
+    @torch.no_grad()
+    def step(self, closure: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """
+        Runs `closure` at the two perturbed points and updates the parameters. Returns the loss at `theta + eps * z`.
+        """
+        if closure is None:
+            raise ValueError("`ZeroOrderSGD.step` requires a closure returning the loss.")
+        seed = int(torch.randint(2**62, (1,), generator=self._seeds))
+
+        self._perturb(seed, 1.0)
+        loss_plus = closure()
+        self._perturb(seed, -2.0)
+        loss_minus = closure()
+        # back to theta, then along -z; `z` is drawn again rather than kept
+        self._perturb(seed, 1.0)
+
+        self.projected_grad = (loss_plus.item() - loss_minus.item()) / (2 * self.eps)
+        for group, param, z in self._directions(seed):
+            if group["weight_decay"] != 0.0:
+                param.mul_(1 - group["lr"] * group["weight_decay"])
+            param.add_(z, alpha=-group["lr"] * self.projected_grad)
+        return loss_plus
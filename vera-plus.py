@@ -16,11 +16,11 @@ from peft import (
     PeftType,
 )
 from rsverac.config import VeraConfig
-import evaluate
 from datasets import load_dataset
 
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, get_linear_schedule_with_warmup, set_seed, AutoConfig
 from tqdm import tqdm
+from utils import AsyncEvaluator, GlueMetric, ZeroOrderSGD
 from rsverac.model import VeraModel
 
 
@@ -43,6 +43,13 @@ parser.add_argument("--vera_alpha", type=int, default=8, help="Vera alpha value
 parser.add_argument("--use_rsvera", type=bool, default=True, help="Whether to use RSVeRA")
 parser.add_argument("--head_lr", type=float, default=4e-3, help="Learning rate (head)")
 parser.add_argument("--vera_lr", type=float, default=1e-2, help="Learning rate (vera)")
+parser.add_argument("--async_eval", action="store_true", help="Evaluate in a background process while training")
+parser.add_argument("--eval_threads", type=int, default=None, help="Number of threads of the evaluation process")
+parser.add_argument("--zero_order", action="store_true", help="Train with forwards only (SPSA/MeZO), without backward")
+parser.add_argument("--zo_eps", type=float, default=1e-3, help="Perturbation scale of the zero-order training")
+parser.add_argument(
+    "--zo_lr", type=float, default=1e-6, help="Learning rate of the zero-order training, instead of --head_lr/--vera_lr"
+)
 
 args = parser.parse_args()
 # Assign configuration values
@@ -65,7 +72,7 @@ peft_config = VeraConfig(
     d_initial=0.1,
     c_initial=0.1,
     target_modules=["key","query", "value"],
-    save_projection=True
+    save_projection=True,
 )
 
 head_lr = args.head_lr
@@ -82,7 +89,7 @@ if getattr(tokenizer, "pad_token_id") is None:
     tokenizer.pad_token_id = tokenizer.eos_token_id
 
 datasets = load_dataset("glue", task)
-metric = evaluate.load("glue", task)
+metric = GlueMetric(task)
 
 def tokenize_function(examples):
     if task == "sst2":
@@ -148,12 +155,18 @@ model = get_peft_model(model, peft_config)
 model.print_trainable_parameters()
 model
 #print(model)
-optimizer = AdamW(
-    [
-        {"params": [p for n, p in model.named_parameters() if "vera_lambda_" in n], "lr": vera_lr},
-        {"params": [p for n, p in model.named_parameters() if "classifier" in n], "lr": head_lr},
-    ]
-)
+param_groups = [
+    {"params": [p for n, p in model.named_parameters() if "vera_lambda_" in n and p.requires_grad], "lr": vera_lr},
+    # not the frozen `classifier.original_module` kept by the `modules_to_save` wrapper
+    {"params": [p for n, p in model.named_parameters() if "classifier" in n and p.requires_grad], "lr": head_lr},
+]
+if args.zero_order:
+    # the SPSA steps scale with the projected gradient, they diverge at the learning rates of AdamW
+    for group in param_groups:
+        group["lr"] = args.zo_lr
+    optimizer = ZeroOrderSGD(param_groups, eps=args.zo_eps)
+else:
+    optimizer = AdamW(param_groups)
 
 # Instantiate scheduler
 lr_scheduler = get_linear_schedule_with_warmup(
@@ -162,11 +175,23 @@ lr_scheduler = get_linear_schedule_with_warmup(
     num_training_steps=(len(train_dataloader) * num_epochs),
 )
 print("train:", train_dataloader)
+# the evaluation process is forked here, before the model is moved to `device`
+evaluator = AsyncEvaluator(model, eval_dataloader, metric, num_threads=args.eval_threads) if args.async_eval else None
 model.to(device)
 for epoch in range(num_epochs):
-    model.train()
+    # the two forwards of a zero-order step must see the same network, i.e. without dropout
+    model.train(not args.zero_order)
     for step, batch in enumerate(tqdm(train_dataloader)):
         batch.to(device)
+        if args.zero_order:
+            def closure():
+                with torch.inference_mode():
+                    return model(**batch).loss
+
+            optimizer.step(closure)
+            lr_scheduler.step()
+            continue
+
         outputs = model(**batch)
         loss = outputs.loss
         loss.backward()
@@ -174,6 +199,12 @@ for epoch in range(num_epochs):
         lr_scheduler.step()
         optimizer.zero_grad()
         
+    if evaluator is not None:
+        evaluator.submit(epoch, model)
+        for finished_epoch, eval_metric in evaluator.poll():
+            print(f"epoch {finished_epoch}:", eval_metric)
+        continue
+
     model.eval()
     for step, batch in enumerate(tqdm(eval_dataloader)):
         batch.to(device)
@@ -190,6 +221,10 @@ for epoch in range(num_epochs):
     print(f"epoch {epoch}:", eval_metric)
     
     
+if evaluator is not None:
+    for finished_epoch, eval_metric in evaluator.close():
+        print(f"epoch {finished_epoch}:", eval_metric)
+
 save_model(model, f"{model_name_or_path}_{task}.safetensors")
 load_model(model, f"{model_name_or_path}_{task}.safetensors")
 